@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+NanoBanana MCP Server 离线基准测试
+
+启动本地模拟 OpenRouter（mock_openrouter.py），通过 stdio 启动多个
+mcp_server.py 会话并发调用工具，统计吞吐量、尾延迟、峰值内存和 stdio
+管道字节数；可与保存的基线对比，超出容差时以非零状态退出。
+
+用法:
+    python benchmark.py --sessions 4 --requests 20 --save-baseline bench_baseline.json
+    python benchmark.py --baseline bench_baseline.json --tolerance 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import AsyncExitStack
+
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+
+import mock_openrouter
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mcp_server.py")
+
+
+def _prompt(i: int) -> list[dict]:
+    # 每次请求使用不同的提示词，避免被请求合并或缓存命中
+    return [{"role": "user", "content": f"生成一张图片：基准测试场景 #{i}"}]
+
+
+SCENARIOS = {
+    "chat_inline": ("chat_completion", lambda i, out: {"messages": _prompt(i)}),
+    "chat_file": ("chat_completion", lambda i, out: {"messages": _prompt(i), "output": "file", "output_dir": out}),
+    "chat_stream": ("chat_completion", lambda i, out: {"messages": _prompt(i), "stream": True, "output": "file", "output_dir": out}),
+    "list_models": ("list_models", lambda i, out: {"modality": "image", "limit": 20}),
+    "batch": ("batch_generate", lambda i, out: {
+        "items": [f"生成一张图片：批量场景 #{i}-{j}" for j in range(4)],
+        "output": "file",
+        "output_dir": out,
+        "concurrency": 4,
+    }),
+}
+
+# 越大越差的指标和越小越差的指标
+HIGHER_IS_WORSE = ("p50_ms", "p95_ms", "p99_ms", "peak_rss_mb", "pipe_bytes_per_call")
+LOWER_IS_WORSE = ("throughput_rps",)
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _is_error(result) -> bool:
+    if result.isError:
+        return True
+    for content in result.content:
+        if getattr(content, "type", None) == "text":
+            try:
+                data = json.loads(content.text)
+            except ValueError:
+                return False
+            return isinstance(data, dict) and "error" in data and "results" not in data
+    return False
+
+
+async def run_session(scenario: str, session_id: int, args, env: dict, output_dir: str) -> dict:
+    """启动一个服务器进程并发调用工具，返回该会话的原始统计"""
+    tool, make_args = SCENARIOS[scenario]
+    params = StdioServerParameters(command=sys.executable, args=[SERVER_SCRIPT], env=env)
+    latencies: list[float] = []
+    pipe_bytes = 0
+    errors = 0
+
+    async with AsyncExitStack() as stack:
+        read, write = await stack.enter_async_context(stdio_client(params))
+        session = await stack.enter_async_context(ClientSession(read, write))
+        await session.initialize()
+        # 服务器应答 initialize 后才在后台导入 mcp/httpx，先等它就绪，冷启动不计入请求延迟
+        await session.read_resource("nano-banana://config")
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        started = time.perf_counter()
+
+        async def call(i: int) -> None:
+            nonlocal pipe_bytes, errors
+            async with semaphore:
+                started = time.perf_counter()
+                result = await session.call_tool(tool, make_args(session_id * 100000 + i, output_dir))
+                latencies.append(time.perf_counter() - started)
+                pipe_bytes += len(result.model_dump_json())
+                errors += _is_error(result)
+
+        await asyncio.gather(*(call(i) for i in range(args.requests)))
+        finished = time.perf_counter()
+
+        metrics = await session.read_resource("nano-banana://metrics")
+        process = json.loads(metrics.contents[0].text).get("process", {})
+
+    return {
+        "started": started,
+        "finished": finished,
+        "latencies": latencies,
+        "pipe_bytes": pipe_bytes,
+        "errors": errors,
+        "peak_rss_bytes": process.get("peak_rss_bytes", 0),
+    }
+
+
+async def run_scenario(scenario: str, args, env: dict) -> dict:
+    """并发运行多个会话并汇总结果"""
+    with tempfile.TemporaryDirectory(prefix="nano_banana_bench_") as output_dir:
+        sessions = await asyncio.gather(
+            *(run_session(scenario, i, args, env, output_dir) for i in range(args.sessions))
+        )
+
+    # 吞吐量只统计调用窗口，不含进程启动和初始化
+    elapsed = max(s["finished"] for s in sessions) - min(s["started"] for s in sessions)
+
+    latencies = [lat for s in sessions for lat in s["latencies"]]
+    calls = len(latencies)
+    return {
+        "calls": calls,
+        "errors": sum(s["errors"] for s in sessions),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(calls / elapsed, 3) if elapsed else 0.0,
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(_percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 1),
+        "peak_rss_mb": round(max(s["peak_rss_bytes"] for s in sessions) / 1024 / 1024, 1),
+        "pipe_bytes_per_call": round(sum(s["pipe_bytes"] for s in sessions) / calls) if calls else 0,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """与基线比较，返回超出容差的回归项"""
+    regressions = []
+    for scenario, current in report["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(scenario)
+        if not base:
+            continue
+        for key in HIGHER_IS_WORSE:
+            if base.get(key) and current[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{scenario}.{key}: {base[key]} -> {current[key]}")
+        for key in LOWER_IS_WORSE:
+            if base.get(key) and current[key] < base[key] * (1 - tolerance):
+                regressions.append(f"{scenario}.{key}: {base[key]} -> {current[key]}")
+        # 出错的调用也计入延迟和吞吐量，失败变快时上面的指标反而“变好”，错误率需要单独把关
+        base_rate, rate = _error_rate(base), _error_rate(current)
+        if rate > base_rate * (1 + tolerance) or (rate and not base_rate):
+            regressions.append(f"{scenario}.error_rate: {base_rate:.2%} -> {rate:.2%}")
+    return regressions
+
+
+def _error_rate(result: dict) -> float:
+    return result.get("errors", 0) / result["calls"] if result.get("calls") else 0.0
+
+
+async def main_async(args) -> int:
+    mock = mock_openrouter.MockOpenRouter(mock_openrouter.config_from_args(args)).start()
+    env = dict(os.environ)
+    env.update({
+        "OPENROUTER_API_URL": mock.url,
+        "OPENROUTER_API_KEY": env.get("OPENROUTER_API_KEY") or "sk-or-v1-mock",
+        "NANO_BANANA_CACHE": "off",
+    })
+
+    print(f"🧪 模拟 OpenRouter: {mock.url}")
+    print(f"   会话数: {args.sessions}, 每会话请求数: {args.requests}, 会话内并发: {args.concurrency}")
+    print("=" * 70)
+
+    report = {
+        "config": {
+            "sessions": args.sessions,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "mock": vars(mock.config),
+        },
+        "scenarios": {},
+    }
+    try:
+        for scenario in args.scenarios:
+            result = await run_scenario(scenario, args, env)
+            report["scenarios"][scenario] = result
+            print(
+                f"{scenario:12s} {result['throughput_rps']:8.2f} req/s  "
+                f"p50 {result['p50_ms']:8.1f} ms  p95 {result['p95_ms']:8.1f} ms  "
+                f"p99 {result['p99_ms']:8.1f} ms  RSS {result['peak_rss_mb']:6.1f} MB  "
+                f"pipe {result['pipe_bytes_per_call']:>10} B/call  errors {result['errors']}"
+            )
+    finally:
+        mock.stop()
+
+    print("=" * 70)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"📄 报告已保存: {args.output}")
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"📌 基线已保存: {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"❌ 相对基线回归超过 {args.tolerance:.0%}:")
+            for line in regressions:
+                print(f"   {line}")
+            return 1
+        print(f"✅ 未发现超过 {args.tolerance:.0%} 的回归")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NanoBanana MCP Server 离线基准测试")
+    parser.add_argument("--sessions", type=int, default=4, help="并发 MCP 会话（服务器进程）数")
+    parser.add_argument("--requests", type=int, default=20, help="每个会话的请求数")
+    parser.add_argument("--concurrency", type=int, default=4, help="每个会话内的并发请求数")
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=list(SCENARIOS),
+        default=list(SCENARIOS),
+        help="要运行的场景",
+    )
+    parser.add_argument("--output", help="保存 JSON 报告的路径")
+    parser.add_argument("--baseline", help="对比的基线 JSON")
+    parser.add_argument("--save-baseline", help="把本次结果保存为基线")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的回归比例 (默认 0.2)")
+    mock_openrouter.add_arguments(parser)
+    args = parser.parse_args()
+
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
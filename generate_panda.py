@@ -6,10 +6,20 @@
 import asyncio
 import json
 import os
-import base64
 import httpx
 from datetime import datetime
 
+from mcp_server import (
+    check_postprocess,
+    close_image_pool,
+    postprocess_image,
+    run_in_image_pool,
+    save_data_url,
+)
+
+# 保存原图后额外生成的 WebP 版本（需要 Pillow，未安装时跳过）
+POSTPROCESS = {"format": "webp", "quality": 85, "sizes": [1024, 512, 256]}
+
 
 async def generate_and_save_panda():
     """生成熊猫武士图片并保存"""
@@ -79,30 +89,25 @@ async def generate_and_save_panda():
                     for i, img in enumerate(images, 1):
                         url = img.get("image_url", {}).get("url", "")
                         if url and url.startswith("data:image"):
-                            # 解析 base64 数据
-                            header, encoded = url.split(",", 1)
-                            image_data = base64.b64decode(encoded)
-                            
-                            # 确定文件格式
-                            if "jpeg" in header or "jpg" in header:
-                                ext = "jpg"
-                            elif "png" in header:
-                                ext = "png"
-                            elif "webp" in header:
-                                ext = "webp"
-                            else:
-                                ext = "jpg"
+                            # 分块解码 base64 并保存文件
+                            info = save_data_url(url, ".", f"panda_warrior_{timestamp}_{i}")
                             
-                            # 保存文件
-                            filename = f"panda_warrior_{timestamp}_{i}.{ext}"
-                            with open(filename, "wb") as f:
-                                f.write(image_data)
-                            
-                            file_size = len(image_data) / 1024  # KB
+                            file_size = info["size"] / 1024  # KB
                             print(f"🖼️  图像 {i} 已保存:")
-                            print(f"   文件名: {filename}")
-                            print(f"   格式: {ext.upper()}")
+                            print(f"   文件名: {os.path.basename(info['path'])}")
+                            print(f"   格式: {info['format'].upper()}")
                             print(f"   大小: {file_size:.2f} KB")
+
+                            # 在进程池中缩放、转码，不阻塞事件循环
+                            try:
+                                check_postprocess(POSTPROCESS)
+                            except ValueError as e:
+                                print(f"   跳过后处理: {e}")
+                            else:
+                                variants = await run_in_image_pool(postprocess_image, info["path"], POSTPROCESS)
+                                for variant in variants:
+                                    print(f"   {variant['width']}x{variant['height']} {variant['format'].upper()}: "
+                                          f"{os.path.basename(variant['path'])} ({variant['size'] / 1024:.2f} KB)")
                             print()
                     
                     print(f"✅ 所有图像已保存到当前目录！")
@@ -121,6 +126,8 @@ async def generate_and_save_panda():
             print(f"❌ 失败: {e}")
             import traceback
             traceback.print_exc()
+        finally:
+            close_image_pool()
 
 
 if __name__ == "__main__":
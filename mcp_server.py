@@ -4,282 +4,5278 @@ NanoBanana MCP Server
 封装 OpenRouter API 为 MCP 服务，供 Claude Code 和 Gemini CLI 使用
 """
 
+from __future__ import annotations
+
 import asyncio
+import base64
+import codecs
+import collections
+import contextlib
+import contextvars
+import copy
+import email.utils
+import hashlib
+import importlib
+import importlib.util
+import io
 import json
 import os
-from typing import Any, Optional
-import httpx
-from mcp.server import Server
-from mcp.server.stdio import stdio_server
-from mcp.types import (
-    Resource,
-    Tool,
-    TextContent,
-    ImageContent,
-    EmbeddedResource,
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Optional, Sequence
+
+if TYPE_CHECKING:
+    import httpx
+    from mcp.server import Server
+    from mcp.types import ImageContent, Resource, TextContent, Tool
+
+
+class _LazyModule:
+    """首次访问属性时才导入的模块代理
+
+    mcp 和 httpx 的导入要花上百毫秒到一秒；推迟到第一次真正使用时，
+    stdio 模式可以先应答 initialize，同时在后台线程中完成导入（见 load_runtime）。
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def _load(self) -> Any:
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._load(), attr)
+
+
+httpx = _LazyModule("httpx")  # noqa: F811
+mcp_types = _LazyModule("mcp.types")
+
+SERVER_NAME = "nano-banana"
+SERVER_VERSION = "1.0.1"
+
+# OpenRouter API 配置（OPENROUTER_API_URL 可指向兼容的网关或本地模拟服务）
+OPENROUTER_API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1").rstrip("/")
+# 不要在模块级别抛出异常，以免影响 MCP Server 启动
+OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
+DEFAULT_MODEL = "google/gemini-3-pro-image-preview"
+
+
+def _env_int(name: str, default: int) -> int:
+    """读取整数型环境变量，非法值回退到默认值"""
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    """读取浮点型环境变量，非法值回退到默认值"""
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    """读取布尔型环境变量（1/true/yes/on 视为真）"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_json(name: str, default: Any) -> Any:
+    """读取 JSON 型环境变量；无法解析或类型与默认值不符时在 stderr 警告并回退到默认值"""
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        parsed = json.loads(value)
+    except ValueError as e:
+        print(f"⚠️ 警告: {name} 不是合法的 JSON，已忽略: {e}", file=sys.stderr)
+        return default
+    if not isinstance(parsed, type(default)):
+        kind = {dict: "object", list: "array"}.get(type(default), type(default).__name__)
+        print(f"⚠️ 警告: {name} 应为 JSON {kind}，已忽略", file=sys.stderr)
+        return default
+    return parsed
+
+
+# HTTP 连接池配置（整个服务器生命周期共享一个客户端）
+HTTP_MAX_CONNECTIONS = _env_int("NANO_BANANA_MAX_CONNECTIONS", 20)
+HTTP_MAX_KEEPALIVE = _env_int("NANO_BANANA_MAX_KEEPALIVE", 10)
+HTTP_KEEPALIVE_EXPIRY = _env_float("NANO_BANANA_KEEPALIVE_EXPIRY", 60.0)
+HTTP_CONNECT_TIMEOUT = _env_float("NANO_BANANA_CONNECT_TIMEOUT", 10.0)
+HTTP2_ENABLED = _env_bool("NANO_BANANA_HTTP2", False)
+# 读超时：图像生成常需 30-90 秒，非流式请求在生成完成前收不到任何数据
+REQUEST_TIMEOUT = _env_float("NANO_BANANA_TIMEOUT", 180.0)
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+# 图像输出配置：inline 直接返回 data URL，file 解码保存到目录并只返回文件信息
+IMAGE_OUTPUT_MODE = os.getenv("NANO_BANANA_IMAGE_OUTPUT", "inline")
+IMAGE_OUTPUT_DIR = os.getenv("NANO_BANANA_OUTPUT_DIR", "nano_banana_output")
+# 网络模式下客户端给出的 output_dir 和 image_file 必须位于这些目录中（os.pathsep 分隔，默认只有
+# IMAGE_OUTPUT_DIR）；stdio 模式下服务器以客户端所在用户的身份运行，不做限制
+ALLOWED_DIRS = [d for d in os.getenv("NANO_BANANA_ALLOWED_DIRS", "").split(os.pathsep) if d.strip()] or [IMAGE_OUTPUT_DIR]
+# 网络模式的访问令牌：设置后 MCP 端点要求 Authorization: Bearer <token>
+HTTP_TOKEN = os.getenv("NANO_BANANA_HTTP_TOKEN", "")
+# 网络模式允许的 Host 头（逗号分隔，可用 host:* 匹配任意端口），用于 DNS 重绑定防护；
+# 监听回环地址时自动包含 127.0.0.1、localhost 和 [::1]
+HTTP_ALLOWED_HOSTS = [h.strip() for h in os.getenv("NANO_BANANA_ALLOWED_HOSTS", "").split(",") if h.strip()]
+THUMBNAIL_SIZE = _env_int("NANO_BANANA_THUMBNAIL_SIZE", 256)
+# 图像后处理（缩放、转码、缩略图）使用的进程数
+IMAGE_WORKERS = _env_int("NANO_BANANA_IMAGE_WORKERS", 2)
+POSTPROCESS_FORMATS = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP", "avif": "AVIF"}
+# 输入图像：发送前把最长边缩到该尺寸以内；编码结果按内容哈希缓存在内存中
+INPUT_MAX_SIZE = _env_int("NANO_BANANA_INPUT_MAX_SIZE", 1536)
+INPUT_CACHE_MAX_BYTES = _env_int("NANO_BANANA_INPUT_CACHE_MB", 64) * 1024 * 1024
+
+# 服务端会话：保存多轮对话历史，客户端每轮只需发送新消息
+SESSION_MAX = _env_int("NANO_BANANA_SESSION_MAX", 256)
+SESSION_TTL = _env_float("NANO_BANANA_SESSION_TTL", 24 * 3600)
+SESSION_TURNS = _env_int("NANO_BANANA_SESSION_TURNS", 20)
+SESSION_IMAGES = _env_int("NANO_BANANA_SESSION_IMAGES", 4)
+
+# 单次调用最多生成的候选数（n）
+MAX_CANDIDATES = _env_int("NANO_BANANA_MAX_CANDIDATES", 8)
+
+# 每次解码的 base64 字符数（必须是 4 的倍数）
+_B64_CHUNK_CHARS = 64 * 1024 * 4
+
+_IMAGE_MIME_TYPES = {"jpg": "image/jpeg", "png": "image/png", "webp": "image/webp", "avif": "image/avif"}
+
+# 响应缓存配置：off 不使用，read 只读，readwrite 读写
+CACHE_MODE = os.getenv("NANO_BANANA_CACHE", "off")
+CACHE_DIR = os.getenv(
+    "NANO_BANANA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "nano-banana")
+)
+CACHE_MAX_BYTES = _env_int("NANO_BANANA_CACHE_MAX_MB", 512) * 1024 * 1024
+CACHE_TTL = _env_float("NANO_BANANA_CACHE_TTL", 7 * 24 * 3600)
+
+# 批量生成配置
+BATCH_CONCURRENCY = _env_int("NANO_BANANA_BATCH_CONCURRENCY", 4)
+BATCH_ITEM_TIMEOUT = _env_float("NANO_BANANA_BATCH_ITEM_TIMEOUT", 120.0)
+
+# 后台任务配置
+JOB_WORKERS = _env_int("NANO_BANANA_JOB_WORKERS", 2)
+JOB_TTL = _env_float("NANO_BANANA_JOB_TTL", 7 * 24 * 3600)
+# 任务持久化数据库，设为空字符串时只保存在内存中
+JOB_DB = os.getenv("NANO_BANANA_JOB_DB", os.path.join(CACHE_DIR, "jobs.sqlite3"))
+# 运行中被进程崩溃打断的任务最多执行几次（每次重跑都会再次计费）
+JOB_MAX_ATTEMPTS = _env_int("NANO_BANANA_JOB_MAX_ATTEMPTS", 2)
+JOB_MAX_WAIT = 60.0
+
+# 重试与熔断配置
+RETRY_MAX_RETRIES = _env_int("NANO_BANANA_MAX_RETRIES", 3)
+RETRY_BASE_DELAY = _env_float("NANO_BANANA_RETRY_BASE_DELAY", 1.0)
+RETRY_MAX_DELAY = _env_float("NANO_BANANA_RETRY_MAX_DELAY", 30.0)
+BREAKER_FAILURE_THRESHOLD = _env_int("NANO_BANANA_BREAKER_THRESHOLD", 5)
+BREAKER_RESET_TIMEOUT = _env_float("NANO_BANANA_BREAKER_RESET", 30.0)
+_RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+# 上游凭据池：OPENROUTER_API_KEYS 为逗号分隔的多个 Key（共用 OPENROUTER_API_URL），
+# NANO_BANANA_UPSTREAMS 可完整指定：[{"url": "...", "key": "...", "weight": 2, "name": "team-a"}]，
+# type 为 openrouter（默认）或 openai（OpenAI 兼容网关），models 限定或映射该后端服务的模型
+OPENROUTER_API_KEYS = [k.strip() for k in os.getenv("OPENROUTER_API_KEYS", "").split(",") if k.strip()]
+UPSTREAMS: list = _env_json("NANO_BANANA_UPSTREAMS", [])
+# 选择策略：weighted（平滑加权轮询）、least_outstanding（在途请求数/权重最小）
+# 或 latency（按模型的滚动 p95 延迟和错误率）
+LB_STRATEGY = os.getenv("NANO_BANANA_LB_STRATEGY", "weighted")
+# 被限流（无 Retry-After 时）和认证失败的凭据暂时剔除的秒数
+EJECT_SECONDS = _env_float("NANO_BANANA_EJECT_SECONDS", 30.0)
+AUTH_EJECT_SECONDS = _env_float("NANO_BANANA_AUTH_EJECT_SECONDS", 600.0)
+# latency 策略：每个后端按模型保留最近的样本数、开始按 p95 比较前需要的样本数、
+# 错误率的惩罚系数（p95 × (1 + 系数 × 错误率)）和随机探索的概率
+ROUTER_WINDOW = _env_int("NANO_BANANA_ROUTER_WINDOW", 100)
+ROUTER_MIN_SAMPLES = _env_int("NANO_BANANA_ROUTER_MIN_SAMPLES", 5)
+ROUTER_ERROR_PENALTY = _env_float("NANO_BANANA_ROUTER_ERROR_PENALTY", 4.0)
+ROUTER_EXPLORE = _env_float("NANO_BANANA_ROUTER_EXPLORE", 0.05)
+
+# 对冲请求：请求耗时超过该模型历史耗时的 HEDGE_PERCENTILE 分位数后，向另一个后端再发一次相同请求，
+# 取先完成的结果；对冲请求数不超过普通请求数的 HEDGE_BUDGET 比例（每次对冲都可能额外计费）
+HEDGE_DEFAULT = _env_bool("NANO_BANANA_HEDGE", False)
+HEDGE_PERCENTILE = _env_float("NANO_BANANA_HEDGE_PERCENTILE", 0.9)
+HEDGE_BUDGET = _env_float("NANO_BANANA_HEDGE_BUDGET", 0.1)
+HEDGE_MIN_SAMPLES = _env_int("NANO_BANANA_HEDGE_MIN_SAMPLES", 20)
+HEDGE_MIN_DELAY = _env_float("NANO_BANANA_HEDGE_MIN_DELAY", 1.0)
+
+# 用量预算，键为 global、model:<id>、session:<id>、key:<凭据名>，* 表示每个会话/凭据各自的默认额度：
+# {"global": {"cost": 5}, "session:*": {"images": 50, "downgrade_at": 0.8, "max_tokens": 1024},
+#  "model:google/gemini-3-pro-image-preview": {"cost": 2, "on_exhausted": "downgrade",
+#  "fallback_model": "google/gemini-2.5-flash-image"}}
+BUDGETS: dict = _env_json("NANO_BANANA_BUDGETS", {})
+# 预算周期（秒），到期后用量清零；0 表示整个进程生命周期
+BUDGET_PERIOD = _env_float("NANO_BANANA_BUDGET_PERIOD", 0)
+# 按 token 计价（美元/token），上游未返回 usage.cost 时使用；未配置的模型取模型目录中的价格
+PRICING: dict = _env_json("NANO_BANANA_PRICING", {})
+
+# 客户端限速配置（0 表示不限速），NANO_BANANA_RATE_LIMITS 可按模型覆盖：
+# {"google/gemini-3-pro-image-preview": {"rpm": 20, "tpm": 100000}}
+RATE_LIMIT_RPM = _env_float("NANO_BANANA_RATE_RPM", 0)
+RATE_LIMIT_TPM = _env_float("NANO_BANANA_RATE_TPM", 0)
+RATE_LIMITS: dict = _env_json("NANO_BANANA_RATE_LIMITS", {})
+RATE_OUTPUT_TOKEN_ESTIMATE = _env_int("NANO_BANANA_TOKEN_ESTIMATE", 2000)
+PRIORITY_LANES = ("interactive", "batch")
+
+# 相同请求体的在途请求默认合并为一次上游调用
+COALESCE_DEFAULT = _env_bool("NANO_BANANA_COALESCE", True)
+
+# 指标直方图保留的样本数
+METRICS_WINDOW = _env_int("NANO_BANANA_METRICS_WINDOW", 2048)
+
+# 工具结果格式：compact（无缩进）或 pretty（缩进 2 格）
+RESULT_FORMAT = os.getenv("NANO_BANANA_RESULT_FORMAT", "compact")
+# 结果中超过该长度的字符串被截断，完整结果另存为资源；0 表示不截断
+RESULT_MAX_FIELD_CHARS = _env_int("NANO_BANANA_MAX_FIELD_CHARS", 8000)
+RESULT_STORE_MAX_BYTES = _env_int("NANO_BANANA_RESULT_STORE_MB", 32) * 1024 * 1024
+
+# 模型目录缓存配置
+MODELS_TTL = _env_float("NANO_BANANA_MODELS_TTL", 600.0)
+DEFAULT_MODEL_FIELDS = ["id", "name", "architecture.output_modalities", "context_length"]
+
+def create_http_client() -> httpx.AsyncClient:
+    """创建带连接池和 keep-alive 的 HTTP 客户端"""
+    http2 = HTTP2_ENABLED
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            print("⚠️ 警告: 未安装 h2，已回退到 HTTP/1.1（pip install 'httpx[http2]'）", file=sys.stderr)
+            http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的 HTTP 客户端（未在 main() 中创建时按需创建）"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = create_http_client()
+    return _http_client
+
+
+async def close_http_client() -> None:
+    """关闭共享的 HTTP 客户端，释放连接池"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def image_extension(header: str) -> str:
+    """根据 data URL 头部确定文件扩展名"""
+    if "jpeg" in header or "jpg" in header:
+        return "jpg"
+    elif "png" in header:
+        return "png"
+    elif "webp" in header:
+        return "webp"
+    else:
+        return "jpg"
+
+
+def save_data_url(url: str, directory: str, stem: str) -> dict:
+    """将 data:image/...;base64 URL 分块解码写入文件，返回路径、大小和 SHA-256"""
+    header, encoded = url.split(",", 1)
+    ext = image_extension(header)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{stem}.{ext}")
+
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as f:
+        for start in range(0, len(encoded), _B64_CHUNK_CHARS):
+            chunk = base64.b64decode(encoded[start:start + _B64_CHUNK_CHARS])
+            digest.update(chunk)
+            size += len(chunk)
+            f.write(chunk)
+
+    return {
+        "path": os.path.abspath(path),
+        "format": ext,
+        "size": size,
+        "sha256": digest.hexdigest(),
+    }
+
+
+def image_file_prefix() -> str:
+    """生成图像文件名前缀：时间戳加随机后缀，避免并发请求写入同名文件"""
+    return f"image_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+
+class _Base64FileSink:
+    """接收 data URL 字符串片段，边解析边把 base64 解码写入文件"""
+
+    def __init__(self, directory: str, stem: str):
+        self.directory = directory
+        self.stem = stem
+        self.header = ""
+        self.pending = ""
+        self.file: Optional[io.BufferedWriter] = None
+        self.path: Optional[str] = None
+        self.format = ""
+        self.size = 0
+        self.digest = hashlib.sha256()
+        # 不是 data URL（如远程 URL）时退化为普通字符串
+        self.plain: Optional[list[str]] = None
+
+    def write(self, text: str) -> None:
+        if self.plain is not None:
+            self.plain.append(text)
+            return
+        if self.file is None:
+            self.header += text
+            if "," not in self.header:
+                if len(self.header) > 256 or not "data:image".startswith(self.header[:10]):
+                    self.plain = [self.header]
+                return
+            header, text = self.header.split(",", 1)
+            if not header.startswith("data:image"):
+                self.plain = [self.header]
+                return
+            self.format = image_extension(header)
+            os.makedirs(self.directory, exist_ok=True)
+            self.path = os.path.abspath(os.path.join(self.directory, f"{self.stem}.{self.format}"))
+            self.file = open(self.path, "wb")
+
+        # 只解码 4 的整数倍个字符，余下的留到下一个片段
+        text = self.pending + text
+        usable = len(text) - len(text) % 4
+        self.pending = text[usable:]
+        if usable:
+            self._emit(base64.b64decode(text[:usable]))
+
+    def _emit(self, data: bytes) -> None:
+        self.digest.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    def close(self) -> Any:
+        """结束字符串，返回文件信息（或退化后的普通字符串）"""
+        if self.plain is not None:
+            return "".join(self.plain)
+        if self.file is None:
+            return self.header
+        if self.pending:
+            self._emit(base64.b64decode(self.pending + "=" * (-len(self.pending) % 4)))
+        self.file.close()
+        return {
+            "file": self.path,
+            "format": self.format,
+            "size": self.size,
+            "sha256": self.digest.hexdigest(),
+        }
+
+    def abort(self) -> None:
+        """解析失败时删除写了一半的文件"""
+        if self.file is not None:
+            self.file.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class StreamingJsonParser:
+    """增量 JSON 解析器
+
+    按块喂入文本，除 sink_factory 认领的字符串外正常构建 Python 对象；被认领的
+    字符串（如图像 data URL）直接以片段形式交给 sink，不在内存中拼接。
+    """
+
+    _WHITESPACE = " \t\r\n"
+    _STRING_SPECIAL = re.compile(r'["\\]')
+
+    def __init__(self, sink_factory: Callable[[tuple], Optional[_Base64FileSink]]):
+        self.sink_factory = sink_factory
+        self.sinks: list[_Base64FileSink] = []
+        # 栈帧：[容器, 当前键]；列表的当前键是下一个元素的下标
+        self.stack: list[list] = []
+        self.root: Any = None
+        self.done = False
+        self.state = "value"
+        self.string_parts: list[str] = []
+        self.string_sink: Optional[_Base64FileSink] = None
+        self.string_is_key = False
+        self.string_has_unicode = False
+        self.escape: Optional[str] = None
+        self.literal = ""
+
+    def feed(self, text: str) -> None:
+        i = 0
+        n = len(text)
+        while i < n:
+            state = self.state
+            if state == "string":
+                i = self._feed_string(text, i)
+                continue
+
+            ch = text[i]
+            if state == "literal":
+                if ch in ",]}" or ch in self._WHITESPACE:
+                    self._finish_value(json.loads(self.literal))
+                    self.literal = ""
+                    continue
+                self.literal += ch
+                i += 1
+                continue
+
+            i += 1
+            if ch in self._WHITESPACE:
+                continue
+
+            if state in ("value", "value_or_end"):
+                if ch == "]" and state == "value_or_end":
+                    self._close_container()
+                elif ch == "{":
+                    self._open_container({}, "key_or_end")
+                elif ch == "[":
+                    self._open_container([], "value_or_end")
+                elif ch == '"':
+                    self._start_string(is_key=False)
+                else:
+                    self.literal = ch
+                    self.state = "literal"
+            elif state in ("key", "key_or_end"):
+                if ch == "}" and state == "key_or_end":
+                    self._close_container()
+                elif ch == '"':
+                    self._start_string(is_key=True)
+                else:
+                    raise ValueError(f"Expected object key, got {ch!r}")
+            elif state == "colon":
+                if ch != ":":
+                    raise ValueError(f"Expected ':', got {ch!r}")
+                self.state = "value"
+            elif state == "after_value":
+                if ch == ",":
+                    self.state = "key" if isinstance(self.stack[-1][0], dict) else "value"
+                elif ch in "]}":
+                    self._close_container()
+                else:
+                    raise ValueError(f"Unexpected {ch!r} after value")
+            elif state == "done":
+                raise ValueError(f"Unexpected {ch!r} after end of document")
+
+    def close(self) -> Any:
+        """结束解析并返回根对象"""
+        if self.state == "literal":
+            self._finish_value(json.loads(self.literal))
+        if not self.done:
+            raise ValueError("Incomplete JSON document")
+        return self.root
+
+    def abort(self) -> None:
+        for sink in self.sinks:
+            sink.abort()
+
+    def _path(self) -> tuple:
+        return tuple(frame[1] for frame in self.stack)
+
+    def _open_container(self, container: Any, state: str) -> None:
+        self._attach(container)
+        self.stack.append([container, 0 if isinstance(container, list) else None])
+        self.state = state
+
+    def _close_container(self) -> None:
+        self.stack.pop()
+        self._after_value()
+
+    def _attach(self, value: Any) -> None:
+        if not self.stack:
+            self.root = value
+            return
+        frame = self.stack[-1]
+        if isinstance(frame[0], dict):
+            frame[0][frame[1]] = value
+        else:
+            frame[0].append(value)
+
+    def _after_value(self) -> None:
+        if not self.stack:
+            self.done = True
+            self.state = "done"
+            return
+        frame = self.stack[-1]
+        if isinstance(frame[0], list):
+            frame[1] = len(frame[0])
+        self.state = "after_value"
+
+    def _finish_value(self, value: Any) -> None:
+        self._attach(value)
+        self._after_value()
+
+    def _start_string(self, is_key: bool) -> None:
+        self.string_is_key = is_key
+        self.string_parts = []
+        self.string_has_unicode = False
+        self.string_sink = None
+        if not is_key:
+            self.string_sink = self.sink_factory(self._path())
+            if self.string_sink is not None:
+                self.sinks.append(self.string_sink)
+        self.state = "string"
+
+    def _string_write(self, text: str) -> None:
+        if self.string_sink is not None:
+            self.string_sink.write(text)
+        else:
+            self.string_parts.append(text)
+
+    def _feed_string(self, text: str, i: int) -> int:
+        """消费字符串内容，返回新的位置"""
+        if self.escape is not None:
+            # 继续处理跨块的转义序列
+            self.escape += text[i]
+            i += 1
+            if self.escape.startswith("u") and len(self.escape) < 5:
+                return i
+            self._string_write(self._decode_escape(self.escape))
+            self.escape = None
+            return i
+
+        match = self._STRING_SPECIAL.search(text, i)
+        if match is None:
+            self._string_write(text[i:])
+            return len(text)
+
+        j = match.start()
+        if j > i:
+            self._string_write(text[i:j])
+        if text[j] == "\\":
+            self.escape = ""
+            return j + 1
+
+        # 字符串结束
+        if self.string_sink is not None:
+            value = self.string_sink.close()
+        else:
+            value = "".join(self.string_parts)
+            if self.string_has_unicode:
+                # 合并 \\uXXXX 转义得到的代理对
+                value = value.encode("utf-16", "surrogatepass").decode("utf-16")
+        self.string_parts = []
+        self.string_sink = None
+
+        if self.string_is_key:
+            self.stack[-1][1] = value
+            self.state = "colon"
+        else:
+            self._finish_value(value)
+        return j + 1
+
+    def _decode_escape(self, escape: str) -> str:
+        if escape.startswith("u"):
+            self.string_has_unicode = True
+            return chr(int(escape[1:], 16))
+        return {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}.get(escape, escape)
+
+
+def _is_image_url_path(path: tuple) -> bool:
+    """是否为 choices[0].message.images[*].image_url.url"""
+    return (
+        len(path) == 7
+        and path[0] == "choices"
+        and path[1] == 0
+        and path[2] == "message"
+        and path[3] == "images"
+        and path[5] == "image_url"
+        and path[6] == "url"
+    )
+
+
+def make_thumbnail(path: str, size: int = THUMBNAIL_SIZE) -> Optional[ImageContent]:
+    """生成 JPEG 缩略图（需要 Pillow，未安装时返回 None）"""
+    data = thumbnail_jpeg(path, size)
+    if data is None:
+        return None
+    return mcp_types.ImageContent(
+        type="image",
+        data=base64.b64encode(data).decode("ascii"),
+        mimeType="image/jpeg",
+    )
+
+
+def thumbnail_jpeg(path: str, size: int = THUMBNAIL_SIZE) -> Optional[bytes]:
+    """生成 JPEG 缩略图字节（需要 Pillow，未安装时返回 None）；可在进程池中执行"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+
+    with Image.open(path) as img:
+        img.thumbnail((size, size))
+        buffer = io.BytesIO()
+        img.convert("RGB").save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+
+def postprocess_image(
+    path: str,
+    spec: dict,
+    directory: Optional[str] = None,
+    stem: Optional[str] = None,
+) -> list[dict]:
+    """按 spec 把图像缩放、转码为一组新文件，返回各文件的信息（需要 Pillow）
+
+    spec 字段：format（png/jpeg/webp/avif，默认 webp）、quality（1-100，默认 80）、
+    sizes（最长边像素列表，默认只转码原尺寸，不会放大）、strip_metadata（默认 true）。
+    文件写入 directory（默认与原图同目录），命名为 {stem}_{宽}x{高}.{扩展名}。
+    该函数只依赖文件路径和可序列化参数，可直接交给进程池执行。
+    """
+    from PIL import Image, ImageOps
+
+    fmt = spec.get("format") or "webp"
+    quality = int(spec.get("quality", 80))
+    strip = spec.get("strip_metadata", True)
+    directory = directory or os.path.dirname(os.path.abspath(path))
+    stem = stem or os.path.splitext(os.path.basename(path))[0]
+    ext = "jpg" if fmt == "jpeg" else fmt
+    os.makedirs(directory, exist_ok=True)
+
+    variants = []
+    with Image.open(path) as original:
+        # 先按 EXIF 方向旋转，去掉元数据后方向信息也不会丢失
+        img = ImageOps.exif_transpose(original)
+        save_options: dict = {}
+        if fmt == "png":
+            save_options["optimize"] = True
+        else:
+            save_options["quality"] = quality
+        if not strip:
+            # Pillow 重新编码时默认不写入 EXIF 和 ICC，只有保留元数据时才显式传入
+            for key in ("exif", "icc_profile"):
+                if original.info.get(key):
+                    save_options[key] = original.info[key]
+
+        seen = set()
+        for size in spec.get("sizes") or [max(img.size)]:
+            variant = img.copy()
+            variant.thumbnail((int(size), int(size)), Image.Resampling.LANCZOS)
+            if variant.size in seen:
+                continue
+            seen.add(variant.size)
+            if fmt == "jpeg" and variant.mode not in ("RGB", "L"):
+                variant = variant.convert("RGB")
+            elif variant.mode not in ("RGB", "RGBA", "L", "LA"):
+                variant = variant.convert("RGBA" if "transparency" in variant.info else "RGB")
+
+            out_path = os.path.join(directory, f"{stem}_{variant.width}x{variant.height}.{ext}")
+            variant.save(out_path, format=POSTPROCESS_FORMATS[fmt], **save_options)
+            with open(out_path, "rb") as f:
+                data = f.read()
+            variants.append({
+                "path": os.path.abspath(out_path),
+                "format": ext,
+                "width": variant.width,
+                "height": variant.height,
+                "size": len(data),
+                "sha256": hashlib.sha256(data).hexdigest(),
+            })
+    return variants
+
+
+def check_postprocess(spec: dict) -> None:
+    """在提交到进程池之前检查后处理参数和 Pillow 支持，不满足时抛出 ValueError"""
+    fmt = spec.get("format") or "webp"
+    if fmt not in POSTPROCESS_FORMATS:
+        raise ValueError(f"Unsupported postprocess format: {fmt}")
+    try:
+        from PIL import features
+    except ImportError:
+        raise ValueError("Image post-processing requires Pillow (pip install 'nano-banana-mcp[images]')")
+    if fmt in ("webp", "avif") and not features.check(fmt):
+        raise ValueError(f"This Pillow build cannot encode {fmt.upper()}")
+
+
+_image_pool: Optional[Any] = None
+
+
+def get_image_pool() -> Any:
+    """图像处理进程池，首次使用时创建（spawn 方式，避免在带线程的事件循环进程中 fork）"""
+    global _image_pool
+    if _image_pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        _image_pool = ProcessPoolExecutor(
+            max_workers=max(1, IMAGE_WORKERS),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _image_pool
+
+
+def close_image_pool(wait: bool = False) -> None:
+    """关闭图像进程池；服务器退出时 wait=True 等待子进程退出，释放进程池的信号量"""
+    global _image_pool
+    if _image_pool is not None:
+        _image_pool.shutdown(wait=wait, cancel_futures=True)
+        _image_pool = None
+
+
+async def run_in_image_pool(func: Callable[..., Any], *args: Any) -> Any:
+    """在图像进程池中执行 func，子进程异常退出时重建进程池"""
+    from concurrent.futures.process import BrokenProcessPool
+
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_image_pool(), func, *args)
+    except BrokenProcessPool:
+        close_image_pool()
+        raise
+
+
+# 文件头魔数 -> MIME 类型，只允许把图像文件作为输入发送给上游
+_IMAGE_MAGIC = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """根据文件头判断图像 MIME 类型，不是支持的图像时返回 None"""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for magic, mime in _IMAGE_MAGIC:
+        if head.startswith(magic):
+            return mime
+    return None
+
+
+def encode_input_image(path: str, max_size: int) -> tuple[str, bytes, str]:
+    """读取输入图像，最长边超过 max_size 时缩小并重新编码；可在进程池中执行
+
+    返回 (MIME 类型, 图像字节, 原文件 SHA-256)。未安装 Pillow 时原样返回文件内容。
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    mime = sniff_image_type(data[:16]) or "application/octet-stream"
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return mime, data, digest
+
+    with Image.open(io.BytesIO(data)) as img:
+        if max(img.size) <= max_size:
+            return mime, data, digest
+        resized = ImageOps.exif_transpose(img)
+        resized.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        if mime == "image/jpeg":
+            resized.convert("RGB").save(buffer, format="JPEG", quality=90)
+        elif mime == "image/webp":
+            resized.save(buffer, format="WEBP", quality=90)
+        else:
+            resized.save(buffer, format="PNG", optimize=True)
+            mime = "image/png"
+    return mime, buffer.getvalue(), digest
+
+
+# 网络模式下由 create_http_app() 打开，限制客户端可读写的路径
+_confine_paths = False
+
+
+def _client_path(path: str, what: str) -> str:
+    """把客户端给出的路径转为绝对路径；网络模式下要求它位于 ALLOWED_DIRS 中"""
+    path = os.path.abspath(os.path.expanduser(path))
+    if not _confine_paths:
+        return path
+    real = os.path.normcase(os.path.realpath(path))
+    for directory in ALLOWED_DIRS:
+        root = os.path.normcase(os.path.realpath(os.path.expanduser(directory)))
+        if real == root or real.startswith(root.rstrip(os.sep) + os.sep):
+            return path
+    raise ValueError(f"{what} must be inside NANO_BANANA_ALLOWED_DIRS: {path}")
+
+
+class ImageInputStore:
+    """输入图像：解析本地文件和历史生成结果的引用，按内容哈希缓存编码后的 data URL
+
+    消息中的 image_file / image_ref 内容先被替换成带内容哈希的占位 URL，
+    响应缓存和请求合并都基于这个很短的请求体计算；只有真正请求上游时（materialize）
+    才读取、缩放并编码图像。同一张图像（同一尺寸上限）只编码一次。
+    """
+
+    URL_PREFIX = "nano-banana://input/"
+
+    def __init__(self, max_bytes: int, default_max_size: int, max_generations: int = 1024):
+        self.max_bytes = max_bytes
+        self.default_max_size = default_max_size
+        self.max_generations = max_generations
+        self.sources: dict[str, str] = {}
+        self.generations: collections.OrderedDict[str, list[str]] = collections.OrderedDict()
+        self._digests: dict[tuple, str] = {}
+        self._encoded: collections.OrderedDict[tuple[str, int], str] = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, generation_id: str, paths: list[str]) -> None:
+        """记录一次生成结果的图像文件，供后续以 image_ref 引用"""
+        self.generations[generation_id] = paths
+        self.generations.move_to_end(generation_id)
+        while len(self.generations) > self.max_generations:
+            self.generations.popitem(last=False)
+
+    def digest(self, path: str) -> str:
+        """文件内容的 SHA-256；按路径、修改时间和大小记忆，未变化的文件不会重复读取"""
+        st = os.stat(path)
+        memo_key = (path, st.st_mtime_ns, st.st_size)
+        digest = self._digests.get(memo_key)
+        if digest is None:
+            hasher = hashlib.sha256()
+            with open(path, "rb") as f:
+                head = f.read(16)
+                if sniff_image_type(head) is None:
+                    raise ValueError(f"Not a supported image file (png, jpeg, webp, gif): {path}")
+                hasher.update(head)
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+            digest = self._digests[memo_key] = hasher.hexdigest()
+        return digest
+
+    def _lookup_ref(self, ref: str, index: int) -> str:
+        """ref 为 generation_id 或 job_id；多候选的结果可用 ref#k 指定第 k 个候选，否则按候选顺序编号"""
+        paths = self.generations.get(ref)
+        job_id, _, candidate = ref.partition("#")
+        if paths is None and job_id in job_manager.jobs:
+            result = job_manager.get(job_id).result or {}
+            results = result.get("candidates") or [result]
+            if candidate:
+                results = [c for c in results if str(c.get("index")) == candidate]
+            paths = [p for c in results for p in (_image_file(img) for img in c.get("images", [])) if p]
+        if not paths:
+            raise ValueError(f"Unknown generation or job id, or it has no saved images: {ref}")
+        if not 0 <= index < len(paths):
+            raise ValueError(f"Image index {index} out of range for {ref} ({len(paths)} images)")
+        return paths[index]
+
+    async def resolve_messages(self, messages: list) -> list:
+        """把消息中的 image_file / image_ref 内容替换为占位 URL，其它内容原样保留"""
+        resolved = []
+        for message in messages:
+            content = message.get("content") if isinstance(message, dict) else None
+            if isinstance(content, list) and any(
+                isinstance(part, dict) and part.get("type") in ("image_file", "image_ref")
+                for part in content
+            ):
+                message = {**message, "content": [await self._resolve_part(part) for part in content]}
+            resolved.append(message)
+        return resolved
+
+    async def _resolve_part(self, part: Any) -> Any:
+        kind = part.get("type") if isinstance(part, dict) else None
+        if kind == "image_file":
+            path = _client_path(part["path"], "image_file")
+        elif kind == "image_ref":
+            path = self._lookup_ref(part["ref"], int(part.get("index", 0)))
+        else:
+            return part
+        if not os.path.isfile(path):
+            raise ValueError(f"Image file not found: {path}")
+
+        digest = await asyncio.to_thread(self.digest, path)
+        self.sources[digest] = path
+        max_size = int(part.get("max_size") or self.default_max_size)
+        image_url = {"url": f"{self.URL_PREFIX}{digest}?max_size={max_size}"}
+        if part.get("detail"):
+            image_url["detail"] = part["detail"]
+        return {"type": "image_url", "image_url": image_url}
+
+    async def materialize(self, payload: dict) -> dict:
+        """把请求体中的占位 URL 替换为 data URL（返回新的请求体，不修改原对象）"""
+        messages = payload.get("messages", [])
+        if self.URL_PREFIX not in json.dumps(messages, ensure_ascii=False):
+            return payload
+
+        materialized = []
+        for message in messages:
+            content = message.get("content") if isinstance(message, dict) else None
+            if isinstance(content, list):
+                parts = []
+                for part in content:
+                    url = (part.get("image_url") or {}).get("url", "") if isinstance(part, dict) else ""
+                    if url.startswith(self.URL_PREFIX):
+                        part = {**part, "image_url": {**part["image_url"], "url": await self._encode(url)}}
+                    parts.append(part)
+                message = {**message, "content": parts}
+            materialized.append(message)
+        return {**payload, "messages": materialized}
+
+    async def _encode(self, url: str) -> str:
+        digest, _, query = url[len(self.URL_PREFIX):].partition("?max_size=")
+        key = (digest, int(query or self.default_max_size))
+        data_url = self._encoded.get(key)
+        if data_url is not None:
+            self.hits += 1
+            self._encoded.move_to_end(key)
+            return data_url
+
+        self.misses += 1
+        path = self.sources.get(digest)
+        if path is None:
+            raise ValueError(f"Input image {digest[:12]} is no longer available")
+        if importlib.util.find_spec("PIL") is not None:
+            mime, data, actual = await run_in_image_pool(encode_input_image, path, key[1])
+        else:
+            mime, data, actual = await asyncio.to_thread(encode_input_image, path, key[1])
+        if actual != digest:
+            raise ValueError(f"Input image changed on disk while encoding: {path}")
+
+        data_url = f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+        metrics.inc("input_image_bytes_total", len(data))
+        self._encoded[key] = data_url
+        self._bytes += len(data_url)
+        while self._bytes > self.max_bytes and len(self._encoded) > 1:
+            _, evicted = self._encoded.popitem(last=False)
+            self._bytes -= len(evicted)
+        return data_url
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "encoded": len(self._encoded),
+            "encoded_bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "generations": len(self.generations),
+        }
+
+
+def _image_file(info: dict) -> Optional[str]:
+    """结果中一张图像对应的本地文件：原图，或原图已删除时最大的后处理版本"""
+    if info.get("path"):
+        return info["path"]
+    variants = [v for v in info.get("variants", []) if v.get("path")]
+    if variants:
+        return max(variants, key=lambda v: v["width"] * v["height"])["path"]
+    return None
+
+
+image_inputs = ImageInputStore(INPUT_CACHE_MAX_BYTES, INPUT_MAX_SIZE)
+
+
+class Conversation:
+    """一个服务端会话：固定的系统消息加上按轮保存的历史消息"""
+
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.system: list[dict] = []
+        self.turns: list[list[dict]] = []
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.dropped_turns = 0
+        # 历史中引用的图像：image_ref 的 ref -> 文件路径；inline 结果的图像写入 directory
+        self.images: dict[str, list[str]] = {}
+        self.directory: Optional[str] = None
+        # 同一会话的请求依次执行，保证每轮都基于上一轮的结果
+        self.lock = asyncio.Lock()
+
+
+_IMAGE_PART_TYPES = ("image_url", "image_file", "image_ref")
+
+
+class ConversationStore:
+    """按 session_id 保存对话历史，超出数量上限或过期的会话被淘汰
+
+    历史中的生成图像以 image_ref 保存，请求上游前才展开：file 模式直接引用已保存的文件，
+    inline 模式的 base64 先写入临时目录，不在内存中保留。会话被淘汰或清除时删除这些文件。
+    拼装请求时只保留最近 max_turns 轮和最近 max_images 张历史图像。
+    """
+
+    def __init__(self, max_sessions: int, ttl: float, max_turns: int, max_images: int):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.max_images = max_images
+        self.sessions: collections.OrderedDict[str, Conversation] = collections.OrderedDict()
+        self.evicted = 0
+        self._directory: Optional[str] = None
+
+    def get(self, session_id: str) -> Conversation:
+        """取出会话，不存在时创建"""
+        self._prune()
+        conversation = self.sessions.get(session_id)
+        if conversation is None:
+            conversation = self.sessions[session_id] = Conversation(session_id)
+        self.sessions.move_to_end(session_id)
+        return conversation
+
+    def clear(self, session_id: str) -> bool:
+        conversation = self.sessions.pop(session_id, None)
+        if conversation is None:
+            return False
+        self._discard(conversation)
+        return True
+
+    def close(self) -> None:
+        """服务器退出时删除所有会话的图像文件"""
+        self.sessions.clear()
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+    def build(
+        self,
+        conversation: Conversation,
+        messages: list,
+        max_turns: Optional[int] = None,
+        max_images: Optional[int] = None,
+    ) -> tuple[list, dict]:
+        """把历史和本轮新消息拼成完整的 messages，返回 (messages, 会话信息)"""
+        max_turns = self.max_turns if max_turns is None else min(max_turns, self.max_turns)
+        max_images = self.max_images if max_images is None else max_images
+
+        # 本轮带了系统消息时替换会话的系统消息；请求成功后才由 record 保存
+        system = [m for m in messages if isinstance(m, dict) and m.get("role") == "system"]
+        system = system or conversation.system
+        turns = conversation.turns[-max_turns:] if max_turns > 0 else []
+        history = [message for turn in turns for message in turn]
+        # 重新登记历史中引用的图像，避免被 image_inputs 按数量上限淘汰
+        for ref, paths in conversation.images.items():
+            image_inputs.register(ref, paths)
+
+        # 从最新往前数，超出 max_images 的历史图像替换为文字占位
+        omitted = 0
+        for index in range(len(history) - 1, -1, -1):
+            content = history[index].get("content")
+            if not isinstance(content, list):
+                continue
+            parts = []
+            for part in reversed(content):
+                if isinstance(part, dict) and part.get("type") in _IMAGE_PART_TYPES:
+                    if max_images <= 0:
+                        omitted += 1
+                        part = {"type": "text", "text": "[earlier image omitted]"}
+                    else:
+                        max_images -= 1
+                parts.append(part)
+            history[index] = {**history[index], "content": parts[::-1]}
+
+        new_messages = [m for m in messages if not (isinstance(m, dict) and m.get("role") == "system")]
+        info = {
+            "id": conversation.id,
+            "turns": len(conversation.turns),
+            "history_messages": len(history),
+            "dropped_turns": conversation.dropped_turns + len(conversation.turns) - len(turns),
+            "omitted_images": omitted,
+        }
+        return system + history + new_messages, info
+
+    def record(self, conversation: Conversation, messages: list, response_data: dict) -> None:
+        """把本轮的用户消息和生成结果追加到历史，本轮的系统消息替换会话的系统消息"""
+        system = [m for m in messages if isinstance(m, dict) and m.get("role") == "system"]
+        if system:
+            conversation.system = system
+        user = [m for m in messages if not (isinstance(m, dict) and m.get("role") == "system")]
+        parts = []
+        if response_data.get("content"):
+            parts.append({"type": "text", "text": response_data["content"]})
+        generation_id = response_data.get("generation_id") or uuid.uuid4().hex
+        if generation_id not in image_inputs.generations:
+            self._spool_images(conversation, generation_id, response_data.get("images", []))
+        if generation_id in image_inputs.generations:
+            conversation.images[generation_id] = image_inputs.generations[generation_id]
+        for index, info in enumerate(response_data.get("images", [])):
+            if generation_id in conversation.images and index < len(conversation.images[generation_id]):
+                parts.append({"type": "image_ref", "ref": generation_id, "index": index})
+            elif _image_url(info):
+                parts.append({"type": "image_url", "image_url": {"url": _image_url(info)}})
+        if any(part["type"] != "text" for part in parts):
+            assistant = {"role": "assistant", "content": parts}
+        else:
+            assistant = {"role": "assistant", "content": response_data.get("content") or ""}
+
+        conversation.turns.append(user + [assistant])
+        # 只保存 max_turns 轮，更早的历史不会再被发送
+        if len(conversation.turns) > self.max_turns:
+            conversation.dropped_turns += len(conversation.turns) - self.max_turns
+            del conversation.turns[: -self.max_turns]
+        conversation.updated_at = time.time()
+
+    def _spool_images(self, conversation: Conversation, ref: str, images: list[dict]) -> None:
+        """把 inline 结果中的 data URL 图像写入会话目录，并登记为 ref 供 image_ref 引用"""
+        urls = [_image_url(info) or "" for info in images]
+        if not urls or not all(url.startswith("data:image") for url in urls):
+            return
+        if conversation.directory is None:
+            if self._directory is None:
+                self._directory = tempfile.mkdtemp(prefix="nano-banana-sessions-")
+            conversation.directory = tempfile.mkdtemp(dir=self._directory)
+        paths = [save_data_url(url, conversation.directory, f"{ref}_{i}")["path"] for i, url in enumerate(urls, 1)]
+        image_inputs.register(ref, paths)
+
+    def _discard(self, conversation: Conversation) -> None:
+        if conversation.directory is not None:
+            shutil.rmtree(conversation.directory, ignore_errors=True)
+
+    def _prune(self) -> None:
+        # 正在进行中的会话（锁被占用）不淘汰，即使因此暂时超出数量上限
+        cutoff = time.time() - self.ttl
+        for session_id in [k for k, c in self.sessions.items() if c.updated_at < cutoff and not c.lock.locked()]:
+            self._discard(self.sessions.pop(session_id))
+            self.evicted += 1
+        idle = [k for k, c in self.sessions.items() if not c.lock.locked()]
+        for session_id in idle[: max(0, len(self.sessions) - self.max_sessions + 1)]:
+            self._discard(self.sessions.pop(session_id))
+            self.evicted += 1
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self.sessions),
+            "max_sessions": self.max_sessions,
+            "evicted": self.evicted,
+            "turns": sum(len(c.turns) for c in self.sessions.values()),
+        }
+
+
+def _image_url(info: dict) -> Optional[str]:
+    """inline 结果中一张图像的 data URL：原图，或只有后处理版本时最大的那个"""
+    if info.get("url"):
+        return info["url"]
+    variants = [v for v in info.get("variants", []) if v.get("url")]
+    if variants:
+        return max(variants, key=lambda v: v["width"] * v["height"])["url"]
+    return None
+
+
+conversations = ConversationStore(SESSION_MAX, SESSION_TTL, SESSION_TURNS, SESSION_IMAGES)
+
+
+class ResponseCache:
+    """按请求体哈希寻址的磁盘缓存，图像单独存为 blob 文件，按大小和 TTL 做 LRU 淘汰"""
+
+    def __init__(self, directory: str, max_bytes: int, ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries_dir = os.path.join(directory, "entries")
+        self.blobs_dir = os.path.join(directory, "blobs")
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # 内存索引：key -> (条目文件大小, 引用的 blob)，按最近访问排序；首次写入时扫描磁盘建立
+        self._index: Optional[collections.OrderedDict[str, tuple[int, list[str]]]] = None
+        self._refcount: collections.Counter = collections.Counter()
+        self._blob_sizes: dict[str, int] = {}
+        self._total = 0
+
+    @staticmethod
+    def key(payload: dict) -> str:
+        """请求体的规范化哈希（忽略 stream 等不影响结果的字段）"""
+        canonical = {k: v for k, v in payload.items() if k != "stream"}
+        data = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.entries_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[dict]:
+        """读取缓存条目，图像以 blob 文件路径返回；过期或缺失时返回 None"""
+        result = self._load(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def _load(self, key: str) -> Optional[dict]:
+        path = self._entry_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry.get("created", 0) > self.ttl:
+            with self._lock:
+                self._drop(key)
+            return None
+
+        result = entry["result"]
+        try:
+            for choice in result.get("choices", []):
+                for img in choice.get("message", {}).get("images", []):
+                    image_url = img.get("image_url", {})
+                    blob = image_url.pop("blob", None)
+                    if blob is None:
+                        continue
+                    blob_path = os.path.join(self.blobs_dir, blob)
+                    if not os.path.exists(blob_path):
+                        # blob 已丢失，整个条目作废
+                        with self._lock:
+                            self._drop(key)
+                        return None
+                    sha256, ext = blob.rsplit(".", 1)
+                    image_url.update(
+                        file=blob_path,
+                        format=ext,
+                        size=os.path.getsize(blob_path),
+                        sha256=sha256,
+                    )
+                    os.utime(blob_path)
+
+            # 刷新访问时间：磁盘上的 mtime 供重启后重建索引，内存索引用于 LRU 淘汰
+            os.utime(path)
+        except OSError:
+            # 读取过程中条目或 blob 被并发的淘汰删除，按未命中处理
+            return None
+        with self._lock:
+            if self._index is not None and key in self._index:
+                self._index.move_to_end(key)
+        return result
+
+    def put(self, key: str, result: dict) -> dict:
+        """写入缓存：data URL 图像解码为 blob，返回引用 blob 文件的结果"""
+        # deepcopy 不会复制字符串本身，避免再占一份 base64 内存
+        stored = copy.deepcopy(result)
+        decoded = False
+        blobs = []
+        for choice in stored.get("choices", []):
+            for img in choice.get("message", {}).get("images", []):
+                image_url = img.get("image_url", {})
+                url = image_url.get("url") or ""
+                if url.startswith("data:image"):
+                    image_url.pop("url")
+                    image_url["blob"] = self._store_blob(url)
+                    blobs.append(image_url["blob"])
+                    decoded = True
+                elif "file" in image_url:
+                    # 已解码到磁盘的图像：复制为 blob，结果仍指向原文件
+                    blob = f"{image_url['sha256']}.{image_url['format']}"
+                    blob_path = os.path.join(self.blobs_dir, blob)
+                    if not os.path.exists(blob_path):
+                        os.makedirs(self.blobs_dir, exist_ok=True)
+                        tmp_path = os.path.join(self.blobs_dir, f"tmp_{uuid.uuid4().hex}")
+                        shutil.copyfile(image_url["file"], tmp_path)
+                        os.replace(tmp_path, blob_path)
+                    img["image_url"] = {"blob": blob, "detail": image_url.get("detail", "auto")}
+                    blobs.append(blob)
+
+        os.makedirs(self.entries_dir, exist_ok=True)
+        path = self._entry_path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "result": stored}, f, ensure_ascii=False)
+        size = os.path.getsize(tmp_path)
+        with self._lock:
+            os.replace(tmp_path, path)
+            self.writes += 1
+            if self._index is None:
+                self._scan()
+            else:
+                self._add(key, size, blobs)
+            self._shrink()
+
+        if not decoded:
+            return result
+        return self._load(key) or result
+
+    def _store_blob(self, url: str) -> str:
+        """把 data URL 解码为以 SHA-256 命名的 blob 文件，返回文件名"""
+        info = save_data_url(url, self.blobs_dir, f"tmp_{uuid.uuid4().hex}")
+        blob = f"{info['sha256']}.{info['format']}"
+        os.replace(info["path"], os.path.join(self.blobs_dir, blob))
+        return blob
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self) -> None:
+        """重新扫描磁盘：删除过期条目和无引用的 blob，按最近访问时间淘汰至容量上限"""
+        with self._lock:
+            self._scan()
+            self._shrink()
+
+    # 以下方法需持有 self._lock。索引只在首次写入和 evict() 时扫描磁盘建立，
+    # 之后随写入、命中和淘汰增量维护，每次写入的开销与条目数无关。
+
+    def _scan(self) -> None:
+        now = time.time()
+        entries = []
+        refcount: collections.Counter = collections.Counter()
+        for name in _listdir(self.entries_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.entries_dir, name)
+            try:
+                stat = os.stat(path)
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if now - entry.get("created", 0) > self.ttl:
+                self._remove(path)
+                self.evictions += 1
+                continue
+            blobs = [
+                img["image_url"]["blob"]
+                for choice in entry["result"].get("choices", [])
+                for img in choice.get("message", {}).get("images", [])
+                if "blob" in img.get("image_url", {})
+            ]
+            entries.append((stat.st_mtime, name[:-len(".json")], stat.st_size, blobs))
+            refcount.update(blobs)
+
+        self._blob_sizes = {}
+        for name in _listdir(self.blobs_dir):
+            path = os.path.join(self.blobs_dir, name)
+            if name not in refcount:
+                if not name.startswith("tmp_"):
+                    self._remove(path)
+                continue
+            try:
+                self._blob_sizes[name] = os.path.getsize(path)
+            except OSError:
+                pass
+
+        entries.sort()
+        self._index = collections.OrderedDict((key, (size, blobs)) for _, key, size, blobs in entries)
+        self._refcount = refcount
+        self._total = sum(size for _, _, size, _ in entries) + sum(self._blob_sizes.values())
+
+    def _add(self, key: str, size: int, blobs: list[str]) -> None:
+        # 先登记新条目的 blob 再释放旧条目，覆盖写入时共用的 blob 不会被删除
+        for blob in blobs:
+            if blob not in self._blob_sizes:
+                try:
+                    self._blob_sizes[blob] = os.path.getsize(os.path.join(self.blobs_dir, blob))
+                except OSError:
+                    self._blob_sizes[blob] = 0
+                self._total += self._blob_sizes[blob]
+            self._refcount[blob] += 1
+        old = self._index.pop(key, None)
+        if old is not None:
+            self._total -= old[0]
+            self._release(old[1])
+        self._index[key] = (size, blobs)
+        self._total += size
+
+    def _drop(self, key: str) -> None:
+        self._remove(self._entry_path(key))
+        if self._index is None or key not in self._index:
+            return
+        size, blobs = self._index.pop(key)
+        self._total -= size
+        self._release(blobs)
+
+    def _release(self, blobs: list[str]) -> None:
+        for blob in blobs:
+            self._refcount[blob] -= 1
+            if self._refcount[blob] <= 0:
+                del self._refcount[blob]
+                self._remove(os.path.join(self.blobs_dir, blob))
+                self._total -= self._blob_sizes.pop(blob, 0)
+
+    def _shrink(self) -> None:
+        while self._index and self._total > self.max_bytes:
+            self._drop(next(iter(self._index)))
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        """命中率等统计信息"""
+        lookups = self.hits + self.misses
+        return {
+            "directory": os.path.abspath(self.directory),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+        }
+
+
+def _listdir(directory: str) -> list[str]:
+    """列出目录内容，目录不存在时返回空列表"""
+    try:
+        return os.listdir(directory)
+    except FileNotFoundError:
+        return []
+
+
+response_cache = ResponseCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_TTL)
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求被直接拒绝"""
+
+    def __init__(self, key: str, retry_in: float):
+        super().__init__(f"Circuit open for {key}: upstream degraded, retry in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """按模型划分的熔断器：连续失败达到阈值后打开，冷却后放行一个探测请求"""
+
+    def __init__(self, key: str, failure_threshold: int, reset_timeout: float):
+        self.key = key
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def before_request(self) -> None:
+        """请求前检查，熔断打开时抛出 CircuitOpenError"""
+        if self.state == "open":
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            if remaining > 0:
+                raise CircuitOpenError(self.key, remaining)
+            self.state = "half_open"
+            self._probing = False
+
+        if self.state == "half_open":
+            # 半开状态只放行一个探测请求
+            if self._probing:
+                raise CircuitOpenError(self.key, self.reset_timeout)
+            self._probing = True
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(key: str) -> CircuitBreaker:
+    """获取（必要时创建）指定键的熔断器"""
+    breaker = _breakers.get(key)
+    if breaker is None:
+        breaker = _breakers[key] = CircuitBreaker(
+            key, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT
+        )
+    return breaker
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    """解析 Retry-After 头（秒数或 HTTP 日期）"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+# 403 响应体中表明是凭据本身的问题（而非请求内容被拒绝）的关键词
+_CREDENTIAL_ERROR_PATTERN = re.compile(
+    r"\bkey\b|api[ _-]?key|credential|credit|quota|balance|billing|payment|revoked|disabled|suspended",
+    re.IGNORECASE,
+)
+
+
+def _is_credential_error(response: httpx.Response) -> bool:
+    """错误是否由凭据引起，需要剔除该凭据
+
+    401 和 429 总是凭据问题；OpenRouter 对触发内容审核的提示词也返回 403，
+    换凭据重试没有意义，只有响应体提到密钥、额度等时才算凭据问题。
+    """
+    status = response.status_code
+    if status in (401, 429):
+        return True
+    if status != 403:
+        return False
+    try:
+        body = response.text
+    except httpx.ResponseNotRead:
+        return False
+    return bool(_CREDENTIAL_ERROR_PATTERN.search(body))
+
+
+def _is_retryable(e: Exception) -> bool:
+    """429、5xx 和网络层错误视为暂时性故障"""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in _RETRYABLE_STATUS
+    return isinstance(e, httpx.TransportError)
+
+
+async def execute_request(key: str, attempt: Callable[[], Awaitable[Any]]) -> tuple[Any, dict]:
+    """带重试、退避和熔断的请求执行器
+
+    attempt 每次调用发起一次完整请求；暂时性故障按带抖动的指数退避重试，
+    并优先遵循 Retry-After。返回 (结果, {"retries", "circuit"})；失败时
+    异常上附带 retry_info 属性。
+    """
+    breaker = get_breaker(key)
+    retries = 0
+    while True:
+        probe = False
+        try:
+            breaker.before_request()
+            probe = breaker.state == "half_open"
+            value = await attempt()
+        except CircuitOpenError as e:
+            e.retry_info = {"retries": retries, "circuit": breaker.state}
+            raise
+        except asyncio.CancelledError:
+            # 被取消的探测请求按失败处理，否则半开状态会一直拒绝后续请求
+            if probe:
+                breaker.record_failure()
+            raise
+        except Exception as e:
+            retryable = _is_retryable(e)
+            if retryable:
+                breaker.record_failure()
+            else:
+                # 4xx 等客户端错误说明上游可用，不计入熔断
+                breaker.record_success()
+
+            delay = None
+            if retryable and retries < RETRY_MAX_RETRIES and breaker.state != "open":
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** retries))
+                if isinstance(e, httpx.HTTPStatusError):
+                    retry_after = _retry_after(e.response)
+                    if retry_after is not None:
+                        # 提前重试只会再次被限流，超过上限则直接放弃
+                        delay = retry_after if retry_after <= RETRY_MAX_DELAY else None
+
+            if delay is None:
+                e.retry_info = {"retries": retries, "circuit": breaker.state}
+                raise
+            retries += 1
+            await asyncio.sleep(delay)
+            continue
+
+        breaker.record_success()
+        return value, {"retries": retries, "circuit": breaker.state}
+
+
+class Upstream:
+    """OpenRouter 后端：API 地址 + Key，记录在途请求数、状态码、token 用量和各模型的延迟
+
+    models 限定该后端服务的模型：列表表示只接受这些模型，字典表示把请求中的模型名映射为后端的模型名。
+    """
+
+    kind = "openrouter"
+    # 响应中的图像位于 choices[0].message.images，可以边接收边解码写入文件
+    supports_spool = True
+
+    def __init__(
+        self,
+        name: str,
+        url: str,
+        key: str,
+        weight: float = 1.0,
+        models: Optional[list | dict] = None,
+    ):
+        self.name = name
+        self.url = url.rstrip("/")
+        self.key = key
+        self.weight = max(float(weight), 0.001)
+        self.models = models
+        self.current_weight = 0.0
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.statuses: dict[int, int] = {}
+        self.tokens = {"prompt": 0, "completion": 0}
+        self.ejected_until = 0.0
+        self.ejections = 0
+        # 每个模型最近的请求耗时和成败（True 表示失败），供按延迟路由使用
+        self.latencies: dict[str, collections.deque] = {}
+        self.outcomes: dict[str, collections.deque] = {}
+
+    @property
+    def ejected(self) -> bool:
+        return time.monotonic() < self.ejected_until
+
+    def serves(self, model: Optional[str]) -> bool:
+        return model is None or not self.models or model in self.models
+
+    def headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.key}"}
+
+    def request_headers(self) -> dict:
+        return {
+            **self.headers(),
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://github.com/nano-banana/mcp-server",
+            "X-Title": "NanoBanana MCP Server",
+        }
+
+    def prepare(self, payload: dict) -> dict:
+        """把请求体转换为该后端接受的形式"""
+        if isinstance(self.models, dict) and payload["model"] in self.models:
+            return {**payload, "model": self.models[payload["model"]]}
+        return payload
+
+    def normalize(self, result: dict) -> dict:
+        """把响应转换为 OpenRouter 的结构（图像在 choices[0].message.images）"""
+        return result
+
+    def observe(self, model: str, seconds: Optional[float], failed: bool) -> None:
+        self.outcomes.setdefault(model, collections.deque(maxlen=ROUTER_WINDOW)).append(failed)
+        if seconds is not None:
+            self.latencies.setdefault(model, collections.deque(maxlen=ROUTER_WINDOW)).append(seconds)
+
+    def p95(self, model: str) -> Optional[float]:
+        samples = sorted(self.latencies.get(model, ()))
+        if len(samples) < ROUTER_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+
+    def error_rate(self, model: str) -> float:
+        outcomes = self.outcomes.get(model)
+        return sum(outcomes) / len(outcomes) if outcomes else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "type": self.kind,
+            "url": self.url,
+            "key": f"{self.key[:10]}...{self.key[-4:]}" if len(self.key) > 16 else "***",
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "statuses": {str(k): v for k, v in sorted(self.statuses.items())},
+            "tokens": dict(self.tokens),
+            "ejections": self.ejections,
+            "ejected_for": round(max(0.0, self.ejected_until - time.monotonic()), 1),
+            "latency": {
+                model: {"p95_seconds": self.p95(model), "error_rate": round(self.error_rate(model), 3)}
+                for model in self.outcomes
+            },
+        }
+
+
+# 文本中内嵌的 Markdown 图像：![alt](data:image/png;base64,...)
+_MARKDOWN_IMAGE_RE = re.compile(r"!\[[^\]]*\]\((data:image/[^)\s]+)\)")
+
+
+class OpenAICompatibleUpstream(Upstream):
+    """OpenAI 兼容的后端（自建网关、LiteLLM 等）
+
+    不发送 OpenRouter 专有的请求头和 modalities 参数；响应中以内容块或 Markdown
+    data URL 返回的图像会被整理到 message.images。
+    """
+
+    kind = "openai"
+    supports_spool = False
+
+    def request_headers(self) -> dict:
+        return {**self.headers(), "Content-Type": "application/json"}
+
+    def prepare(self, payload: dict) -> dict:
+        return {key: value for key, value in super().prepare(payload).items() if key != "modalities"}
+
+    def normalize(self, result: dict) -> dict:
+        for choice in result.get("choices", [])[:1]:
+            message = choice.get("message") or {}
+            images = list(message.get("images") or [])
+            content = message.get("content")
+            if isinstance(content, list):
+                texts = []
+                for part in content:
+                    if part.get("type") == "image_url":
+                        images.append({"type": "image_url", "image_url": part["image_url"]})
+                    elif part.get("type") == "text":
+                        texts.append(part.get("text", ""))
+                content = "".join(texts)
+            if isinstance(content, str) and "data:image/" in content:
+                for url in _MARKDOWN_IMAGE_RE.findall(content):
+                    images.append({"type": "image_url", "image_url": {"url": url}})
+                content = _MARKDOWN_IMAGE_RE.sub("", content).strip()
+            message["content"] = content
+            if images:
+                message["images"] = images
+        return result
+
+
+UPSTREAM_TYPES = {"openrouter": Upstream, "openai": OpenAICompatibleUpstream}
+
+
+class UpstreamPool:
+    """多凭据、多后端的负载均衡
+
+    每次请求在服务该模型、未被剔除的后端中按策略选出一个：weighted（平滑加权轮询）、
+    least_outstanding（在途请求数/权重最小）或 latency（该模型滚动 p95 延迟和错误率最低）。
+    返回 429 的凭据按 Retry-After（或 EJECT_SECONDS）暂时剔除，401 和说明凭据问题的 403
+    剔除 AUTH_EJECT_SECONDS，随后立即换另一个凭据重试；内容审核等由提示词引起的 403 不剔除。
+    """
+
+    def __init__(self, upstreams: list[Upstream], strategy: str):
+        self.upstreams = upstreams
+        self.strategy = strategy
+
+    @classmethod
+    def from_env(cls) -> "UpstreamPool":
+        upstreams = []
+        for i, u in enumerate(UPSTREAMS, 1):
+            name = (isinstance(u, dict) and u.get("name")) or f"upstream-{i}"
+            kind = str(u.get("type") or "openrouter").lower() if isinstance(u, dict) else None
+            if kind not in UPSTREAM_TYPES:
+                # 配置错误不能让服务器在启动时崩溃：跳过该项并提示
+                print(
+                    f"⚠️ 警告: NANO_BANANA_UPSTREAMS 中的 {name} 已忽略："
+                    f"type 应为 {' / '.join(UPSTREAM_TYPES)}，实际为 {u.get('type') if isinstance(u, dict) else u!r}",
+                    file=sys.stderr,
+                )
+                continue
+            upstreams.append(UPSTREAM_TYPES[kind](
+                name,
+                u.get("url") or OPENROUTER_API_URL,
+                u.get("key") or OPENROUTER_API_KEY,
+                u.get("weight", 1.0),
+                u.get("models"),
+            ))
+        if not upstreams:
+            keys = OPENROUTER_API_KEYS or [OPENROUTER_API_KEY]
+            upstreams = [Upstream(f"key-{i}", OPENROUTER_API_URL, k) for i, k in enumerate(keys, 1)]
+        return cls(upstreams, LB_STRATEGY)
+
+    def has_credentials(self) -> bool:
+        return any(u.key for u in self.upstreams)
+
+    def _serving(self, model: Optional[str], kind: Optional[str]) -> list[Upstream]:
+        return [u for u in self.upstreams if u.serves(model) and (kind is None or u.kind == kind)]
+
+    def select(
+        self,
+        exclude: Sequence[Upstream] = (),
+        model: Optional[str] = None,
+        kind: Optional[str] = None,
+    ) -> Upstream:
+        """选择一个上游；全部被剔除时选最早恢复的那个，预算用尽的凭据不参与选择
+
+        kind 限定后端类型，如模型目录只能从 OpenRouter 获取。
+        """
+        serving = self._serving(model, kind)
+        if not serving:
+            if kind is not None and model is None:
+                raise ValueError(f"No configured upstream of type {kind}")
+            raise ValueError(f"No configured upstream serves model {model}")
+        pool = [u for u in serving if not budget_ledger.exhausted("key", u.name)]
+        if not pool:
+            raise BudgetExceededError("key", "*", "every credential has exhausted its budget")
+        candidates = [u for u in pool if u not in exclude] or pool
+        healthy = [u for u in candidates if not u.ejected]
+        if not healthy:
+            return min(candidates, key=lambda u: u.ejected_until)
+        if self.strategy == "least_outstanding":
+            return min(healthy, key=lambda u: (u.outstanding / u.weight, u.requests))
+        if self.strategy == "latency" and model is not None:
+            return self._fastest(healthy, model)
+        # 平滑加权轮询：权重大的更常被选中，且不会连续扎堆
+        total = sum(u.weight for u in healthy)
+        for u in healthy:
+            u.current_weight += u.weight
+        chosen = max(healthy, key=lambda u: u.current_weight)
+        chosen.current_weight -= total
+        return chosen
+
+    def _fastest(self, healthy: list[Upstream], model: str) -> Upstream:
+        """按滚动 p95 和错误率选择；样本不足的后端优先试探，并保留少量随机探索以发现恢复的后端"""
+        unexplored = [u for u in healthy if u.p95(model) is None]
+        if unexplored:
+            return min(unexplored, key=lambda u: (u.outstanding, len(u.latencies.get(model, ()))))
+        if len(healthy) > 1 and random.random() < ROUTER_EXPLORE:
+            return random.choice(healthy)
+        return min(
+            healthy,
+            key=lambda u: u.p95(model) * (1 + ROUTER_ERROR_PENALTY * u.error_rate(model))
+            * (1 + u.outstanding / u.weight) / u.weight,
+        )
+
+    async def call(
+        self,
+        attempt: Callable[[Upstream], Awaitable[Any]],
+        model: Optional[str] = None,
+        tried: Optional[list[Upstream]] = None,
+        kind: Optional[str] = None,
+        admit: Optional[Callable[[], Awaitable[Any]]] = None,
+    ) -> tuple[Any, Upstream]:
+        """用选中的上游执行 attempt，返回 (结果, 上游)
+
+        凭据错误（429/401/凭据相关的 403）时剔除该上游，还有其它可用上游就立即换一个，
+        否则把异常交给重试逻辑。
+        tried 中的上游尽量不再选择，选中的上游也会追加到其中。
+        admit 在每次发出请求前等待（如限速排队），排队时间不计入上游的在途数和延迟。
+        """
+        tried = tried if tried is not None else []
+        while True:
+            if admit is not None:
+                await admit()
+            upstream = self.select(tried, model, kind)
+            tried.append(upstream)
+            upstream.outstanding += 1
+            upstream.requests += 1
+            started = time.monotonic()
+            try:
+                value = await attempt(upstream)
+            except httpx.HTTPStatusError as e:
+                status = e.response.status_code
+                upstream.statuses[status] = upstream.statuses.get(status, 0) + 1
+                upstream.errors += 1
+                if model is not None:
+                    upstream.observe(model, None, _is_retryable(e))
+                if _is_credential_error(e.response):
+                    self._eject(upstream, status, _retry_after(e.response))
+                    if any(not u.ejected for u in self._serving(model, kind) if u not in tried):
+                        continue
+                raise
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                upstream.errors += 1
+                if model is not None:
+                    upstream.observe(model, None, True)
+                raise
+            finally:
+                upstream.outstanding -= 1
+            upstream.statuses[200] = upstream.statuses.get(200, 0) + 1
+            if model is not None:
+                upstream.observe(model, time.monotonic() - started, False)
+            return value, upstream
+
+    def _eject(self, upstream: Upstream, status: int, retry_after: Optional[float]) -> None:
+        if status == 429:
+            seconds = retry_after if retry_after is not None else EJECT_SECONDS
+        else:
+            seconds = AUTH_EJECT_SECONDS
+        upstream.ejected_until = time.monotonic() + seconds
+        upstream.ejections += 1
+        metrics.inc("upstream_ejections_total", upstream=upstream.name, status=status)
+
+    def record_usage(self, upstream: Upstream, usage: dict) -> None:
+        for kind in ("prompt", "completion"):
+            upstream.tokens[kind] += usage.get(f"{kind}_tokens") or 0
+
+    def stats(self) -> dict:
+        return {
+            "strategy": self.strategy,
+            "upstreams": {u.name: u.stats() for u in self.upstreams},
+        }
+
+
+upstream_pool = UpstreamPool.from_env()
+
+
+class HedgePolicy:
+    """对冲请求策略：主请求超过历史耗时的分位数仍未完成时，向其它后端发出第二个相同请求
+
+    先成功的结果胜出，另一个请求被取消。对冲数受 budget（占普通请求的比例）限制；
+    分位数按模型统计，样本不足 min_samples 时不对冲。
+    """
+
+    def __init__(self, percentile: float, budget: float, min_samples: int, min_delay: float, window: int):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.samples: dict[str, collections.deque] = {}
+        self.window = window
+        self.primaries = 0
+        self.hedges = 0
+        self.wins = 0
+        self.denied = 0
+
+    def observe(self, model: str, seconds: float) -> None:
+        self.samples.setdefault(model, collections.deque(maxlen=self.window)).append(seconds)
+
+    def delay(self, model: str) -> Optional[float]:
+        """发出对冲请求前等待的秒数，样本不足时返回 None"""
+        samples = sorted(self.samples.get(model, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return max(self.min_delay, samples[min(len(samples) - 1, int(self.percentile * len(samples)))])
+
+    async def run(
+        self,
+        model: str,
+        leg: Callable[[list[Upstream]], Awaitable[tuple[Any, Upstream]]],
+        enabled: bool,
+        discard: Optional[Callable[[tuple[Any, Upstream]], None]] = None,
+    ) -> tuple[Any, Upstream]:
+        """执行 leg(tried)；启用对冲时在超过分位数后再发一次，返回先成功的结果
+
+        另一个请求若在取消前已经成功完成，其结果交给 discard（计入用量、清理已写入的文件）。
+        """
+        started = time.monotonic()
+        if not enabled:
+            value = await leg([])
+            self.observe(model, time.monotonic() - started)
+            return value
+
+        self.primaries += 1
+        tried: list[Upstream] = []
+        primary = asyncio.ensure_future(leg(tried))
+        delay = self.delay(model)
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            hedging = not done and delay is not None
+            if hedging and self.hedges >= self.budget * self.primaries:
+                self.denied += 1
+                metrics.inc("hedge_denied_total", model=model)
+                hedging = False
+            if not hedging:
+                await asyncio.wait({primary})
+        except BaseException:
+            # 调用方被取消：asyncio.wait 不会取消等待中的请求，需要手动取消并清理
+            await _abandon_legs((primary,), None, discard)
+            raise
+        if not hedging:
+            value = primary.result()
+            self.observe(model, time.monotonic() - started)
+            return value
+
+        self.hedges += 1
+        metrics.inc("hedge_requests_total", model=model)
+        hedge_started = time.monotonic()
+        # 对冲请求避开主请求正在使用的后端（只有一个后端时仍发往它）
+        hedge = asyncio.ensure_future(leg(list(tried)))
+        pending = {primary, hedge}
+        winner = None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.cancelled() and task.exception() is None:
+                        winner = task
+                        break
+        finally:
+            # 包括调用方被取消的情况：取消仍在进行的请求，清理已完成但未采用的结果
+            await _abandon_legs((primary, hedge), winner, discard)
+
+        if winner is None:
+            # 两个请求都失败时返回主请求的错误
+            return primary.result()
+        outcome = "hedge" if winner is hedge else "primary"
+        if outcome == "hedge":
+            self.wins += 1
+        metrics.inc("hedge_outcomes_total", model=model, winner=outcome)
+        metrics.observe("hedged_request_seconds", time.monotonic() - started, model=model, winner=outcome)
+        self.observe(model, time.monotonic() - (hedge_started if outcome == "hedge" else started))
+        return winner.result()
+
+    def stats(self) -> dict:
+        return {
+            "default": HEDGE_DEFAULT,
+            "percentile": self.percentile,
+            "budget": self.budget,
+            "primaries": self.primaries,
+            "hedges": self.hedges,
+            "hedge_wins": self.wins,
+            "denied": self.denied,
+            "extra_request_ratio": round(self.hedges / self.primaries, 4) if self.primaries else 0.0,
+            "delay_seconds": {model: self.delay(model) for model in self.samples},
+        }
+
+
+async def _abandon_legs(
+    legs: Sequence[asyncio.Future],
+    winner: Optional[asyncio.Future],
+    discard: Optional[Callable[[tuple[Any, Upstream]], None]],
+) -> None:
+    """取消未完成的请求并等待其结束；除 winner 外已成功完成的结果交给 discard
+
+    等待期间调用方再次被取消时，winner 的结果也不再有人使用，一并交给 discard 后重新抛出取消。
+    """
+    pending = [task for task in legs if not task.done()]
+    for task in pending:
+        task.cancel()
+    # 调用方再次取消也要等请求真正结束，避免在途计数和已写入的文件泄漏
+    gathered = asyncio.gather(*pending, return_exceptions=True)
+    interrupted = False
+    while not gathered.done():
+        try:
+            await asyncio.shield(gathered)
+        except asyncio.CancelledError:
+            interrupted = True
+    # 两个请求可能在同一轮中都成功，也可能在取消前刚好完成：上游已计费，图像可能已写入磁盘
+    for task in legs:
+        if (task is not winner or interrupted) and not task.cancelled() and task.exception() is None:
+            (discard or _discard_leg)(task.result())
+    if interrupted:
+        raise asyncio.CancelledError()
+
+
+def _discard_leg(value: tuple[Any, Upstream]) -> None:
+    _discard_spooled(value[0])
+
+
+def _discard_spooled(result: Any) -> None:
+    """删除被放弃的响应已写入磁盘的图像文件"""
+    if not isinstance(result, dict):
+        return
+    for choice in result.get("choices", [])[:1]:
+        for img in (choice.get("message") or {}).get("images") or []:
+            path = (img.get("image_url") or {}).get("file")
+            if path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+hedge_policy = HedgePolicy(HEDGE_PERCENTILE, HEDGE_BUDGET, HEDGE_MIN_SAMPLES, HEDGE_MIN_DELAY, ROUTER_WINDOW)
+
+
+class BudgetExceededError(Exception):
+    """预算已用尽，请求在发往上游之前被拒绝"""
+
+    def __init__(self, scope: str, name: str, detail: str):
+        label = scope if scope == "global" else f"{scope} {name}"
+        super().__init__(f"Budget exhausted for {label}: {detail}")
+        self.scope = scope
+
+
+_BUDGET_LIMITS = ("cost", "tokens", "requests", "images")
+
+
+class BudgetLedger:
+    """按全局、模型、会话和凭据累计请求数、token、图像数和费用，并在请求上游前做准入检查
+
+    用量达到预算的 downgrade_at 比例后降级（换 fallback_model、压低 max_tokens），
+    用尽后按 on_exhausted 拒绝（默认）或继续降级。
+
+    准入后 reserve() 按预估用量预留额度，并发的请求据此计入已用量，不会一起越过上限；
+    上游响应后 record() 按实际用量结算，请求结束时 refund() 退回预留（缓存命中、失败时不计费）。
+    """
+
+    def __init__(self, budgets: dict, period: float, pricing: dict):
+        self.budgets = budgets
+        self.period = period
+        self.pricing = pricing
+        self.totals: dict[str, dict[str, dict]] = {}
+        # 在途请求的预留用量：(scope, name) -> 各项用量
+        self.reserved: dict[tuple[str, str], dict[str, float]] = {}
+        self.window_start = time.time()
+        self.rejections = 0
+        self.downgrades = 0
+
+    def _roll(self) -> None:
+        """预算周期到期后清零用量"""
+        now = time.time()
+        if self.period and now - self.window_start >= self.period:
+            self.totals.clear()
+            self.window_start = now - (now - self.window_start) % self.period
+
+    def _entry(self, scope: str, name: str) -> dict:
+        entries = self.totals.setdefault(scope, {})
+        entry = entries.get(name)
+        if entry is None:
+            entry = entries[name] = {
+                "requests": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "tokens": 0,
+                "images": 0,
+                "cost": 0.0,
+            }
+        return entry
+
+    def _budget(self, scope: str, name: str) -> Optional[dict]:
+        if scope == "global":
+            return self.budgets.get("global")
+        return self.budgets.get(f"{scope}:{name}") or self.budgets.get(f"{scope}:*")
+
+    def _usage(self, scope: str, name: str) -> tuple[float, str]:
+        """预算中用得最多的一项：(已用比例, 描述)"""
+        budget = self._budget(scope, name)
+        if not budget:
+            return 0.0, ""
+        recorded = self.totals.get(scope, {}).get(name, {})
+        reserved = self.reserved.get((scope, name), {})
+        worst = (0.0, "")
+        for field in _BUDGET_LIMITS:
+            if budget.get(field):
+                used = recorded.get(field, 0) + reserved.get(field, 0)
+                fraction = used / budget[field]
+                if fraction >= worst[0]:
+                    worst = (fraction, f"{field} {used:.6g} of {budget[field]:g}")
+        return worst
+
+    def exhausted(self, scope: str, name: str) -> bool:
+        if not self.budgets:
+            return False
+        self._roll()
+        return self._usage(scope, name)[0] >= 1
+
+    def admit(self, payload: dict, session: str) -> Optional[dict]:
+        """请求上游前检查预算：需要降级时就地修改 payload 并返回降级信息，用尽时抛出 BudgetExceededError"""
+        if not self.budgets:
+            return None
+        self._roll()
+        downgrade: dict = {}
+        # 模型预算放在最后，按降级后的模型检查
+        for scope, name in (("global", "*"), ("session", session), ("model", None)):
+            name = name or payload["model"]
+            budget = self._budget(scope, name)
+            if not budget:
+                continue
+            fraction, detail = self._usage(scope, name)
+            soft = budget.get("downgrade_at")
+            if fraction >= 1 and budget.get("on_exhausted", "reject") != "downgrade":
+                self.rejections += 1
+                metrics.inc("budget_rejections_total", scope=scope)
+                raise BudgetExceededError(scope, name, detail)
+            if fraction >= 1 or (soft is not None and fraction >= soft):
+                fallback = budget.get("fallback_model")
+                if fallback and fallback != payload["model"]:
+                    downgrade.setdefault("original_model", payload["model"])
+                    payload["model"] = downgrade["model"] = fallback
+                if budget.get("max_tokens") and payload.get("max_tokens", float("inf")) > budget["max_tokens"]:
+                    payload["max_tokens"] = downgrade["max_tokens"] = budget["max_tokens"]
+                downgrade.setdefault("reasons", []).append(f"{scope}: {detail}")
+        if "model" in downgrade or "max_tokens" in downgrade:
+            self.downgrades += 1
+            metrics.inc("budget_downgrades_total")
+            return downgrade
+        return None
+
+    def reserve(self, payload: dict, session: str) -> Optional[list]:
+        """按预估用量为一次已准入的请求预留额度，返回交给 refund() 的预留记录"""
+        if not self.budgets:
+            return None
+        prompt = _estimate_tokens({**payload, "max_tokens": 0})
+        completion = payload.get("max_tokens", RATE_OUTPUT_TOKEN_ESTIMATE)
+        amounts = {
+            "requests": 1,
+            "tokens": prompt + completion,
+            "cost": self.price(payload["model"], {"prompt_tokens": prompt, "completion_tokens": completion}),
+        }
+        reservation = [("global", "*"), ("model", payload["model"]), ("session", session)]
+        for scope_name in reservation:
+            held = self.reserved.setdefault(scope_name, {})
+            for field, amount in amounts.items():
+                held[field] = held.get(field, 0) + amount
+        reservation.append(amounts)
+        return reservation
+
+    def refund(self, reservation: Optional[list]) -> None:
+        """退回预留的额度；实际用量已由 record() 结算"""
+        if not reservation:
+            return
+        amounts = reservation.pop()
+        for scope_name in reservation:
+            held = self.reserved.get(scope_name, {})
+            for field, amount in amounts.items():
+                held[field] = held.get(field, 0) - amount
+            if held.get("requests", 0) <= 0:
+                self.reserved.pop(scope_name, None)
+        reservation.clear()
+
+    def price(self, model: str, usage: dict) -> float:
+        """请求费用（美元）：优先用上游返回的 usage.cost，否则按单价估算"""
+        if usage.get("cost") is not None:
+            return float(usage["cost"])
+        pricing = self.pricing.get(model) or (model_catalog.by_id.get(model) or {}).get("pricing") or {}
+        try:
+            return float(pricing.get("prompt") or 0) * (usage.get("prompt_tokens") or 0) + float(
+                pricing.get("completion") or 0
+            ) * (usage.get("completion_tokens") or 0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    def record(self, model: str, session: str, key: str, usage: dict, images: int) -> None:
+        """记录一次上游请求的用量（缓存命中和合并的请求不计）"""
+        self._roll()
+        cost = self.price(model, usage)
+        for scope, name in (("global", "*"), ("model", model), ("session", session), ("key", key)):
+            entry = self._entry(scope, name)
+            entry["requests"] += 1
+            entry["prompt_tokens"] += usage.get("prompt_tokens") or 0
+            entry["completion_tokens"] += usage.get("completion_tokens") or 0
+            entry["tokens"] += usage.get("total_tokens") or 0
+            entry["images"] += images
+            entry["cost"] = round(entry["cost"] + cost, 8)
+        if cost:
+            metrics.inc("cost_usd_total", cost, model=model)
+
+    def _report(self, scope: str, name: str, entry: dict) -> dict:
+        report = dict(entry)
+        budget = self._budget(scope, name)
+        if budget:
+            report["remaining"] = {
+                field: round(max(0.0, budget[field] - entry[field]), 8)
+                for field in _BUDGET_LIMITS
+                if budget.get(field)
+            }
+        return report
+
+    def stats(self) -> dict:
+        self._roll()
+        totals = {
+            scope: {name: self._report(scope, name, entry) for name, entry in entries.items()}
+            for scope, entries in self.totals.items()
+        }
+        return {
+            "period_seconds": self.period,
+            "window_started": datetime.fromtimestamp(self.window_start).isoformat(timespec="seconds"),
+            "budgets": self.budgets,
+            "rejections": self.rejections,
+            "downgrades": self.downgrades,
+            "in_flight": self.reserved.get(("global", "*"), {}).get("requests", 0),
+            "global": totals.pop("global", {}).get("*") or self._report("global", "*", self._entry("global", "*")),
+            "models": totals.get("model", {}),
+            "sessions": totals.get("session", {}),
+            "keys": totals.get("key", {}),
+        }
+
+
+budget_ledger = BudgetLedger(BUDGETS, BUDGET_PERIOD, PRICING)
+
+# 当前请求计入哪个会话的预算：session_id，或者 MCP 客户端会话
+_budget_session: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "nano_banana_budget_session", default="default"
+)
+
+
+class TokenBucket:
+    """按分钟速率连续补充的令牌桶，rate 为 0 表示不限速"""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """距离可以取出 amount 个令牌还需等待的秒数"""
+        if not self.rate:
+            return 0.0
+        self._refill()
+        # 单次需求超过桶容量时，只要桶满即可放行，避免永远等待
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        if self.rate:
+            self._refill()
+            self.tokens -= amount
+
+    def refund(self, amount: float) -> None:
+        """按实际用量修正预估（amount 为负表示补扣）"""
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RequestScheduler:
+    """单个模型的请求调度器：RPM/TPM 双令牌桶，交互优先，同一优先级内按会话轮转"""
+
+    def __init__(self, model: str, rpm: float, tpm: float):
+        self.model = model
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        # 每个优先级：会话 -> 等待队列；dict 保持插入顺序，用于轮转
+        self.lanes: dict[str, dict[Any, collections.deque]] = {lane: {} for lane in PRIORITY_LANES}
+        self.granted = 0
+        self.total_wait = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def acquire(self, tokens: float, priority: str, session: Any) -> float:
+        """排队等待配额，返回排队耗时（秒）"""
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        lane = self.lanes.get(priority, self.lanes["interactive"])
+        lane.setdefault(session, collections.deque()).append((future, tokens))
+        self._dispatch()
+        await future
+        waited = time.monotonic() - started
+        self.granted += 1
+        self.total_wait += waited
+        return waited
+
+    def settle(self, estimated: float, actual: Optional[float]) -> None:
+        """请求完成后用实际 token 用量修正 TPM 桶"""
+        if actual is not None:
+            self.tokens.refund(estimated - actual)
+
+    def _next_waiter(self) -> Optional[tuple[dict, Any]]:
+        for lane in self.lanes.values():
+            for session, queue in list(lane.items()):
+                while queue and queue[0][0].done():
+                    # 调用方已取消（如客户端超时），直接丢弃
+                    queue.popleft()
+                if queue:
+                    return lane, session
+                del lane[session]
+        return None
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while True:
+            picked = self._next_waiter()
+            if picked is None:
+                return
+            lane, session = picked
+            future, tokens = lane[session][0]
+            delay = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if delay > 0:
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+                return
+
+            lane[session].popleft()
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            future.set_result(None)
+            # 放行后把该会话移到队尾，实现会话间公平轮转
+            queue = lane.pop(session)
+            if queue:
+                lane[session] = queue
+
+    def stats(self) -> dict:
+        return {
+            "queued": {
+                name: sum(len(q) for q in lane.values()) for name, lane in self.lanes.items()
+            },
+            "granted": self.granted,
+            "avg_wait_seconds": round(self.total_wait / self.granted, 3) if self.granted else 0.0,
+            "rpm": self.requests.capacity,
+            "tpm": self.tokens.capacity,
+        }
+
+
+_schedulers: dict[str, RequestScheduler] = {}
+
+
+def get_scheduler(model: str) -> RequestScheduler:
+    """获取（必要时创建）模型的调度器，限额取自 NANO_BANANA_RATE_LIMITS 或全局默认值"""
+    scheduler = _schedulers.get(model)
+    if scheduler is None:
+        limits = RATE_LIMITS.get(model, {})
+        # 限额按单个凭据配置，有多个凭据服务该模型时总配额相应放大
+        serving = max(1, len(upstream_pool._serving(model, None)))
+        scheduler = _schedulers[model] = RequestScheduler(
+            model,
+            rpm=limits.get("rpm", RATE_LIMIT_RPM) * serving,
+            tpm=limits.get("tpm", RATE_LIMIT_TPM) * serving,
+        )
+    return scheduler
+
+
+def _estimate_tokens(payload: dict) -> int:
+    """粗略估算请求消耗的 token：提示词按 4 字符 1 token，加上输出上限"""
+    prompt_chars = len(json.dumps(payload.get("messages", []), ensure_ascii=False))
+    return prompt_chars // 4 + payload.get("max_tokens", RATE_OUTPUT_TOKEN_ESTIMATE)
+
+
+def _current_session() -> Any:
+    """当前 MCP 会话的标识，用于会话间公平排队"""
+    job = _current_job.get()
+    if job is not None:
+        return job.session
+    if _app is None:
+        return None
+    try:
+        return id(_app.request_context.session)
+    except LookupError:
+        return None
+
+
+class Histogram:
+    """保留最近 N 个样本的直方图，用于计算 p50/p95/p99"""
+
+    def __init__(self, window: int):
+        self.samples: collections.deque = collections.deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self, *qs: float) -> list[Optional[float]]:
+        if not self.samples:
+            return [None for _ in qs]
+        ordered = sorted(self.samples)
+        return [ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in qs]
+
+
+class MetricsRegistry:
+    """进程内的计数器和直方图，按名称加标签区分"""
+
+    def __init__(self, window: int):
+        self.window = window
+        self.counters: dict[tuple, float] = {}
+        self.histograms: dict[tuple, Histogram] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.window)
+        histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, phase: str, **labels: Any):
+        """记录代码块耗时到 phase_seconds{phase=...}"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("phase_seconds", time.perf_counter() - started, phase=phase, **labels)
+
+    def snapshot(self) -> dict:
+        """JSON 形式的指标快照"""
+        counters: dict[str, list] = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            counters.setdefault(name, []).append({"labels": dict(labels), "value": value})
+
+        histograms: dict[str, list] = {}
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            p50, p95, p99 = histogram.quantiles(0.5, 0.95, 0.99)
+            histograms.setdefault(name, []).append({
+                "labels": dict(labels),
+                "count": histogram.count,
+                "sum": round(histogram.sum, 6),
+                "p50": p50,
+                "p95": p95,
+                "p99": p99,
+            })
+
+        return {
+            "counters": counters,
+            "histograms": histograms,
+            "process": _process_stats(),
+        }
+
+    def prometheus(self) -> str:
+        """Prometheus 文本格式导出（直方图以 summary 形式输出分位数）"""
+        lines = []
+        seen = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            metric = f"nano_banana_{name}"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_prom_labels(labels)} {_prom_number(value)}")
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            metric = f"nano_banana_{name}"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} summary")
+            for q, value in zip((0.5, 0.95, 0.99), histogram.quantiles(0.5, 0.95, 0.99)):
+                if value is not None:
+                    lines.append(f"{metric}{_prom_labels(labels + (('quantile', str(q)),))} {_prom_number(value)}")
+            lines.append(f"{metric}_count{_prom_labels(labels)} {histogram.count}")
+            lines.append(f"{metric}_sum{_prom_labels(labels)} {_prom_number(histogram.sum)}")
+
+        for name, value in _process_stats().items():
+            metric = f"nano_banana_process_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {_prom_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _prom_number(value: float) -> str:
+    """整数原样输出，避免 :g 格式丢失精度"""
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _prom_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels
+    )
+    return "{" + body + "}"
+
+
+def _process_stats() -> dict:
+    """进程级指标；resource 模块在 Windows 上不可用"""
+    stats = {"uptime_seconds": round(time.monotonic() - _started_at, 1)}
+    # Linux 上 ru_maxrss 会从父进程继承，优先读取 exec 后重新计数的 VmHWM
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    stats["peak_rss_bytes"] = int(line.split()[1]) * 1024
+                    return stats
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return stats
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    stats["peak_rss_bytes"] = peak if sys.platform == "darwin" else peak * 1024
+    return stats
+
+
+def _connect_tracer() -> Callable[[str, dict], Awaitable[None]]:
+    """httpx trace 回调：记录新建连接时 TCP 建连和 TLS 握手的耗时"""
+    started: dict[str, float] = {}
+    phases = {"connection.connect_tcp": "connect", "connection.start_tls": "tls"}
+
+    async def trace(event: str, info: dict) -> None:
+        base, _, stage = event.rpartition(".")
+        if base not in phases:
+            return
+        if stage == "started":
+            started[base] = time.perf_counter()
+        elif stage == "complete" and base in started:
+            metrics.observe(
+                "phase_seconds", time.perf_counter() - started.pop(base), phase=phases[base]
+            )
+
+    return trace
+
+
+_started_at = time.monotonic()
+metrics = MetricsRegistry(METRICS_WINDOW)
+
+
+# MCP 服务器实例，由 get_app() 在首次使用时创建
+_app: Optional[Server] = None
+
+
+def get_app() -> Server:
+    """创建 MCP 服务器并注册处理函数（首次调用时才导入 mcp.server）"""
+    global _app
+    if _app is None:
+        from mcp.server import Server
+
+        server = Server(SERVER_NAME, version=SERVER_VERSION)
+        server.list_resources()(list_resources)
+        server.read_resource()(read_resource)
+        server.list_tools()(list_tools)
+        server.call_tool()(call_tool)
+        _app = server
+    return _app
+
+
+def __getattr__(name: str) -> Any:
+    # 兼容直接访问 mcp_server.app 的旧代码
+    if name == "app":
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# 资源和工具列表是静态数据：stdio 前端在 mcp 导入完成前即可直接应答列表请求
+RESOURCES = [
+    {
+        "uri": "nano-banana://config",
+        "name": "NanoBanana Configuration",
+        "mimeType": "application/json",
+        "description": "OpenRouter API configuration for NanoBanana",
+    },
+    {
+        "uri": "nano-banana://stats",
+        "name": "NanoBanana Statistics",
+        "mimeType": "application/json",
+        "description": "Runtime statistics such as response cache hits and misses",
+    },
+    {
+        "uri": "nano-banana://budget",
+        "name": "NanoBanana Budget",
+        "mimeType": "application/json",
+        "description": "Token, image and cost totals per model, session and API key, with configured budgets and what remains",
+    },
+    {
+        "uri": "nano-banana://metrics",
+        "name": "NanoBanana Metrics",
+        "mimeType": "application/json",
+        "description": "Request counters, bytes, tokens and per-phase latency histograms (p50/p95/p99)",
+    },
+    {
+        "uri": "nano-banana://metrics/prometheus",
+        "name": "NanoBanana Metrics (Prometheus)",
+        "mimeType": "text/plain",
+        "description": "The same metrics in Prometheus text exposition format",
+    },
+]
+
+
+async def list_resources() -> list[Resource]:
+    """列出可用的资源"""
+    return [mcp_types.Resource(**resource) for resource in RESOURCES]
+
+
+async def read_resource(uri: str) -> str:
+    """读取资源内容"""
+    # 新版 MCP SDK 传入的是 AnyUrl 对象，统一转换为字符串比较
+    uri = str(uri)
+    if uri == "nano-banana://config":
+        config = {
+            "api_url": OPENROUTER_API_URL,
+            "model": DEFAULT_MODEL,
+            "description": "NanoBanana MCP Server - OpenRouter API Wrapper",
+        }
+        return json.dumps(config, indent=2)
+    elif uri == "nano-banana://stats":
+        stats = {
+            "cache": response_cache.stats(),
+            "models": model_catalog.stats(),
+            "coalescing": {"in_flight": len(_inflight), **_coalescing_stats},
+            "jobs": job_manager.stats(),
+            "upstreams": upstream_pool.stats(),
+            "hedging": hedge_policy.stats(),
+            "image_inputs": image_inputs.stats(),
+            "sessions": conversations.stats(),
+            "schedulers": {model: sched.stats() for model, sched in _schedulers.items()},
+            "circuits": {
+                key: {"state": breaker.state, "failures": breaker.failures}
+                for key, breaker in _breakers.items()
+            },
+        }
+        return json.dumps(stats, indent=2)
+    elif uri == "nano-banana://budget":
+        return json.dumps(budget_ledger.stats(), indent=2, ensure_ascii=False)
+    elif uri.startswith(ResultStore.URI_PREFIX):
+        return result_store.get(uri)
+    elif uri == "nano-banana://metrics":
+        return json.dumps(metrics.snapshot(), indent=2)
+    elif uri == "nano-banana://metrics/prometheus":
+        return metrics.prometheus()
+    else:
+        raise ValueError(f"Unknown resource: {uri}")
+
+
+# 图像后处理参数，chat_completion、batch_generate 和 submit_generation 共用
+POSTPROCESS_SCHEMA = {
+    "type": "object",
+    "description": "Resize and re-encode generated images in a worker process pool (requires Pillow). Results are added as 'variants' on each image.",
+    "properties": {
+        "format": {
+            "type": "string",
+            "enum": list(POSTPROCESS_FORMATS),
+            "description": "Target format (default: webp)",
+        },
+        "quality": {
+            "type": "integer",
+            "description": "Encoder quality for jpeg/webp/avif (default: 80)",
+            "minimum": 1,
+            "maximum": 100,
+        },
+        "sizes": {
+            "type": "array",
+            "items": {"type": "integer", "minimum": 1},
+            "description": "Longest-edge sizes in pixels to emit, e.g. [1024, 256]; images are never upscaled (default: original size only)",
+        },
+        "strip_metadata": {
+            "type": "boolean",
+            "description": "Drop EXIF and ICC metadata from the outputs (default: true)",
+        },
+        "keep_original": {
+            "type": "boolean",
+            "description": "Also return the original image (default: true for file output, false for inline output)",
+        },
+    },
+}
+
+# 消息内容：纯文本，或文本与图像混排的内容数组
+MESSAGE_CONTENT_SCHEMA = {
+    "description": "Message content: a string, or an array of parts for image input",
+    "anyOf": [
+        {"type": "string"},
+        {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "type": {
+                        "type": "string",
+                        "enum": ["text", "image_url", "image_file", "image_ref"],
+                        "description": "text: {text}; image_url: {image_url: {url}} sent as-is; image_file: {path} a local image file; image_ref: {ref, index} an image from an earlier generation_id or job_id",
+                    },
+                    "text": {"type": "string"},
+                    "image_url": {"type": "object"},
+                    "path": {"type": "string", "description": "Local image file (png, jpeg, webp, gif)"},
+                    "ref": {"type": "string", "description": "generation_id of an earlier file-output result, or a job_id; append #k to pick candidate k of an n > 1 result"},
+                    "index": {"type": "integer", "minimum": 0, "description": "Image index within the referenced result (default: 0)"},
+                    "max_size": {
+                        "type": "integer",
+                        "minimum": 1,
+                        "description": f"Downscale so the longest edge fits before upload (default: {INPUT_MAX_SIZE})",
+                    },
+                    "detail": {"type": "string", "enum": ["auto", "low", "high"]},
+                },
+                "required": ["type"],
+            },
+        },
+    ],
+}
+
+# 结果格式参数，返回生成结果的工具共用
+FORMAT_PROPERTY = {
+    "type": "string",
+    "enum": ["compact", "pretty"],
+    "description": f"JSON layout of the result (default: {RESULT_FORMAT})",
+}
+RESULT_PROPERTIES = {
+    "format": FORMAT_PROPERTY,
+    "fields": {
+        "type": "array",
+        "items": {"type": "string"},
+        "description": "Only return these result fields, dotted paths allowed such as 'usage.total_tokens' (default: all)",
+    },
+    "max_field_chars": {
+        "type": "integer",
+        "minimum": 0,
+        "description": f"Truncate longer strings and store the full result as a resource linked from 'full_result'; 0 disables (default: {RESULT_MAX_FIELD_CHARS})",
+    },
+}
+
+# 多候选参数，chat_completion 和 submit_generation 共用
+CANDIDATE_PROPERTIES = {
+    "n": {
+        "type": "integer",
+        "minimum": 1,
+        "maximum": MAX_CANDIDATES,
+        "description": "Number of independent candidates to generate concurrently. Each candidate is announced in a progress notification as soon as it finishes (with file paths when output is 'file'); results are under 'candidates' (default: 1)",
+    },
+    "seed": {
+        "type": "integer",
+        "description": "Sampling seed; with n > 1, candidate i uses seed + i",
+    },
+    "variations": {
+        "type": "array",
+        "description": "Per-candidate overrides, one object per candidate (sets n to at least its length)",
+        "items": {
+            "type": "object",
+            "properties": {
+                "temperature": {"type": "number", "minimum": 0, "maximum": 2},
+                "seed": {"type": "integer"},
+                "model": {"type": "string"},
+                "max_tokens": {"type": "integer"},
+                "prompt_suffix": {
+                    "type": "string",
+                    "description": "Text appended to the last user message for this candidate",
+                },
+            },
+        },
+    },
+}
+
+HEDGE_PROPERTY = {
+    "type": "boolean",
+    "description": f"If the request runs longer than the p{HEDGE_PERCENTILE * 100:g} latency seen for this model, send a duplicate to another upstream and keep whichever finishes first; capped at {HEDGE_BUDGET:.0%} extra requests, and the cancelled duplicate may still be billed. Ignored when streaming (default: {str(HEDGE_DEFAULT).lower()})",
+}
+
+# 服务端会话参数，chat_completion 和 submit_generation 共用
+SESSION_PROPERTIES = {
+    "session_id": {
+        "type": "string",
+        "description": "Keep the conversation history on the server under this id; send only the new turn in 'messages'. Earlier generated images are referenced instead of resent.",
+    },
+    "history_turns": {
+        "type": "integer",
+        "minimum": 0,
+        "description": f"With session_id, number of earlier turns to include (default and max: {SESSION_TURNS})",
+    },
+    "history_images": {
+        "type": "integer",
+        "minimum": 0,
+        "description": f"With session_id, number of most recent earlier images to include; older ones are omitted (default: {SESSION_IMAGES})",
+    },
+}
+
+TOOLS = [
+    {
+        "name": "chat_completion",
+        "description": "Send a chat completion request to OpenRouter API using Gemini 3 Pro Image Preview model. Supports text and image inputs.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "messages": {
+                    "type": "array",
+                    "description": "Array of message objects with role and content",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "role": {
+                                "type": "string",
+                                "enum": ["user", "assistant", "system"],
+                                "description": "Role of the message sender",
+                            },
+                            "content": MESSAGE_CONTENT_SCHEMA,
+                        },
+                        "required": ["role", "content"],
+                    },
+                },
+                "model": {
+                    "type": "string",
+                    "description": f"Model to use (default: {DEFAULT_MODEL})",
+                },
+                "temperature": {
+                    "type": "number",
+                    "description": "Sampling temperature (0-2, default: 1)",
+                    "minimum": 0,
+                    "maximum": 2,
+                },
+                "max_tokens": {
+                    "type": "integer",
+                    "description": "Maximum tokens to generate",
+                },
+                "stream": {
+                    "type": "boolean",
+                    "description": "Stream the response via SSE and report progress notifications while generating (default: false)",
+                },
+                "output": {
+                    "type": "string",
+                    "enum": ["inline", "file"],
+                    "description": f"How to return generated images: 'inline' data URLs or 'file' paths on disk (default: {IMAGE_OUTPUT_MODE})",
+                },
+                "output_dir": {
+                    "type": "string",
+                    "description": f"Directory for saved images when output is 'file' (default: {IMAGE_OUTPUT_DIR})",
+                },
+                "thumbnails": {
+                    "type": "boolean",
+                    "description": "Attach small JPEG thumbnails as image content when output is 'file' (requires Pillow, default: false)",
+                },
+                "postprocess": POSTPROCESS_SCHEMA,
+                "cache": {
+                    "type": "string",
+                    "enum": ["off", "read", "readwrite"],
+                    "description": f"Response cache mode for identical requests (default: {CACHE_MODE})",
+                },
+                "priority": {
+                    "type": "string",
+                    "enum": list(PRIORITY_LANES),
+                    "description": "Scheduling lane when client-side rate limits are configured (default: interactive)",
+                },
+                "coalesce": {
+                    "type": "boolean",
+                    "description": f"Share one upstream call with identical requests already in flight; disable to get an independent sample (default: {str(COALESCE_DEFAULT).lower()})",
+                },
+                "timeout": {
+                    "type": "number",
+                    "description": f"Seconds to wait for upstream data before giving up (default: {REQUEST_TIMEOUT:g})",
+                    "exclusiveMinimum": 0,
+                },
+                "hedge": HEDGE_PROPERTY,
+                **CANDIDATE_PROPERTIES,
+                **SESSION_PROPERTIES,
+                **RESULT_PROPERTIES,
+            },
+            "required": ["messages"],
+        },
+    },
+    {
+        "name": "batch_generate",
+        "description": "Run several chat completion / image generation requests concurrently. Results are returned in input order; failed items are reported individually.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "items": {
+                    "type": "array",
+                    "description": "Prompts (strings) or request objects with 'messages' and optional per-item overrides (model, temperature, max_tokens)",
+                    "items": {
+                        "anyOf": [
+                            {"type": "string"},
+                            {
+                                "type": "object",
+                                "properties": {
+                                    "messages": {"type": "array"},
+                                },
+                                "required": ["messages"],
+                            },
+                        ],
+                    },
+                },
+                "model": {
+                    "type": "string",
+                    "description": f"Model to use for all items (default: {DEFAULT_MODEL})",
+                },
+                "temperature": {
+                    "type": "number",
+                    "description": "Sampling temperature (0-2, default: 1)",
+                    "minimum": 0,
+                    "maximum": 2,
+                },
+                "max_tokens": {
+                    "type": "integer",
+                    "description": "Maximum tokens to generate per item",
+                },
+                "output": {
+                    "type": "string",
+                    "enum": ["inline", "file"],
+                    "description": f"How to return generated images (default: {IMAGE_OUTPUT_MODE}; 'file' is recommended for batches)",
+                },
+                "output_dir": {
+                    "type": "string",
+                    "description": f"Directory for saved images when output is 'file' (default: {IMAGE_OUTPUT_DIR})",
+                },
+                "postprocess": POSTPROCESS_SCHEMA,
+                "cache": {
+                    "type": "string",
+                    "enum": ["off", "read", "readwrite"],
+                    "description": f"Response cache mode (default: {CACHE_MODE})",
+                },
+                "priority": {
+                    "type": "string",
+                    "enum": list(PRIORITY_LANES),
+                    "description": "Scheduling lane when client-side rate limits are configured (default: batch)",
+                },
+                "concurrency": {
+                    "type": "integer",
+                    "description": f"Maximum number of requests in flight (default: {BATCH_CONCURRENCY})",
+                    "minimum": 1,
+                },
+                "item_timeout": {
+                    "type": "number",
+                    "description": f"Timeout in seconds for each item (default: {BATCH_ITEM_TIMEOUT:g})",
+                },
+                **RESULT_PROPERTIES,
+            },
+            "required": ["items"],
+        },
+    },
+    {
+        "name": "submit_generation",
+        "description": "Start an image generation in the background and return a job id immediately. Poll or wait with get_job; images are saved to disk and returned as file paths.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "prompt": {
+                    "type": "string",
+                    "description": "Prompt text, shorthand for a single user message",
+                },
+                "messages": {
+                    "type": "array",
+                    "description": "Array of message objects with role and content (alternative to prompt)",
+                },
+                "model": {
+                    "type": "string",
+                    "description": f"Model to use (default: {DEFAULT_MODEL})",
+                },
+                "temperature": {
+                    "type": "number",
+                    "description": "Sampling temperature (0-2, default: 1)",
+                    "minimum": 0,
+                    "maximum": 2,
+                },
+                "max_tokens": {
+                    "type": "integer",
+                    "description": "Maximum tokens to generate",
+                },
+                "stream": {
+                    "type": "boolean",
+                    "description": "Stream from upstream so the job reports progress while generating (default: false)",
+                },
+                "output_dir": {
+                    "type": "string",
+                    "description": f"Directory for saved images (default: {IMAGE_OUTPUT_DIR})",
+                },
+                "postprocess": POSTPROCESS_SCHEMA,
+                "cache": {
+                    "type": "string",
+                    "enum": ["off", "read", "readwrite"],
+                    "description": f"Response cache mode (default: {CACHE_MODE})",
+                },
+                "priority": {
+                    "type": "string",
+                    "enum": list(PRIORITY_LANES),
+                    "description": "Scheduling lane when client-side rate limits are configured (default: batch)",
+                },
+                "timeout": {
+                    "type": "number",
+                    "description": f"Seconds to wait for upstream data before giving up (default: {REQUEST_TIMEOUT:g})",
+                    "exclusiveMinimum": 0,
+                },
+                "hedge": HEDGE_PROPERTY,
+                **CANDIDATE_PROPERTIES,
+                **SESSION_PROPERTIES,
+                "format": FORMAT_PROPERTY,
+            },
+        },
+    },
+    {
+        "name": "get_job",
+        "description": "Get the status, progress and result of a background job. With 'wait', block until the job finishes (progress is forwarded as notifications). Without job_id, list all jobs.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "job_id": {
+                    "type": "string",
+                    "description": "Job id returned by submit_generation",
+                },
+                "wait": {
+                    "type": "number",
+                    "description": f"Seconds to wait for the job to finish before returning (max {JOB_MAX_WAIT:g}, default: 0)",
+                    "minimum": 0,
+                },
+                **RESULT_PROPERTIES,
+            },
+        },
+    },
+    {
+        "name": "cancel_job",
+        "description": "Cancel a queued or running background job.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "job_id": {
+                    "type": "string",
+                    "description": "Job id returned by submit_generation",
+                },
+            },
+            "required": ["job_id"],
+        },
+    },
+    {
+        "name": "clear_session",
+        "description": "Forget the server-side history of a conversation session.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "session_id": {
+                    "type": "string",
+                    "description": "Session id used with chat_completion or submit_generation",
+                },
+            },
+            "required": ["session_id"],
+        },
+    },
+    {
+        "name": "list_models",
+        "description": "List available models from OpenRouter API. The catalogue is cached in-process; use filters, field projection and pagination to keep results small.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "modality": {
+                    "type": "string",
+                    "description": "Only models that can output this modality, e.g. 'image' or 'text'",
+                },
+                "input_modality": {
+                    "type": "string",
+                    "description": "Only models that accept this input modality, e.g. 'image'",
+                },
+                "provider": {
+                    "type": "string",
+                    "description": "Only models from this provider (id prefix), e.g. 'google'",
+                },
+                "search": {
+                    "type": "string",
+                    "description": "Case-insensitive substring match on model id or name",
+                },
+                "fields": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": f"Fields to return per model, dotted paths allowed such as 'pricing.prompt'; empty list returns full records (default: {DEFAULT_MODEL_FIELDS})",
+                },
+                "limit": {
+                    "type": "integer",
+                    "description": "Maximum number of models to return (default: 50)",
+                    "minimum": 0,
+                },
+                "offset": {
+                    "type": "integer",
+                    "description": "Number of matching models to skip (default: 0)",
+                    "minimum": 0,
+                },
+                "refresh": {
+                    "type": "boolean",
+                    "description": "Revalidate the cached catalogue with OpenRouter before answering (default: false)",
+                },
+                "format": FORMAT_PROPERTY,
+            },
+        },
+    },
+]
+
+
+async def list_tools() -> list[Tool]:
+    """列出可用的工具"""
+    return [mcp_types.Tool(**tool) for tool in TOOLS]
+
+
+async def call_tool(name: str, arguments: Any) -> list[TextContent | ImageContent]:
+    """调用工具"""
+    started = time.perf_counter()
+    metrics.inc("tool_calls_total", tool=name)
+    if name == "chat_completion":
+        contents = await chat_completion(arguments)
+    elif name == "batch_generate":
+        contents = await batch_generate(arguments)
+    elif name == "submit_generation":
+        contents = await submit_generation(arguments)
+    elif name == "get_job":
+        contents = await get_job(arguments)
+    elif name == "cancel_job":
+        contents = await cancel_job(arguments)
+    elif name == "clear_session":
+        contents = await clear_session(arguments)
+    elif name == "list_models":
+        contents = await list_models(arguments)
+    else:
+        raise ValueError(f"Unknown tool: {name}")
+
+    metrics.observe("tool_seconds", time.perf_counter() - started, tool=name)
+    metrics.inc(
+        "tool_result_bytes_total",
+        sum(len(c.text) if isinstance(c, mcp_types.TextContent) else len(c.data) for c in contents),
+        tool=name,
+    )
+    return contents
+
+
+class ResultStore:
+    """被截断的工具结果的完整副本，按最近最少使用淘汰，通过 nano-banana://results/<id> 读取"""
+
+    URI_PREFIX = "nano-banana://results/"
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.results: collections.OrderedDict[str, str] = collections.OrderedDict()
+        self._bytes = 0
+
+    def put(self, text: str) -> str:
+        result_id = uuid.uuid4().hex[:16]
+        self.results[result_id] = text
+        self._bytes += len(text)
+        while self._bytes > self.max_bytes and len(self.results) > 1:
+            _, evicted = self.results.popitem(last=False)
+            self._bytes -= len(evicted)
+        return self.URI_PREFIX + result_id
+
+    def get(self, uri: str) -> str:
+        text = self.results.get(uri[len(self.URI_PREFIX):])
+        if text is None:
+            raise ValueError(f"Result expired or unknown: {uri}")
+        return text
+
+
+result_store = ResultStore(RESULT_STORE_MAX_BYTES)
+
+
+def dump_json(data: Any, fmt: Optional[str] = None) -> str:
+    """按 compact / pretty 格式序列化工具结果"""
+    if (fmt or RESULT_FORMAT) == "pretty":
+        return json.dumps(data, indent=2, ensure_ascii=False)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+def _extract_images(data: Any, images: list) -> Any:
+    """把结果中的 data URL 图像取出为 ImageContent，原位置改为 content_index（在返回内容中的下标）"""
+    if isinstance(data, list):
+        return [_extract_images(item, images) for item in data]
+    if not isinstance(data, dict):
+        return data
+    url = data.get("url")
+    if isinstance(url, str) and url.startswith("data:image/") and ";base64," in url:
+        header, encoded = url.split(",", 1)
+        images.append(mcp_types.ImageContent(type="image", data=encoded, mimeType=header[5:].split(";")[0]))
+        data = {k: v for k, v in data.items() if k != "url"}
+        data["content_index"] = len(images)
+    return {key: _extract_images(value, images) for key, value in data.items()}
+
+
+def _truncate(data: Any, limit: int) -> tuple[Any, int]:
+    """截断超过 limit 的字符串，返回 (新结果, 截断的字段数)"""
+    if isinstance(data, str) and len(data) > limit:
+        return f"{data[:limit]}... [truncated {len(data) - limit} chars]", 1
+    if isinstance(data, list):
+        items = [_truncate(item, limit) for item in data]
+        return [item for item, _ in items], sum(n for _, n in items)
+    if isinstance(data, dict):
+        items = {key: _truncate(value, limit) for key, value in data.items()}
+        return {key: item for key, (item, _) in items.items()}, sum(n for _, n in items.values())
+    return data, 0
+
+
+def render_result(data: Any, arguments: dict) -> list[TextContent | ImageContent]:
+    """序列化工具结果：按 fields 投影，data URL 图像改为原生 ImageContent，截断超长字段
+
+    先投影再取图像，未选中的字段中的图像不会出现在返回内容中。
+    被截断时完整结果另存到 result_store，结果中的 full_result 给出读取它的资源 URI。
+    """
+    images: list[ImageContent] = []
+    with metrics.timer("serialize"):
+        fields = arguments.get("fields")
+        if fields and isinstance(data, dict) and "error" not in data:
+            data = _project(data, fields)
+        data = _extract_images(data, images)
+        limit = arguments.get("max_field_chars", RESULT_MAX_FIELD_CHARS)
+        if limit:
+            truncated, count = _truncate(data, limit)
+            if count and isinstance(truncated, dict):
+                truncated["full_result"] = result_store.put(dump_json(data))
+                data = truncated
+        text = dump_json(data, arguments.get("format"))
+    return [mcp_types.TextContent(type="text", text=text), *images]
+
+
+async def chat_completion(arguments: dict) -> list[TextContent | ImageContent]:
+    """调用 OpenRouter Chat Completion API"""
+    try:
+        response_data, extra_contents = await _run_completion(arguments)
+        return [*render_result(response_data, arguments), *extra_contents]
+    except Exception as e:
+        return render_result(_error_data(e), arguments)
+
+
+def _error_data(e: Exception) -> dict:
+    """把异常转换为工具结果中的错误 JSON"""
+    metrics.inc(
+        "errors_total",
+        status=e.response.status_code if isinstance(e, httpx.HTTPStatusError) else type(e).__name__,
+    )
+    if isinstance(e, httpx.HTTPStatusError):
+        data = {
+            "error": f"HTTP error: {e.response.status_code}",
+            "details": e.response.text,
+        }
+    else:
+        data = {"error": str(e)}
+    if hasattr(e, "retry_info"):
+        data["upstream"] = e.retry_info
+    return data
+
+
+async def _run_completion(arguments: dict) -> tuple[dict, list[ImageContent]]:
+    """执行一次补全请求，返回响应数据和附加的图像内容（失败时抛出异常）
+
+    带 session_id 时，messages 只需包含本轮的新消息，历史由服务端拼接。
+    n 大于 1 或给出多个 variations 时并发生成多个候选；只有一个 variation 时直接应用到本次请求。
+    """
+    session_id = arguments.get("session_id")
+    n = int(arguments.get("n", 1))
+    if n < 1:
+        raise ValueError("n must be at least 1")
+    variations = arguments.get("variations") or []
+    if n > 1 or len(variations) > 1:
+        if session_id:
+            raise ValueError("n > 1 cannot be combined with session_id; pick a candidate and send it as the next turn")
+        return await _complete_candidates(arguments)
+    if variations:
+        arguments = _candidate_arguments(arguments, 0, independent=False)
+    if not session_id:
+        return await _complete(arguments)
+
+    conversation = conversations.get(session_id)
+    async with conversation.lock:
+        messages = arguments.get("messages", [])
+        full_messages, session_info = conversations.build(
+            conversation, messages, arguments.get("history_turns"), arguments.get("history_images")
+        )
+        response_data, extra_contents = await _complete({**arguments, "messages": full_messages})
+        if "error" not in response_data:
+            conversations.record(conversation, messages, response_data)
+            session_info["turns"] = len(conversation.turns)
+        response_data["session"] = session_info
+    return response_data, extra_contents
+
+
+def _candidate_arguments(arguments: dict, index: int, independent: bool = True) -> dict:
+    """第 index 个候选的请求参数：seed 依次递增，并应用 variations 中对应的覆盖项
+
+    independent 为 False 时只有这一个请求，可以照常合并和使用缓存。
+    """
+    args = {key: value for key, value in arguments.items() if key not in ("n", "variations")}
+    variations = arguments.get("variations") or []
+    variation = variations[index] if index < len(variations) else {}
+    if arguments.get("seed") is not None:
+        args["seed"] = arguments["seed"] + index
+    for key in ("model", "temperature", "seed", "max_tokens"):
+        if key in variation:
+            args[key] = variation[key]
+    suffix = variation.get("prompt_suffix")
+    if suffix:
+        messages = copy.deepcopy(args.get("messages", []))
+        last_user = next((m for m in reversed(messages) if m.get("role") == "user"), None)
+        if last_user is None:
+            messages.append({"role": "user", "content": suffix})
+        elif isinstance(last_user.get("content"), list):
+            last_user["content"].append({"type": "text", "text": suffix})
+        else:
+            last_user["content"] = f"{last_user.get('content', '')} {suffix}".strip()
+        args["messages"] = messages
+    if not independent:
+        return args
+    # 候选之间必须是独立采样：不合并在途请求；没有 seed 时请求体相同，也不能读缓存
+    args["coalesce"] = False
+    if args.get("seed") is None:
+        args["cache"] = "off"
+    return args
+
+
+async def _complete_candidates(arguments: dict) -> tuple[dict, list[ImageContent]]:
+    """并发生成多个候选，每个候选一完成就通过进度通知告知（file 模式下附带已保存的路径）"""
+    n = max(int(arguments.get("n", 1)), len(arguments.get("variations") or []))
+    if n > MAX_CANDIDATES:
+        raise ValueError(f"n must be at most {MAX_CANDIDATES}")
+    outer = _progress_notifier()
+    lock = asyncio.Lock()
+    progress = 0
+    started = time.monotonic()
+
+    async def forward(message: str) -> None:
+        # 各候选的进度合并为一个单调递增的序列
+        nonlocal progress
+        if outer is None:
+            return
+        async with lock:
+            progress += 1
+            await outer(progress, message)
+
+    async def run(index: int) -> tuple[dict, list[ImageContent]]:
+        args = _candidate_arguments(arguments, index)
+        _progress_hook.set(lambda _, message=None: forward(f"candidate {index}: {message}"))
+        try:
+            data, extra = await _complete(args)
+        except Exception as e:
+            data, extra = _error_data(e), []
+        elapsed = time.monotonic() - started
+        entry = {
+            "index": index,
+            **{key: args[key] for key in ("seed", "temperature", "model") if key in args},
+            "elapsed_seconds": round(elapsed, 3),
+            **data,
+        }
+        if "error" in data:
+            await forward(f"candidate {index} failed: {data['error']}")
+        else:
+            paths = [img["path"] for img in data.get("images", []) if img.get("path")]
+            saved = f": {', '.join(paths)}" if paths else ""
+            await forward(f"candidate {index} ready after {elapsed:.1f}s{saved}")
+        return entry, extra
+
+    tasks = [asyncio.ensure_future(run(i)) for i in range(n)]
+    try:
+        finished = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    candidates = [entry for entry, _ in finished]
+    succeeded = [c for c in candidates if "error" not in c]
+    # 各候选已按自己的 generation_id 登记；再以整体的 generation_id 登记，
+    # 可用 generation_id#k 引用第 k 个候选，或直接引用（图像按候选顺序编号）
+    generation_id = f"gen-{uuid.uuid4().hex[:12]}"
+    registered = []
+    for c in succeeded:
+        paths = image_inputs.generations.get(c.get("generation_id"))
+        if paths:
+            image_inputs.register(f"{generation_id}#{c['index']}", paths)
+            registered.extend(paths)
+    if registered:
+        image_inputs.register(generation_id, registered)
+    return {
+        "generation_id": generation_id,
+        "n": n,
+        "succeeded": len(succeeded),
+        "failed": n - len(succeeded),
+        "first_candidate_seconds": min((c["elapsed_seconds"] for c in succeeded), default=None),
+        "elapsed_seconds": round(time.monotonic() - started, 3),
+        "candidates": candidates,
+    }, [content for _, extra in finished for content in extra]
+
+
+async def _complete(arguments: dict) -> tuple[dict, list[ImageContent]]:
+    """按完整的 messages 请求一次补全"""
+    messages = arguments.get("messages", [])
+    model = arguments.get("model", DEFAULT_MODEL)
+    temperature = arguments.get("temperature", 1.0)
+    max_tokens = arguments.get("max_tokens")
+    stream = arguments.get("stream", False)
+    output = arguments.get("output", IMAGE_OUTPUT_MODE)
+    output_dir = arguments.get("output_dir", IMAGE_OUTPUT_DIR)
+    if output == "file":
+        output_dir = _client_path(output_dir, "output_dir")
+    thumbnails = arguments.get("thumbnails", False)
+    postprocess = arguments.get("postprocess")
+    cache_mode = arguments.get("cache", CACHE_MODE)
+    priority = arguments.get("priority", "interactive")
+    coalesce = arguments.get("coalesce", COALESCE_DEFAULT)
+    timeout = arguments.get("timeout")
+    # 流式请求会转发进度通知，不做对冲
+    hedge = arguments.get("hedge", HEDGE_DEFAULT) and not stream
+
+    # 本地文件和历史结果的图像引用替换为按内容哈希的占位 URL，上游请求前才编码
+    messages = await image_inputs.resolve_messages(messages)
+
+    # 构建请求体
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "modalities": ["image", "text"],  # 支持图像生成
+    }
+
+    if max_tokens:
+        payload["max_tokens"] = max_tokens
+
+    if arguments.get("seed") is not None:
+        payload["seed"] = arguments["seed"]
+
+    if stream:
+        payload["stream"] = True
+
+    # 后处理参数在请求上游之前检查，避免生成完成后才报错
+    if postprocess:
+        check_postprocess(postprocess)
+
+    # 预算准入：用尽时直接拒绝，接近上限时换用更便宜的模型或压低 max_tokens
+    client_session = _current_session()
+    _budget_session.set(
+        arguments.get("session_id") or (f"client-{client_session}" if client_session is not None else "default")
+    )
+    downgrade = budget_ledger.admit(payload, _budget_session.get())
+    reservation = budget_ledger.reserve(payload, _budget_session.get())
+    model = payload["model"]
+
+    # file 模式下图像在接收响应时直接解码写入 output_dir
+    spool_dir = output_dir if output == "file" else None
+    try:
+        result, meta = await _fetch_completion(
+            payload, cache_mode, priority, coalesce, spool_dir, timeout, hedge
+        )
+    finally:
+        budget_ledger.refund(reservation)
+
+    # 提取响应内容
+    if not result.get("choices"):
+        # 原始响应可能很大，只给出上游错误信息，完整内容另存为资源
+        return {
+            "error": "No response from API",
+            "details": result.get("error"),
+            "raw_response": result_store.put(dump_json(result)),
+        }, []
+
+    message = result["choices"][0]["message"]
+    content = message.get("content", "")
+    images = message.get("images", [])
+    usage = result.get("usage", {})
+
+    response_data = {
+        "content": content,
+        "model": result.get("model", model),
+        "usage": usage,
+        "generation_id": result.get("id") or f"gen-{uuid.uuid4().hex[:12]}",
+    }
+    response_data.update(meta)
+    if downgrade:
+        response_data["budget"] = {"downgraded": downgrade}
+
+    # 如果有图像，添加到响应中
+    extra_contents: list[ImageContent] = []
+    if images:
+        if output == "file":
+            with metrics.timer("images"):
+                response_data["images"] = _save_images(
+                    images, output_dir, shared=bool(meta.get("coalesced") or meta.get("cached"))
+                )
+            if thumbnails:
+                with metrics.timer("thumbnails"):
+                    extra_contents = await _make_thumbnails(response_data["images"])
+        else:
+            with metrics.timer("images"):
+                response_data["images"] = _inline_images(images)
+        if postprocess:
+            with metrics.timer("postprocess"):
+                response_data["images"] = await _postprocess_images(
+                    response_data["images"], postprocess, output
+                )
+        # 保存到本地的图像可在后续请求中以 image_ref 引用
+        paths = [_image_file(img) for img in response_data["images"]]
+        if output == "file" and all(paths):
+            image_inputs.register(response_data["generation_id"], paths)
+
+    return response_data, extra_contents
+
+
+async def batch_generate(arguments: dict) -> list[TextContent]:
+    """并发执行多个生成请求，按输入顺序返回结果"""
+    items = arguments.get("items", [])
+    concurrency = max(1, int(arguments.get("concurrency", BATCH_CONCURRENCY)))
+    item_timeout = float(arguments.get("item_timeout", BATCH_ITEM_TIMEOUT))
+    shared = {
+        key: arguments[key]
+        for key in ("model", "temperature", "max_tokens", "output", "output_dir", "postprocess", "cache", "timeout", "hedge")
+        if key in arguments
+    }
+    # 批量任务默认走低优先级通道，不阻塞交互请求
+    shared["priority"] = arguments.get("priority", "batch")
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_item(index: int, item: Any) -> dict:
+        if isinstance(item, str):
+            item_args = {**shared, "messages": [{"role": "user", "content": item}]}
+        else:
+            item_args = {**shared, **item}
+
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                response_data, _ = await asyncio.wait_for(
+                    _run_completion(item_args), timeout=item_timeout
+                )
+            except asyncio.TimeoutError:
+                return {
+                    "index": index,
+                    "status": "error",
+                    "error": f"Timed out after {item_timeout:g}s",
+                }
+            except Exception as e:
+                return {"index": index, "status": "error", **_error_data(e)}
+
+        if "error" in response_data:
+            return {"index": index, "status": "error", **response_data}
+        if arguments.get("fields"):
+            response_data = _project(response_data, arguments["fields"])
+        return {
+            "index": index,
+            "status": "ok",
+            "elapsed_seconds": round(time.monotonic() - started, 3),
+            **response_data,
+        }
+
+    started = time.monotonic()
+    results = await asyncio.gather(
+        *(run_item(i, item) for i, item in enumerate(items))
+    )
+    succeeded = sum(1 for r in results if r["status"] == "ok")
+
+    # 投影已按项完成，这里只做图像转换和截断
+    return render_result(
+        {
+            "total": len(results),
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "elapsed_seconds": round(time.monotonic() - started, 3),
+            "results": results,
+        },
+        {**arguments, "fields": None},
+    )
+
+
+class Job:
+    """一个后台生成任务，状态变化时唤醒等待者"""
+
+    FINAL_STATES = ("succeeded", "failed", "cancelled")
+
+    def __init__(self, arguments: dict, session: Any, job_id: Optional[str] = None):
+        self.id = job_id or uuid.uuid4().hex[:16]
+        self.arguments = arguments
+        self.session = session
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.attempts = 0
+        self.owner = os.getpid()
+        self.owner_start = _own_process_start()
+        self.progress: Optional[float] = None
+        self.message: Optional[str] = None
+        self.result: Optional[dict] = None
+        self.error: Optional[dict] = None
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    @classmethod
+    def from_record(cls, record: dict) -> "Job":
+        """从 JobStore 的记录恢复任务"""
+        job = cls(record["arguments"], None, record["id"])
+        for name in ("status", "created_at", "started_at", "finished_at", "attempts", "owner", "owner_start", "result", "error"):
+            setattr(job, name, record[name])
+        return job
+
+    def to_record(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "arguments": self.arguments,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "attempts": self.attempts,
+            "owner": self.owner,
+            "owner_start": self.owner_start,
+            "result": self.result,
+            "error": self.error,
+        }
+
+    @property
+    def done(self) -> bool:
+        return self.status in self.FINAL_STATES
+
+    def update(self, status: Optional[str] = None, **fields: Any) -> None:
+        """更新状态和字段，并通知所有等待者"""
+        if status is not None:
+            self.status = status
+            if status == "running":
+                self.started_at = time.time()
+            elif status in self.FINAL_STATES:
+                self.finished_at = time.time()
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_changed(self, timeout: float) -> bool:
+        """等待下一次状态变化，超时返回 False"""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def to_dict(self) -> dict:
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "model": self.arguments.get("model", DEFAULT_MODEL),
+            "created_at": datetime.fromtimestamp(self.created_at).isoformat(timespec="seconds"),
+        }
+        if self.started_at is not None:
+            data["queued_seconds"] = round(self.started_at - self.created_at, 3)
+        if self.finished_at is not None:
+            data["elapsed_seconds"] = round(self.finished_at - (self.started_at or self.created_at), 3)
+        if self.attempts > 1:
+            data["attempts"] = self.attempts
+        if self.progress is not None:
+            data["progress"] = self.progress
+        if self.message:
+            data["message"] = self.message
+        if self.result is not None:
+            data["result"] = self.result
+        if self.error is not None:
+            data.update(self.error)
+        return data
+
+
+class JobStore:
+    """SQLite 任务表：记录提交的任务、请求参数和结果，服务器重启后据此恢复
+
+    每次状态变化写一行，数据量很小；WAL + synchronous=NORMAL 下单次写入远小于 1 毫秒，
+    因此直接在事件循环中同步执行。
+    """
+
+    _COLUMNS = (
+        "id", "status", "arguments", "created_at", "started_at", "finished_at",
+        "attempts", "owner", "owner_start", "result", "error",
+    )
+    _JSON_COLUMNS = ("arguments", "result", "error")
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    arguments TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    owner INTEGER,
+                    owner_start TEXT,
+                    result TEXT,
+                    error TEXT
+                )"""
+            )
+            # 旧版本创建的表没有 owner_start 列
+            if "owner_start" not in {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner_start TEXT")
+            self._conn = conn
+        return self._conn
+
+    def save(self, record: dict) -> None:
+        values = [
+            json.dumps(record[c], ensure_ascii=False) if c in self._JSON_COLUMNS and record[c] is not None else record[c]
+            for c in self._COLUMNS
+        ]
+        self._connect().execute(
+            f"INSERT OR REPLACE INTO jobs ({', '.join(self._COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(self._COLUMNS))})",
+            values,
+        )
+
+    def claim(self, record: dict, owner: int, owner_start: Optional[str]) -> bool:
+        """把任务的所有权从 record 中记录的进程转给 owner（比较并交换）
+
+        多个服务器进程同时重启时只有一个能接管同一任务，返回是否成功。
+        """
+        cursor = self._connect().execute(
+            "UPDATE jobs SET owner = ?, owner_start = ? WHERE id = ? AND owner IS ? AND owner_start IS ?",
+            (owner, owner_start, record["id"], record["owner"], record["owner_start"]),
+        )
+        return cursor.rowcount == 1
+
+    def load(self, job_id: str) -> Optional[dict]:
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._decode(row) if row else None
+
+    def load_all(self) -> list[dict]:
+        rows = self._connect().execute("SELECT * FROM jobs ORDER BY created_at").fetchall()
+        return [self._decode(row) for row in rows]
+
+    def delete_finished(self, before: float) -> None:
+        self._connect().execute(
+            "DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (before,)
+        )
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _decode(self, row: sqlite3.Row) -> dict:
+        record = dict(row)
+        for c in self._JSON_COLUMNS:
+            if record[c] is not None:
+                record[c] = json.loads(record[c])
+        return record
+
+
+def _process_alive(pid: Optional[int], start: Optional[str] = None) -> bool:
+    """判断另一个服务器进程是否仍在运行
+
+    start 为记录所有者时的进程启动标识；重启后进程号可能被其它进程复用，
+    标识不一致时视为原进程已退出。
+    """
+    if not pid or pid == os.getpid():
+        return False
+    if os.name == "nt":
+        # Windows 上 os.kill 会终止进程，改为查询进程的退出码
+        alive = _windows_process_alive(pid)
+    else:
+        try:
+            os.kill(pid, 0)
+            alive = True
+        except ProcessLookupError:
+            alive = False
+        except OSError:
+            # 没有权限发信号，说明进程存在
+            alive = True
+    if not alive or start is None:
+        return alive
+    current = _process_start(pid)
+    return current is None or current == start
+
+
+def _process_start(pid: int) -> Optional[str]:
+    """进程的启动标识：Linux 上为开机 ID 加启动时刻，Windows 上为创建时间；无法获取时返回 None"""
+    try:
+        if sys.platform.startswith("linux"):
+            with open("/proc/sys/kernel/random/boot_id", encoding="ascii") as f:
+                boot_id = f.read().strip()
+            with open(f"/proc/{pid}/stat", encoding="utf-8", errors="replace") as f:
+                # 进程名可能包含空格和括号，从最后一个右括号之后取字段；starttime 为第 22 个字段
+                fields = f.read().rpartition(")")[2].split()
+            return f"{boot_id}:{fields[19]}"
+        if os.name == "nt":
+            return _windows_process_start(pid)
+    except (OSError, IndexError):
+        return None
+    return None
+
+
+def _own_process_start() -> Optional[str]:
+    global _OWN_PROCESS_START
+    if _OWN_PROCESS_START is _UNSET:
+        _OWN_PROCESS_START = _process_start(os.getpid())
+    return _OWN_PROCESS_START
+
+
+_UNSET = object()
+_OWN_PROCESS_START: Any = _UNSET
+
+
+def _windows_process_alive(pid: int) -> bool:
+    """通过 OpenProcess/GetExitCodeProcess 判断 Windows 进程是否仍在运行"""
+    import ctypes
+    from ctypes import wintypes
+
+    process_query_limited_information = 0x1000
+    error_access_denied = 5
+    still_active = 259
+
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.GetExitCodeProcess.argtypes = (wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD))
+    kernel32.GetExitCodeProcess.restype = wintypes.BOOL
+    kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+    kernel32.CloseHandle.restype = wintypes.BOOL
+
+    handle = kernel32.OpenProcess(process_query_limited_information, False, pid)
+    if not handle:
+        # 没有权限打开，说明进程存在；其它错误（如参数无效）说明进程已不存在
+        return ctypes.get_last_error() == error_access_denied
+    try:
+        code = wintypes.DWORD()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+            return True
+        return code.value == still_active
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+def _windows_process_start(pid: int) -> Optional[str]:
+    """通过 GetProcessTimes 获取 Windows 进程的创建时间"""
+    import ctypes
+    from ctypes import wintypes
+
+    process_query_limited_information = 0x1000
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.GetProcessTimes.argtypes = (wintypes.HANDLE,) + (ctypes.POINTER(wintypes.FILETIME),) * 4
+    kernel32.GetProcessTimes.restype = wintypes.BOOL
+    kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+    kernel32.CloseHandle.restype = wintypes.BOOL
+
+    handle = kernel32.OpenProcess(process_query_limited_information, False, pid)
+    if not handle:
+        return None
+    try:
+        times = [wintypes.FILETIME() for _ in range(4)]
+        if not kernel32.GetProcessTimes(handle, *(ctypes.byref(t) for t in times)):
+            return None
+        return str((times[0].dwHighDateTime << 32) | times[0].dwLowDateTime)
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+_current_job: contextvars.ContextVar[Optional[Job]] = contextvars.ContextVar(
+    "nano_banana_job", default=None
+)
+
+
+class JobManager:
+    """任务表和固定大小的 worker 池
+
+    任务按提交顺序排队，worker 逐个执行；每个任务在独立的子任务中运行，
+    取消任务不会影响 worker 本身。已结束的任务保留 ttl 秒供查询。
+    配置了 store 时每次状态变化都会持久化，重启后由 restore() 恢复。
+    """
+
+    def __init__(self, workers: int, ttl: float, store: Optional[JobStore] = None, max_attempts: int = 2):
+        self.workers = max(1, workers)
+        self.ttl = ttl
+        self.store = store
+        self.max_attempts = max(1, max_attempts)
+        self.jobs: dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: list[asyncio.Task] = []
+
+    def restore(self) -> dict:
+        """启动时恢复任务：已结束的任务可直接查询，未完成的任务重新排队
+
+        运行中被打断的任务上游可能已经计费，超过 max_attempts 次后不再重跑，标记为失败。
+        属于其它仍在运行的服务器进程的任务保持不动，只供查询；多个进程同时重启时
+        通过 JobStore.claim 保证每个任务只被一个进程接管。
+        """
+        if self.store is None:
+            return {}
+        try:
+            records = self.store.load_all()
+        except sqlite3.Error as e:
+            self._disable_store(e)
+            return {}
+
+        counts: collections.Counter = collections.Counter()
+        self._ensure_workers()
+        for record in records:
+            job = Job.from_record(record)
+            if not job.done and not self._claim(job, record):
+                # 其它服务器进程仍在运行或已抢先接管：由该进程执行，这里只供查询
+                job = self._reload(job)
+            elif not job.done:
+                if job.status == "running" and job.attempts >= self.max_attempts:
+                    job.update(
+                        "failed",
+                        error={"error": f"Interrupted {job.attempts} times by server restarts; not retried"},
+                    )
+                else:
+                    job.update("queued", message="resumed after restart")
+                    self._queue.put_nowait(job)
+                    counts["resumed"] += 1
+                self._save(job)
+            counts[job.status] += 1
+            self.jobs[job.id] = job
+        self._prune()
+        if counts["resumed"]:
+            metrics.inc("jobs_total", counts["resumed"], status="resumed")
+        return dict(counts)
+
+    def _claim(self, job: Job, record: dict) -> bool:
+        if _process_alive(job.owner, job.owner_start):
+            return False
+        job.owner, job.owner_start = os.getpid(), _own_process_start()
+        try:
+            return self.store.claim(record, job.owner, job.owner_start)
+        except sqlite3.Error as e:
+            self._disable_store(e)
+            return True
+
+    def _reload(self, job: Job) -> Job:
+        """从数据库读取其它进程负责的任务的最新状态"""
+        if self.store is None:
+            return job
+        try:
+            record = self.store.load(job.id)
+        except sqlite3.Error:
+            return job
+        return Job.from_record(record) if record is not None else job
+
+    def owns(self, job: Job) -> bool:
+        return job.owner == os.getpid()
+
+    def submit(self, arguments: dict) -> Job:
+        self._prune()
+        self._ensure_workers()
+        job = Job(arguments, _current_session())
+        self.jobs[job.id] = job
+        self._save(job)
+        self._queue.put_nowait(job)
+        metrics.inc("jobs_total", status="queued")
+        return job
+
+    def get(self, job_id: str) -> Job:
+        self._prune()
+        job = self.jobs.get(job_id)
+        if job is None and self.store is not None:
+            # 其它服务器进程提交的任务只能查询
+            try:
+                record = self.store.load(job_id)
+            except sqlite3.Error:
+                record = None
+            if record is not None:
+                return Job.from_record(record)
+        if job is None:
+            raise ValueError(f"Unknown job: {job_id}")
+        if not self.owns(job) and not job.done:
+            # 状态由其它进程更新，每次查询都从数据库刷新
+            job = self.jobs[job_id] = self._reload(job)
+        return job
+
+    def cancel(self, job_id: str) -> Job:
+        job = self.get(job_id)
+        if job.done:
+            return job
+        if not self.owns(job):
+            raise ValueError(f"Job {job_id} is owned by another server process (pid {job.owner})")
+        if job.task is not None:
+            job.task.cancel()
+        else:
+            # 还在排队：worker 取出时会跳过
+            job.update("cancelled", message="cancelled before start")
+            self._save(job)
+            metrics.inc("jobs_total", status="cancelled")
+        return job
+
+    def _ensure_workers(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._workers = [w for w in self._workers if not w.done()]
+        while len(self._workers) < self.workers:
+            self._workers.append(asyncio.ensure_future(self._worker()))
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                if not job.done:
+                    await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job) -> None:
+        task = job.task = asyncio.ensure_future(self._execute(job))
+        job.update("running", attempts=job.attempts + 1, message="generating")
+        self._save(job)
+        try:
+            # asyncio.wait 不会把 worker 的取消传递给子任务，便于区分两种取消
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            # worker 自身被取消（服务器关闭）：放回队列，下次启动时重新执行
+            task.cancel()
+            job.update("queued", task=None, attempts=job.attempts - 1, message="interrupted by shutdown")
+            self._save(job)
+            raise
+        job.task = None
+
+        if task.cancelled():
+            job.update("cancelled", message="cancelled while running")
+        elif task.exception() is not None:
+            job.update("failed", error=_error_data(task.exception()), message=None)
+        elif "error" in task.result():
+            job.update("failed", error=task.result(), message=None)
+        else:
+            job.update("succeeded", result=task.result(), message=None)
+        self._save(job)
+        metrics.inc("jobs_total", status=job.status)
+        metrics.observe("job_seconds", job.finished_at - job.created_at, status=job.status)
+
+    async def _execute(self, job: Job) -> dict:
+        _current_job.set(job)
+        response_data, _ = await _run_completion(job.arguments)
+        return response_data
+
+    async def shutdown(self) -> None:
+        """取消 worker 和运行中的任务"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self.store is not None:
+            self.store.close()
+
+    def _save(self, job: Job) -> None:
+        if self.store is None:
+            return
+        try:
+            self.store.save(job.to_record())
+        except sqlite3.Error as e:
+            self._disable_store(e)
+
+    def _disable_store(self, error: Exception) -> None:
+        print(f"⚠️ 警告: 任务数据库不可用，任务仅保存在内存中: {error}", file=sys.stderr)
+        self.store = None
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.ttl
+        for job_id in [
+            job_id for job_id, job in self.jobs.items()
+            if job.done and job.finished_at < cutoff
+        ]:
+            del self.jobs[job_id]
+        if self.store is not None:
+            try:
+                self.store.delete_finished(cutoff)
+            except sqlite3.Error as e:
+                self._disable_store(e)
+
+    def stats(self) -> dict:
+        counts = collections.Counter(job.status for job in self.jobs.values())
+        return {"workers": self.workers, **counts}
+
+
+job_manager = JobManager(
+    JOB_WORKERS, JOB_TTL, JobStore(JOB_DB) if JOB_DB else None, JOB_MAX_ATTEMPTS
 )
 
-# OpenRouter API 配置
-OPENROUTER_API_URL = "https://openrouter.ai/api/v1"
-# 不要在模块级别抛出异常，以免影响 MCP Server 启动
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
-DEFAULT_MODEL = "google/gemini-3-pro-image-preview"
 
-# 创建 MCP 服务器实例
-app = Server("nano-banana")
+async def submit_generation(arguments: dict) -> list[TextContent]:
+    """提交后台生成任务，立即返回任务 ID"""
+    job_arguments = {
+        key: value for key, value in arguments.items()
+        if key not in ("output", "thumbnails")
+    }
+    # 任务结果以文件路径返回，不在任务表里保留 base64
+    job_arguments["output"] = "file"
+    job_arguments.setdefault("priority", "batch")
+    if "prompt" in job_arguments:
+        prompt = job_arguments.pop("prompt")
+        job_arguments.setdefault("messages", [{"role": "user", "content": prompt}])
+    if not job_arguments.get("messages"):
+        raise ValueError("Either 'prompt' or 'messages' is required")
 
+    job = job_manager.submit(job_arguments)
+    return [mcp_types.TextContent(type="text", text=dump_json(job.to_dict(), arguments.get("format")))]
 
-@app.list_resources()
-async def list_resources() -> list[Resource]:
-    """列出可用的资源"""
+
+async def get_job(arguments: dict) -> list[TextContent]:
+    """查询任务状态；指定 wait 时阻塞到任务结束或超时，期间转发进度通知"""
+    job_id = arguments.get("job_id")
+    if not job_id:
+        jobs = [
+            {
+                key: value for key, value in job.to_dict().items()
+                if key not in ("result", "details")
+            }
+            for job in job_manager.jobs.values()
+        ]
+        return [mcp_types.TextContent(type="text", text=dump_json({"jobs": jobs}, arguments.get("format")))]
+
+    job = job_manager.get(job_id)
+    wait = min(float(arguments.get("wait", 0)), JOB_MAX_WAIT)
+    if wait > 0 and not job.done:
+        notify = _progress_notifier()
+        deadline = time.monotonic() + wait
+        while not job.done:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not job_manager.owns(job):
+                # 其它服务器进程负责的任务不会在本进程中通知状态变化，只能轮询数据库
+                await asyncio.sleep(min(remaining, 1.0))
+                job = job_manager.get(job_id)
+                continue
+            if not await job.wait_changed(remaining):
+                break
+            if notify and job.progress is not None:
+                await notify(job.progress, job.message)
+
+    data = job.to_dict()
+    # 投影作用于任务结果本身，任务状态字段总是保留
+    if arguments.get("fields") and isinstance(data.get("result"), dict):
+        data["result"] = _project(data["result"], arguments["fields"])
+    return render_result(data, {**arguments, "fields": None})
+
+
+async def cancel_job(arguments: dict) -> list[TextContent]:
+    """取消排队中或运行中的任务"""
+    job = job_manager.cancel(arguments["job_id"])
+    # 等取消真正生效，返回最终状态
+    while not job.done and await job.wait_changed(5.0):
+        pass
+    return [mcp_types.TextContent(type="text", text=dump_json(job.to_dict()))]
+
+
+async def clear_session(arguments: dict) -> list[TextContent]:
+    """删除服务端会话历史"""
+    cleared = conversations.clear(arguments["session_id"])
     return [
-        Resource(
-            uri="nano-banana://config",
-            name="NanoBanana Configuration",
-            mimeType="application/json",
-            description="OpenRouter API configuration for NanoBanana",
+        mcp_types.TextContent(
+            type="text",
+            text=dump_json({"session_id": arguments["session_id"], "cleared": cleared}),
         )
     ]
 
 
-@app.read_resource()
-async def read_resource(uri: str) -> str:
-    """读取资源内容"""
-    if uri == "nano-banana://config":
-        config = {
-            "api_url": OPENROUTER_API_URL,
-            "model": DEFAULT_MODEL,
-            "description": "NanoBanana MCP Server - OpenRouter API Wrapper",
-        }
-        return json.dumps(config, indent=2)
+async def _fetch_completion(
+    payload: dict,
+    cache_mode: str,
+    priority: str = "interactive",
+    coalesce: bool = True,
+    spool_dir: Optional[str] = None,
+    timeout: Optional[float] = None,
+    hedge: bool = False,
+) -> tuple[dict, dict]:
+    """获取补全结果：先查缓存，再合并相同的在途请求，最后才请求 OpenRouter
+
+    返回 (result, meta)，meta 中是需要合并到工具结果里的附加信息。
+    """
+    key = None
+    if cache_mode in ("read", "readwrite"):
+        key = ResponseCache.key(payload)
+        cached = await asyncio.to_thread(response_cache.get, key)
+        if cached is not None:
+            return cached, {"cached": True}
+
+    if not coalesce:
+        return await _fetch_upstream(payload, key, cache_mode, priority, spool_dir, timeout, hedge)
+
+    # single-flight：相同请求体只发一次上游请求，其余调用方等待并共享结果
+    key = key or ResponseCache.key(payload)
+    flight = _inflight.get(key)
+    leader = flight is None
+    if leader:
+        task = asyncio.ensure_future(
+            _fetch_upstream(payload, key, cache_mode, priority, spool_dir, timeout, hedge)
+        )
+        flight = _inflight[key] = _InFlight(task)
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
     else:
-        raise ValueError(f"Unknown resource: {uri}")
+        _coalescing_stats["coalesced"] += 1
 
+    flight.waiters += 1
+    try:
+        result, meta = await asyncio.shield(flight.task)
+    except asyncio.CancelledError:
+        # 所有等待者都放弃时才取消上游请求
+        flight.waiters -= 1
+        if flight.waiters == 0:
+            flight.task.cancel()
+        raise
+    flight.waiters -= 1
 
-@app.list_tools()
-async def list_tools() -> list[Tool]:
-    """列出可用的工具"""
-    return [
-        Tool(
-            name="chat_completion",
-            description="Send a chat completion request to OpenRouter API using Gemini 3 Pro Image Preview model. Supports text and image inputs.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "messages": {
-                        "type": "array",
-                        "description": "Array of message objects with role and content",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "role": {
-                                    "type": "string",
-                                    "enum": ["user", "assistant", "system"],
-                                    "description": "Role of the message sender",
-                                },
-                                "content": {
-                                    "type": "string",
-                                    "description": "Message content (text or image URL)",
-                                },
-                            },
-                            "required": ["role", "content"],
-                        },
-                    },
-                    "model": {
-                        "type": "string",
-                        "description": f"Model to use (default: {DEFAULT_MODEL})",
-                    },
-                    "temperature": {
-                        "type": "number",
-                        "description": "Sampling temperature (0-2, default: 1)",
-                        "minimum": 0,
-                        "maximum": 2,
-                    },
-                    "max_tokens": {
-                        "type": "integer",
-                        "description": "Maximum tokens to generate",
-                    },
-                    "stream": {
-                        "type": "boolean",
-                        "description": "Whether to stream the response (default: false)",
-                    },
-                },
-                "required": ["messages"],
-            },
-        ),
-        Tool(
-            name="list_models",
-            description="List all available models from OpenRouter API",
-            inputSchema={
-                "type": "object",
-                "properties": {},
-            },
-        ),
-    ]
+    # 结果处理过程会修改字典（如释放已保存的 base64），每个调用方使用各自的副本；
+    # deepcopy 不复制字符串本身，开销很小
+    result = copy.deepcopy(result)
+    if leader:
+        return result, meta
+    return result, {**meta, "coalesced": True}
 
 
-@app.call_tool()
-async def call_tool(name: str, arguments: Any) -> list[TextContent]:
-    """调用工具"""
-    if name == "chat_completion":
-        return await chat_completion(arguments)
-    elif name == "list_models":
-        return await list_models()
+class _InFlight:
+    """一个在途的上游请求及其等待者数量"""
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+_inflight: dict[str, _InFlight] = {}
+_coalescing_stats = {"coalesced": 0}
+
+
+async def _fetch_upstream(
+    payload: dict,
+    key: Optional[str],
+    cache_mode: str,
+    priority: str,
+    spool_dir: Optional[str] = None,
+    timeout: Optional[float] = None,
+    hedge: bool = False,
+) -> tuple[dict, dict]:
+    """排队、请求 OpenRouter 并按需写回缓存"""
+    meta: dict = {}
+
+    # 输入图像在排队前编码；TPM 预估仍基于占位 URL 的请求体，不把 base64 计入 token
+    upstream_payload = await image_inputs.materialize(payload)
+
+    # 按模型限速排队：重试、429 换凭据和对冲请求都是独立的上游请求，每次发出前各自排队；
+    # 完成后用实际用量修正 TPM 预估
+    scheduler = get_scheduler(payload["model"])
+    estimated = _estimate_tokens(payload)
+    session = _current_session()
+    meta["queue_wait_seconds"] = 0.0
+
+    async def admit() -> None:
+        waited = await scheduler.acquire(estimated, priority, session)
+        meta["queue_wait_seconds"] = round(meta["queue_wait_seconds"] + waited, 3)
+
+    if payload.get("stream"):
+        ((result, meta["stream"]), served_by), meta["upstream"] = await execute_request(
+            payload["model"],
+            lambda: upstream_pool.call(
+                lambda upstream: _stream_chat_completion(upstream_payload, timeout, upstream, spool_dir),
+                payload["model"],
+                admit=admit,
+            ),
+        )
     else:
-        raise ValueError(f"Unknown tool: {name}")
+        def discard(value: tuple[dict, Upstream]) -> None:
+            # 被放弃的对冲请求同样计入预算、凭据用量和 TPM
+            usage = _charge(payload["model"], *value)
+            scheduler.settle(estimated, usage.get("total_tokens"))
+            _discard_spooled(value[0])
 
+        (result, served_by), meta["upstream"] = await execute_request(
+            payload["model"],
+            lambda: hedge_policy.run(
+                payload["model"],
+                lambda tried: upstream_pool.call(
+                    lambda upstream: _post_chat_completion(upstream_payload, spool_dir, timeout, upstream),
+                    payload["model"],
+                    tried,
+                    admit=admit,
+                ),
+                hedge,
+                discard,
+            ),
+        )
+    usage = _charge(payload["model"], result, served_by)
+    if len(upstream_pool.upstreams) > 1:
+        meta["upstream"]["endpoint"] = served_by.name
+    scheduler.settle(estimated, usage.get("total_tokens"))
+    for kind in ("prompt", "completion"):
+        if usage.get(f"{kind}_tokens"):
+            metrics.inc("tokens_total", usage[f"{kind}_tokens"], kind=kind, model=payload["model"])
 
-async def chat_completion(arguments: dict) -> list[TextContent]:
-    """调用 OpenRouter Chat Completion API"""
-    messages = arguments.get("messages", [])
-    model = arguments.get("model", DEFAULT_MODEL)
-    temperature = arguments.get("temperature", 1.0)
-    max_tokens = arguments.get("max_tokens")
-    stream = arguments.get("stream", False)
+    if cache_mode == "readwrite" and result.get("choices"):
+        # 写入缓存后图像指向 blob 文件，原始 base64 字符串随之释放
+        result = await asyncio.to_thread(response_cache.put, key, result)
+    return result, meta
 
-    # 构建请求体
-    payload = {
-        "model": model,
-        "messages": messages,
-        "temperature": temperature,
-        "modalities": ["image", "text"],  # 支持图像生成
-    }
 
-    if max_tokens:
-        payload["max_tokens"] = max_tokens
+def _charge(model: str, result: dict, served_by: Upstream) -> dict:
+    """把一次上游响应的用量记到凭据和预算账本上，返回 usage"""
+    usage = result.get("usage") or {}
+    upstream_pool.record_usage(served_by, usage)
+    images = sum(len((c.get("message") or {}).get("images") or []) for c in result.get("choices", [])[:1])
+    budget_ledger.record(model, _budget_session.get(), served_by.name, usage, images)
+    return usage
 
-    if stream:
-        payload["stream"] = True
 
-    # 发送请求
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://github.com/nano-banana/mcp-server",
-        "X-Title": "NanoBanana MCP Server",
-    }
+async def _post_chat_completion(
+    payload: dict,
+    spool_dir: Optional[str] = None,
+    timeout: Optional[float] = None,
+    upstream: Optional[Upstream] = None,
+) -> dict:
+    """向上游发送一次 /chat/completions 请求
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        try:
-            response = await client.post(
-                f"{OPENROUTER_API_URL}/chat/completions",
-                json=payload,
-                headers=headers,
-            )
+    指定 spool_dir 且后端支持时，响应体按块增量解析，图像 base64 直接解码写入该目录，
+    结果中的图像以文件形式表示，不在内存中保留完整的 base64 字符串。
+    """
+    upstream = upstream or upstream_pool.select(model=payload["model"])
+    client = get_http_client()
+    request = client.build_request(
+        "POST",
+        f"{upstream.url}/chat/completions",
+        json=upstream.prepare(payload),
+        headers=upstream.request_headers(),
+        timeout=httpx.Timeout(timeout or REQUEST_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        extensions={"trace": _connect_tracer()},
+    )
+    metrics.inc("upstream_bytes_out_total", len(request.content))
+
+    # 分阶段计时：等待响应头（上游生成）、下载响应体、JSON 解码
+    with metrics.timer("upstream"):
+        response = await client.send(request, stream=True)
+    try:
+        metrics.inc("upstream_responses_total", status=response.status_code, model=payload["model"])
+        if spool_dir is not None and upstream.supports_spool and not response.is_error:
+            with metrics.timer("download_decode"):
+                return await _parse_streaming_body(response, spool_dir)
+
+        with metrics.timer("download"):
+            body = await response.aread()
+    finally:
+        await response.aclose()
+    metrics.inc("upstream_bytes_in_total", len(body))
+
+    response.raise_for_status()
+    with metrics.timer("json_decode"):
+        return upstream.normalize(json.loads(body))
+
+
+async def _parse_streaming_body(response: httpx.Response, spool_dir: str) -> dict:
+    """增量解析响应体，把 choices[0].message.images[*].image_url.url 解码写入 spool_dir"""
+    prefix = image_file_prefix()
+    sinks: list[_Base64FileSink] = []
+    notify = _progress_notifier()
+    reported = 0
+
+    def sink_factory(path: tuple) -> Optional[_Base64FileSink]:
+        if not _is_image_url_path(path):
+            return None
+        sinks.append(_Base64FileSink(spool_dir, f"{prefix}_{len(sinks) + 1}"))
+        return sinks[-1]
+
+    parser = StreamingJsonParser(sink_factory)
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    received = 0
+    try:
+        async for chunk in response.aiter_bytes():
+            received += len(chunk)
+            parser.feed(decoder.decode(chunk))
+            # 每张图像解码写完后立即通知，不等整个响应体接收完
+            while notify and reported < len(sinks) and sinks[reported].file and sinks[reported].file.closed:
+                reported += 1
+                await notify(reported, f"image {reported} saved: {sinks[reported - 1].path}")
+        parser.feed(decoder.decode(b"", final=True))
+        result = parser.close()
+    except BaseException:
+        parser.abort()
+        raise
+    metrics.inc("upstream_bytes_in_total", received)
+
+    for choice in result.get("choices", [])[:1]:
+        for img in (choice.get("message") or {}).get("images") or []:
+            image_url = img.get("image_url") or {}
+            if isinstance(image_url.get("url"), dict):
+                file_info = image_url.pop("url")
+                image_url.update(file_info)
+                metrics.inc("image_bytes_total", file_info["size"])
+    return result
+
+
+async def _stream_chat_completion(
+    payload: dict,
+    timeout: Optional[float] = None,
+    upstream: Optional[Upstream] = None,
+    spool_dir: Optional[str] = None,
+) -> tuple[dict, dict]:
+    """以 SSE 方式请求 /chat/completions，累积文本和图像增量，并转发 MCP 进度通知
+
+    返回与非流式响应结构一致的结果，以及首包/总耗时统计。
+    """
+    notify = _progress_notifier()
+    upstream = upstream or upstream_pool.select(model=payload["model"])
+    prefix = image_file_prefix()
+    client = get_http_client()
+    started = time.monotonic()
+    first_chunk = None
+    last_notify = 0.0
+    chunks = 0
+    content_parts: list[str] = []
+    content_length = 0
+    images: list[dict] = []
+    result: dict = {"model": payload["model"]}
+    finish_reason = None
+
+    # 读超时作用于相邻两个数据块之间，长时间生成只要持续有数据就不会被中断
+    async with client.stream(
+        "POST",
+        f"{upstream.url}/chat/completions",
+        json=upstream.prepare(payload),
+        headers=upstream.request_headers(),
+        timeout=httpx.Timeout(timeout or REQUEST_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        extensions={"trace": _connect_tracer()},
+    ) as response:
+        metrics.inc("upstream_bytes_out_total", len(response.request.content))
+        metrics.inc("upstream_responses_total", status=response.status_code, model=payload["model"])
+        if response.is_error:
+            await response.aread()
             response.raise_for_status()
-            result = response.json()
-
-            # 提取响应内容
-            if "choices" in result and len(result["choices"]) > 0:
-                message = result["choices"][0]["message"]
-                content = message.get("content", "")
-                images = message.get("images", [])
-                usage = result.get("usage", {})
-
-                response_data = {
-                    "content": content,
-                    "model": result.get("model", model),
-                    "usage": usage,
-                }
-                
-                # 如果有图像，添加到响应中
-                if images:
-                    response_data["images"] = [
-                        {
-                            "url": img.get("image_url", {}).get("url", ""),
-                            "detail": img.get("image_url", {}).get("detail", "auto")
-                        }
-                        for img in images
-                    ]
-
-                return [
-                    TextContent(
-                        type="text",
-                        text=json.dumps(
-                            response_data,
-                            indent=2,
-                            ensure_ascii=False,
-                        ),
-                    )
-                ]
-            else:
-                return [
-                    TextContent(
-                        type="text",
-                        text=json.dumps(
-                            {"error": "No response from API", "raw_response": result},
-                            indent=2,
-                        ),
-                    )
+
+        async for line in response.aiter_lines():
+            # 忽略 SSE 注释（如 ": OPENROUTER PROCESSING"）和空行
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+
+            chunk = json.loads(data)
+            if "error" in chunk:
+                # 错误可能是 {"message": ...} 对象，也可能只是一个字符串
+                error = chunk["error"]
+                raise RuntimeError(error.get("message", str(error)) if isinstance(error, dict) else str(error))
+
+            chunks += 1
+            metrics.inc("upstream_bytes_in_total", len(line))
+            if first_chunk is None:
+                first_chunk = time.monotonic() - started
+                metrics.observe("time_to_first_chunk_seconds", first_chunk, model=payload["model"])
+            for key in ("id", "model", "usage"):
+                if chunk.get(key):
+                    result[key] = chunk[key]
+
+            new_images = 0
+            for choice in chunk.get("choices", [])[:1]:
+                delta = choice.get("delta", {})
+                if delta.get("content"):
+                    content_parts.append(delta["content"])
+                    content_length += len(delta["content"])
+                if delta.get("images"):
+                    new_images = len(delta["images"])
+                    for img in delta["images"]:
+                        if spool_dir is not None:
+                            img = await asyncio.to_thread(_spool_image, img, spool_dir, f"{prefix}_{len(images) + 1}")
+                        images.append(img)
+                finish_reason = choice.get("finish_reason") or finish_reason
+
+            # 文本增量按时间节流，收到图像时立即通知（已写入磁盘时带上文件路径）
+            now = time.monotonic()
+            if notify and (new_images or chunks == 1 or now - last_notify >= 0.25):
+                last_notify = now
+                status = f"{content_length} chars, {len(images)} images after {now - started:.1f}s"
+                saved = [
+                    img["image_url"]["file"] for img in images[len(images) - new_images:]
+                    if "file" in img.get("image_url", {})
                 ]
+                if saved:
+                    status += f"; saved {', '.join(saved)}"
+                await notify(chunks, status)
 
-        except httpx.HTTPStatusError as e:
-            return [
-                TextContent(
-                    type="text",
-                    text=json.dumps(
-                        {
-                            "error": f"HTTP error: {e.response.status_code}",
-                            "details": e.response.text,
-                        },
-                        indent=2,
-                    ),
-                )
-            ]
-        except Exception as e:
-            return [
-                TextContent(
-                    type="text",
-                    text=json.dumps({"error": str(e)}, indent=2),
-                )
-            ]
+    message: dict = {"role": "assistant", "content": "".join(content_parts)}
+    if images:
+        message["images"] = images
+    result["choices"] = [{"message": message, "finish_reason": finish_reason}]
+    result = upstream.normalize(result)
+
+    metrics.observe("phase_seconds", time.monotonic() - started, phase="upstream_stream")
+    stats = {
+        "chunks": chunks,
+        "first_chunk_seconds": round(first_chunk, 3) if first_chunk is not None else None,
+        "total_seconds": round(time.monotonic() - started, 3),
+    }
+    return result, stats
 
 
-async def list_models() -> list[TextContent]:
-    """列出所有可用的模型"""
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+def _spool_image(img: dict, directory: str, stem: str) -> dict:
+    """把流式响应中收到的一张 data URL 图像立即写入磁盘，返回与增量解析相同的文件形式"""
+    image_url = img.get("image_url") or {}
+    url = image_url.get("url") or ""
+    if not url.startswith("data:image"):
+        return img
+    info = save_data_url(url, directory, stem)
+    metrics.inc("image_bytes_total", info["size"])
+    return {
+        **img,
+        "image_url": {
+            "file": os.path.abspath(info["path"]),
+            "format": info["format"],
+            "size": info["size"],
+            "sha256": info["sha256"],
+            "detail": image_url.get("detail", "auto"),
+        },
     }
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
+
+# 多候选生成时由外层设置，把各候选的进度汇总为单调递增的通知
+_progress_hook: contextvars.ContextVar[Optional[Callable[[float, Optional[str]], Awaitable[None]]]] = (
+    contextvars.ContextVar("nano_banana_progress_hook", default=None)
+)
+
+
+def _progress_notifier() -> Optional[Callable[[float, Optional[str]], Awaitable[None]]]:
+    """返回向当前 MCP 请求发送进度通知的函数；客户端未提供 progressToken 时返回 None
+
+    在后台任务中运行时，进度记录到任务上，由 get_job 返回或转发给正在等待的调用方。
+    """
+    hook = _progress_hook.get()
+    if hook is not None:
+        return hook
+    job = _current_job.get()
+    if job is not None:
+        async def record(progress: float, message: Optional[str] = None) -> None:
+            job.update(progress=progress, message=message)
+
+        return record
+    if _app is None:
+        return None
+    try:
+        ctx = _app.request_context
+    except LookupError:
+        return None
+    token = ctx.meta.progressToken if ctx.meta else None
+    if token is None:
+        return None
+
+    async def notify(progress: float, message: Optional[str] = None) -> None:
         try:
-            response = await client.get(
-                f"{OPENROUTER_API_URL}/models",
-                headers=headers,
-            )
-            response.raise_for_status()
-            result = response.json()
+            await ctx.session.send_progress_notification(token, progress, message=message)
+        except Exception:
+            # 进度通知失败不影响主请求
+            pass
 
-            return [
-                TextContent(
-                    type="text",
-                    text=json.dumps(result, indent=2, ensure_ascii=False),
-                )
-            ]
+    return notify
 
-        except Exception as e:
-            return [
-                TextContent(
-                    type="text",
-                    text=json.dumps({"error": str(e)}, indent=2),
+
+def _inline_images(images: list[dict]) -> list[dict]:
+    """以 data URL 形式返回图像（缓存命中的 blob 文件会重新编码）"""
+    inlined = []
+    for img in images:
+        image_url = img.get("image_url", {})
+        url = image_url.get("url", "")
+        if "file" in image_url:
+            url = _file_data_url(image_url["file"], image_url["format"])
+        if url.startswith("data:image"):
+            # 按 base64 长度估算解码后的字节数
+            metrics.inc("image_bytes_total", (len(url) - url.index(",") - 1) * 3 // 4)
+        inlined.append({"url": url, "detail": image_url.get("detail", "auto")})
+    return inlined
+
+
+def _save_images(images: list[dict], output_dir: str, shared: bool = False) -> list[dict]:
+    """把响应中的图像写入 output_dir，返回文件信息
+
+    shared 为 True 表示结果来自合并的请求或缓存，已落盘的文件可能也交给了其他调用方，
+    此时即使在同一目录下也为本次调用另建一个硬链接（不支持时复制），
+    使后续处理（如 keep_original 为 false 时删除原图）只影响自己的文件。
+    """
+    prefix = image_file_prefix()
+    output_dir = os.path.abspath(output_dir)
+    saved = []
+
+    for i, img in enumerate(images, 1):
+        image_url = img.get("image_url", {})
+        url = image_url.get("url") or ""
+        if "file" in image_url:
+            path = image_url["file"]
+            if os.path.dirname(os.path.abspath(path)) != output_dir:
+                # 缓存 blob 或其它目录中的文件：复制过来，无需再次解码
+                os.makedirs(output_dir, exist_ok=True)
+                path = os.path.join(output_dir, f"{prefix}_{i}.{image_url['format']}")
+                shutil.copyfile(image_url["file"], path)
+            elif shared:
+                path = os.path.join(output_dir, f"{prefix}_{i}.{image_url['format']}")
+                try:
+                    os.link(image_url["file"], path)
+                except OSError:
+                    shutil.copyfile(image_url["file"], path)
+            info = {
+                "path": os.path.abspath(path),
+                "format": image_url["format"],
+                "size": image_url["size"],
+                "sha256": image_url["sha256"],
+            }
+        elif url.startswith("data:image"):
+            info = save_data_url(url, output_dir, f"{prefix}_{i}")
+            metrics.inc("image_bytes_total", info["size"])
+            # 已写入磁盘，释放响应中的 base64 字符串
+            image_url["url"] = None
+        else:
+            # 远程 URL 原样返回
+            saved.append({"url": url, "detail": image_url.get("detail", "auto")})
+            continue
+
+        info["detail"] = image_url.get("detail", "auto")
+        saved.append(info)
+
+    return saved
+
+
+async def _make_thumbnails(saved: list[dict]) -> list[ImageContent]:
+    """在进程池中为已保存的图像生成 JPEG 缩略图"""
+    results = await asyncio.gather(*(
+        run_in_image_pool(thumbnail_jpeg, info["path"], THUMBNAIL_SIZE)
+        for info in saved
+        if "path" in info
+    ))
+    return [
+        mcp_types.ImageContent(
+            type="image",
+            data=base64.b64encode(data).decode("ascii"),
+            mimeType="image/jpeg",
+        )
+        for data in results
+        if data is not None
+    ]
+
+
+async def _postprocess_images(images: list[dict], spec: dict, output: str) -> list[dict]:
+    """在进程池中缩放、转码图像，把结果作为 variants 附加到每张图像上
+
+    file 模式下新文件与原图放在同一目录；inline 模式下原图先解码到临时目录，
+    结果以 data URL 返回。keep_original 为 false 时只返回处理后的版本（file 模式会删除原图），
+    默认 file 模式保留原图、inline 模式不保留。
+    """
+    keep_original = spec.get("keep_original", output == "file")
+    processed = []
+    with tempfile.TemporaryDirectory(prefix="nano-banana-") as tmpdir:
+        sources = []
+        for i, info in enumerate(images, 1):
+            if "path" in info:
+                sources.append(info["path"])
+            elif (info.get("url") or "").startswith("data:image"):
+                saved = await asyncio.to_thread(save_data_url, info["url"], tmpdir, f"image_{i}")
+                sources.append(saved["path"])
+            else:
+                # 远程 URL 无法处理，原样返回
+                sources.append(None)
+
+        results = await asyncio.gather(*(
+            run_in_image_pool(postprocess_image, path, spec)
+            for path in sources
+            if path is not None
+        ))
+        results = iter(results)
+
+        for info, path in zip(images, sources):
+            if path is None:
+                processed.append(info)
+                continue
+            variants = next(results)
+            metrics.inc("postprocess_bytes_total", os.path.getsize(path), stage="in")
+            metrics.inc("postprocess_bytes_total", sum(v["size"] for v in variants), stage="out")
+            if output != "file":
+                for variant in variants:
+                    variant["url"] = await asyncio.to_thread(_file_data_url, variant.pop("path"), variant["format"])
+            if keep_original:
+                entry = dict(info)
+            else:
+                entry = {"detail": info.get("detail", "auto")}
+                if output == "file":
+                    os.remove(path)
+            entry["variants"] = variants
+            processed.append(entry)
+    return processed
+
+
+def _file_data_url(path: str, fmt: str) -> str:
+    with open(path, "rb") as f:
+        encoded = base64.b64encode(f.read()).decode("ascii")
+    return f"data:{_IMAGE_MIME_TYPES.get(fmt, 'image/jpeg')};base64,{encoded}"
+
+
+class ModelCatalog:
+    """OpenRouter 模型目录的进程内缓存，按 TTL 过期并用 ETag 条件请求重新验证"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.models: list[dict] = []
+        self.by_id: dict[str, dict] = {}
+        self.by_provider: dict[str, list[dict]] = {}
+        self.by_output_modality: dict[str, list[dict]] = {}
+        self.by_input_modality: dict[str, list[dict]] = {}
+        self.etag: Optional[str] = None
+        self.fetched_at = 0.0
+        self.hits = 0
+        self.fetches = 0
+        self.revalidations = 0
+        self._lock = asyncio.Lock()
+
+    def is_fresh(self) -> bool:
+        return bool(self.models) and time.monotonic() - self.fetched_at < self.ttl
+
+    async def load(self, refresh: bool = False) -> bool:
+        """确保目录可用，返回是否直接使用了缓存"""
+        if not refresh and self.is_fresh():
+            self.hits += 1
+            return True
+
+        # 同一时刻只允许一个请求刷新目录，其余等待后复用结果
+        async with self._lock:
+            if not refresh and self.is_fresh():
+                self.hits += 1
+                return True
+
+            async def fetch(upstream: Upstream) -> httpx.Response:
+                headers = upstream.headers()
+                if self.etag and self.models:
+                    headers["If-None-Match"] = self.etag
+                client = get_http_client()
+                response = await client.get(
+                    f"{upstream.url}/models",
+                    headers=headers,
+                    timeout=30.0,
                 )
+                if response.status_code != 304:
+                    response.raise_for_status()
+                return response
+
+            # 只有 OpenRouter 的 /models 带 architecture、pricing，OpenAI 兼容网关的目录不能替代它
+            (response, _), _ = await execute_request("/models", lambda: upstream_pool.call(fetch, kind="openrouter"))
+            if response.status_code == 304:
+                self.revalidations += 1
+                self.fetched_at = time.monotonic()
+                return True
+
+            self.fetches += 1
+            self._index(response.json().get("data", []))
+            self.etag = response.headers.get("ETag")
+            self.fetched_at = time.monotonic()
+            return False
+
+    def _index(self, models: list[dict]) -> None:
+        """按 id、提供方和输入/输出模态建立索引"""
+        by_id = {}
+        by_provider: dict[str, list[dict]] = {}
+        by_output: dict[str, list[dict]] = {}
+        by_input: dict[str, list[dict]] = {}
+        for model in models:
+            model_id = model.get("id", "")
+            by_id[model_id] = model
+            by_provider.setdefault(model_id.split("/", 1)[0], []).append(model)
+            architecture = model.get("architecture") or {}
+            for modality in architecture.get("output_modalities") or []:
+                by_output.setdefault(modality, []).append(model)
+            for modality in architecture.get("input_modalities") or []:
+                by_input.setdefault(modality, []).append(model)
+
+        self.models = models
+        self.by_id = by_id
+        self.by_provider = by_provider
+        self.by_output_modality = by_output
+        self.by_input_modality = by_input
+
+    def query(
+        self,
+        modality: Optional[str] = None,
+        input_modality: Optional[str] = None,
+        provider: Optional[str] = None,
+        search: Optional[str] = None,
+    ) -> list[dict]:
+        """按条件过滤模型，保持目录原有顺序"""
+        candidates = self.models
+        for index, value in (
+            (self.by_output_modality, modality),
+            (self.by_input_modality, input_modality),
+            (self.by_provider, provider),
+        ):
+            if value:
+                allowed = {id(m) for m in index.get(value, [])}
+                candidates = [m for m in candidates if id(m) in allowed]
+
+        if search:
+            needle = search.lower()
+            candidates = [
+                m for m in candidates
+                if needle in m.get("id", "").lower() or needle in (m.get("name") or "").lower()
             ]
+        return candidates
+
+    def stats(self) -> dict:
+        return {
+            "models": len(self.models),
+            "age_seconds": round(time.monotonic() - self.fetched_at, 1) if self.models else None,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "fetches": self.fetches,
+            "revalidations": self.revalidations,
+        }
+
+
+def _project(model: dict, fields: list[str]) -> dict:
+    """按字段列表投影模型信息，支持 pricing.prompt 这样的点路径"""
+    projected: dict = {}
+    for field in fields:
+        value: Any = model
+        for part in field.split("."):
+            if not isinstance(value, dict) or part not in value:
+                value = None
+                break
+            value = value[part]
+        if value is not None:
+            projected[field] = value
+    return projected
+
+
+model_catalog = ModelCatalog(MODELS_TTL)
+
+
+async def list_models(arguments: Optional[dict] = None) -> list[TextContent]:
+    """列出可用的模型（带缓存，支持过滤、字段投影和分页）"""
+    arguments = arguments or {}
+    fields = arguments.get("fields", DEFAULT_MODEL_FIELDS)
+    offset = max(0, int(arguments.get("offset", 0)))
+    limit = max(0, int(arguments.get("limit", 50)))
+
+    try:
+        cached = await model_catalog.load(refresh=arguments.get("refresh", False))
+        matched = model_catalog.query(
+            modality=arguments.get("modality"),
+            input_modality=arguments.get("input_modality"),
+            provider=arguments.get("provider"),
+            search=arguments.get("search"),
+        )
+        page = matched[offset:offset + limit]
+        if fields:
+            page = [_project(m, fields) for m in page]
+
+        result = {
+            "total": len(matched),
+            "offset": offset,
+            "limit": limit,
+            "cached": cached,
+            "data": page,
+        }
+        return [mcp_types.TextContent(type="text", text=dump_json(result, arguments.get("format")))]
+
+    except Exception as e:
+        return [mcp_types.TextContent(type="text", text=dump_json(_error_data(e), arguments.get("format")))]
 
 
-async def main():
-    """启动 MCP 服务器"""
-    if not OPENROUTER_API_KEY:
-        import sys
+@contextlib.asynccontextmanager
+async def server_lifespan():
+    """服务器生命周期：共享连接池、恢复后台任务，退出时清理"""
+    global _http_client
+
+    if not upstream_pool.has_credentials():
         print("⚠️ 警告: OPENROUTER_API_KEY 环境变量未设置！MCP Server 将启动，但调用 API 会失败。", file=sys.stderr)
         print("请在 MCP 客户端配置中设置环境变量: OPENROUTER_API_KEY", file=sys.stderr)
 
-    async with stdio_server() as (read_stream, write_stream):
-        await app.run(
-            read_stream,
-            write_stream,
-            app.create_initialization_options(),
+    # 整个服务器生命周期共享一个连接池，退出时关闭
+    _http_client = create_http_client()
+    # 恢复上次未完成的后台任务
+    restored = job_manager.restore()
+    if restored.get("resumed"):
+        print(f"已恢复 {restored['resumed']} 个未完成的后台任务", file=sys.stderr)
+    try:
+        yield
+    finally:
+        await job_manager.shutdown()
+        await close_http_client()
+        conversations.close()
+        await asyncio.to_thread(close_image_pool, True)
+
+
+def load_runtime() -> None:
+    """导入 mcp、httpx 等重量级依赖并创建 MCP 服务器实例"""
+    httpx._load()
+    mcp_types._load()
+    importlib.import_module("mcp.server.stdio")
+    get_app()
+    # 前端应答握手时 mcp 尚未导入，只能使用下面的副本；已安装的 SDK 不支持其中的版本时提示升级
+    supported = importlib.import_module("mcp.shared.version").SUPPORTED_PROTOCOL_VERSIONS
+    missing = [v for v in _PROTOCOL_VERSIONS if v not in supported]
+    if missing:
+        print(
+            f"⚠️ 警告: 已安装的 mcp 不支持协议版本 {', '.join(missing)}，请按 requirements.txt 升级 mcp",
+            file=sys.stderr,
         )
 
 
+# stdio 前端在 mcp 导入完成前直接应答的握手参数，需与 get_app().create_initialization_options() 一致；
+# 协议版本取自 mcp 1.24 的 SUPPORTED_PROTOCOL_VERSIONS，对应 requirements.txt 中的最低版本
+_PROTOCOL_VERSIONS = ("2024-11-05", "2025-03-26", "2025-06-18", "2025-11-25")
+_CAPABILITIES = {
+    "experimental": {},
+    "resources": {"subscribe": False, "listChanged": False},
+    "tools": {"listChanged": False},
+}
+_PRELUDE_ID = "nano-banana-prelude"
+
+
+def _write_jsonrpc(message: dict) -> None:
+    sys.stdout.buffer.write(json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode() + b"\n")
+    sys.stdout.buffer.flush()
+
+
+def _stdio_prelude() -> Optional[list[bytes]]:
+    """冷启动前端：在 mcp 导入完成前应答 initialize、ping 和列表请求
+
+    应答第一条消息后在后台线程中执行 load_runtime()（单核机器上同时导入会拖慢首个应答）。
+    收到第一个需要完整服务器处理的消息时等待导入完成并返回，返回值是要按顺序重放给
+    MCP 会话的原始消息；客户端在此之前断开时返回 None。
+    """
+    loader = threading.Thread(target=load_runtime, name="nano-banana-loader", daemon=True)
+    replay: list[bytes] = []
+    while True:
+        line = sys.stdin.buffer.readline()
+        if not line:
+            return None
+        if not line.strip():
+            continue
+        try:
+            message = json.loads(line)
+        except ValueError:
+            message = None
+        method = message.get("method") if isinstance(message, dict) else None
+        is_request = method is not None and "id" in message
+
+        if method == "initialize" and is_request:
+            requested = (message.get("params") or {}).get("protocolVersion")
+            _write_jsonrpc({
+                "jsonrpc": "2.0",
+                "id": message["id"],
+                "result": {
+                    "protocolVersion": requested if requested in _PROTOCOL_VERSIONS else _PROTOCOL_VERSIONS[-1],
+                    "capabilities": _CAPABILITIES,
+                    "serverInfo": {"name": SERVER_NAME, "version": SERVER_VERSION},
+                },
+            })
+            # 会话需要看到 initialize 才会进入已初始化状态；重放时换成内部 id，丢弃它的应答
+            message["id"] = _PRELUDE_ID
+            replay.append(json.dumps(message).encode())
+        elif method == "notifications/initialized":
+            replay.append(line)
+        elif method == "ping" and is_request:
+            _write_jsonrpc({"jsonrpc": "2.0", "id": message["id"], "result": {}})
+        elif method == "tools/list" and is_request and replay:
+            _write_jsonrpc({"jsonrpc": "2.0", "id": message["id"], "result": {"tools": TOOLS}})
+        elif method == "resources/list" and is_request and replay:
+            _write_jsonrpc({"jsonrpc": "2.0", "id": message["id"], "result": {"resources": RESOURCES}})
+        else:
+            replay.append(line)
+            if loader.ident is None:
+                loader.start()
+            loader.join()
+            return replay
+
+        if loader.ident is None:
+            loader.start()
+
+
+@contextlib.asynccontextmanager
+async def _replay_prelude(read_stream, write_stream, prelude: Sequence[bytes]):
+    """把前端已读取的消息排在 stdin 之前交给会话，并丢弃重放的 initialize 的应答"""
+    import anyio
+    from mcp.shared.message import SessionMessage
+
+    session_in_writer, session_in = anyio.create_memory_object_stream(0)
+    session_out, session_out_reader = anyio.create_memory_object_stream(0)
+
+    async def pump_in():
+        async with session_in_writer:
+            for raw in prelude:
+                try:
+                    message = mcp_types.JSONRPCMessage.model_validate_json(raw)
+                except Exception as exc:
+                    await session_in_writer.send(exc)
+                    continue
+                await session_in_writer.send(SessionMessage(message))
+            async for item in read_stream:
+                await session_in_writer.send(item)
+
+    async def pump_out():
+        async with session_out_reader:
+            async for item in session_out_reader:
+                if getattr(item.message.root, "id", None) == _PRELUDE_ID:
+                    continue
+                await write_stream.send(item)
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(pump_in)
+        tg.start_soon(pump_out)
+        yield session_in, session_out
+        tg.cancel_scope.cancel()
+    # 会话不直接持有 stdio 的写端，需在这里关闭，stdio_server 的输出任务才会结束，
+    # 否则退出时卡住，server_lifespan 的清理不会执行
+    await write_stream.aclose()
+
+
+async def serve_stdio(prelude: Sequence[bytes] = ()) -> None:
+    """通过 stdio 为单个客户端提供服务；prelude 是冷启动前端已经读取的消息"""
+    from mcp.server.stdio import stdio_server
+
+    app = get_app()
+    async with server_lifespan():
+        async with stdio_server() as (read_stream, write_stream):
+            async with contextlib.AsyncExitStack() as stack:
+                if prelude:
+                    read_stream, write_stream = await stack.enter_async_context(
+                        _replay_prelude(read_stream, write_stream, prelude)
+                    )
+                await app.run(
+                    read_stream,
+                    write_stream,
+                    app.create_initialization_options(),
+                )
+
+
+def create_http_app(transport: str, host: str = "127.0.0.1", port: int = 8000):
+    """创建 SSE 或 Streamable HTTP 的 ASGI 应用
+
+    所有客户端会话共享同一进程内的连接池、响应缓存、调度器和任务表。
+    客户端路径限制在 ALLOWED_DIRS 中；设置了 HTTP_TOKEN 时除 /health 外都要求令牌。
+    """
+    import hmac
+
+    from mcp.server.transport_security import TransportSecuritySettings
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse, Response
+    from starlette.routing import Mount, Route
+
+    global _confine_paths
+    _confine_paths = True
+
+    # DNS 重绑定防护：监听回环地址时只接受本机的 Host；监听其它地址需配置 HTTP_ALLOWED_HOSTS
+    allowed_hosts = list(HTTP_ALLOWED_HOSTS)
+    if host in ("127.0.0.1", "localhost", "::1"):
+        allowed_hosts += [f"{name}:{port}" for name in ("127.0.0.1", "localhost", "[::1]")]
+    security = TransportSecuritySettings(
+        enable_dns_rebinding_protection=bool(allowed_hosts),
+        allowed_hosts=allowed_hosts,
+        allowed_origins=[f"{scheme}://{h}" for h in allowed_hosts for scheme in ("http", "https")],
+    )
+
+    async def health(request):
+        return JSONResponse({"status": "ok", "transport": transport})
+
+    app = get_app()
+    routes = [Route("/health", endpoint=health, methods=["GET"])]
+
+    if transport == "sse":
+        from mcp.server.sse import SseServerTransport
+
+        sse = SseServerTransport("/messages/", security_settings=security)
+
+        async def handle_sse(request):
+            async with sse.connect_sse(request.scope, request.receive, request._send) as (
+                read_stream,
+                write_stream,
+            ):
+                await app.run(read_stream, write_stream, app.create_initialization_options())
+            return Response()
+
+        routes += [
+            Route("/sse", endpoint=handle_sse, methods=["GET"]),
+            Mount("/messages/", app=sse.handle_post_message),
+        ]
+
+        @contextlib.asynccontextmanager
+        async def lifespan(_app):
+            async with server_lifespan():
+                yield
+    else:
+        from mcp.server.streamable_http_manager import StreamableHTTPSessionManager
+
+        session_manager = StreamableHTTPSessionManager(app=app, security_settings=security)
+
+        async def handle_mcp(scope, receive, send):
+            await session_manager.handle_request(scope, receive, send)
+
+        routes.append(Mount("/mcp", app=handle_mcp))
+
+        @contextlib.asynccontextmanager
+        async def lifespan(_app):
+            async with server_lifespan(), session_manager.run():
+                yield
+
+    starlette_app = Starlette(routes=routes, lifespan=lifespan)
+    if not HTTP_TOKEN:
+        return starlette_app
+
+    expected = f"Bearer {HTTP_TOKEN}".encode()
+
+    async def authenticated(scope, receive, send):
+        if scope["type"] == "http" and scope["path"] != "/health":
+            supplied = dict(scope["headers"]).get(b"authorization", b"")
+            if not hmac.compare_digest(supplied, expected):
+                await JSONResponse({"error": "unauthorized"}, status_code=401)(scope, receive, send)
+                return
+        await starlette_app(scope, receive, send)
+
+    return authenticated
+
+
+async def serve_http(transport: str, host: str, port: int) -> None:
+    """以常驻网络服务的方式运行，同时服务多个客户端会话"""
+    import uvicorn
+
+    endpoint = "/sse" if transport == "sse" else "/mcp"
+    print(f"NanoBanana MCP Server ({transport}) 监听 http://{host}:{port}{endpoint}", file=sys.stderr)
+    if not HTTP_TOKEN and host not in ("127.0.0.1", "localhost", "::1"):
+        print("⚠️ 警告: 监听非回环地址但未设置 NANO_BANANA_HTTP_TOKEN，任何能访问该端口的客户端都可调用", file=sys.stderr)
+    config = uvicorn.Config(create_http_app(transport, host, port), host=host, port=port, log_level="warning")
+    await uvicorn.Server(config).serve()
+
+
+def _parse_importtime(stderr: str) -> list[tuple[int, int, int, str]]:
+    """解析 -X importtime 输出，返回 (self_us, cumulative_us, depth, module)"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((int(parts[0]), int(parts[1]), depth, name.strip()))
+    return entries
+
+
+def print_import_profile(limit: int = 20) -> None:
+    """测量冷启动：端到端应答 initialize 的耗时，以及各模块的导入耗时"""
+    import subprocess
+
+    script = os.path.abspath(__file__)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(script), env.get("PYTHONPATH")]))
+
+    # 启动一个真实的 stdio 服务器进程，计时到收到 initialize 应答
+    initialize = {
+        "jsonrpc": "2.0",
+        "id": 1,
+        "method": "initialize",
+        "params": {
+            "protocolVersion": _PROTOCOL_VERSIONS[-1],
+            "capabilities": {},
+            "clientInfo": {"name": "import-profile", "version": SERVER_VERSION},
+        },
+    }
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, script],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        env=env,
+    )
+    proc.stdin.write(json.dumps(initialize).encode() + b"\n")
+    proc.stdin.flush()
+    proc.stdout.readline()
+    initialize_ms = (time.perf_counter() - started) * 1000
+    proc.stdin.close()
+    proc.wait()
+
+    code = (
+        "import time; t0 = time.perf_counter(); import mcp_server; t1 = time.perf_counter(); "
+        "mcp_server.load_runtime(); t2 = time.perf_counter(); print(t1 - t0, t2 - t1)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    module_s, runtime_s = (float(x) for x in result.stdout.split())
+
+    print("冷启动耗时")
+    print(f"  应答 initialize（含解释器启动）  {initialize_ms:8.1f} ms")
+    print(f"  import mcp_server                {module_s * 1000:8.1f} ms")
+    print(f"  load_runtime()（后台线程）       {runtime_s * 1000:8.1f} ms")
+    print()
+    print("导入耗时最多的模块（-X importtime，单位 ms）")
+    print(f"  {'self':>8}  {'cumulative':>10}  module")
+    entries = [e for e in _parse_importtime(result.stderr) if e[2] <= 1]
+    for self_us, cumulative_us, depth, name in sorted(entries, key=lambda e: -e[1])[:limit]:
+        print(f"  {self_us / 1000:8.1f}  {cumulative_us / 1000:10.1f}  {'  ' * depth}{name}")
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    """命令行入口（nano-banana-mcp）：按参数选择 stdio、SSE 或 Streamable HTTP"""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="nano-banana-mcp", description="NanoBanana MCP Server")
+    parser.add_argument(
+        "--transport",
+        choices=["stdio", "sse", "streamable-http"],
+        default=os.getenv("NANO_BANANA_TRANSPORT", "stdio"),
+        help="传输方式（默认: stdio）",
+    )
+    parser.add_argument(
+        "--host",
+        default=os.getenv("NANO_BANANA_HOST", "127.0.0.1"),
+        help="网络模式监听地址（默认: 127.0.0.1）",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=_env_int("NANO_BANANA_PORT", 8000),
+        help="网络模式监听端口（默认: 8000）",
+    )
+    parser.add_argument(
+        "--import-profile",
+        action="store_true",
+        help="测量冷启动耗时并打印最慢的导入模块（-X importtime），然后退出",
+    )
+    args = parser.parse_args(argv)
+
+    if args.import_profile:
+        print_import_profile()
+    elif args.transport == "stdio":
+        # 先由前端应答握手，mcp 在后台线程中导入
+        prelude = _stdio_prelude()
+        if prelude is not None:
+            asyncio.run(serve_stdio(prelude))
+    else:
+        asyncio.run(serve_http(args.transport, args.host, args.port))
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
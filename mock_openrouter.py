@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+本地 OpenRouter 模拟服务，用于离线测试和基准测试
+
+支持配置延迟分布、错误率和图像大小，提供 /chat/completions（含 SSE 流式）
+和 /models（含 ETag）两个接口。
+
+用法:
+    python mock_openrouter.py --port 8765 --latency-ms 200 --image-kb 2048
+    OPENROUTER_API_URL=http://127.0.0.1:8765/api/v1 python mcp_server.py
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+@dataclass
+class MockConfig:
+    """模拟服务配置"""
+    latency_ms: float = 200.0
+    latency_dist: str = "lognormal"  # fixed | uniform | lognormal
+    latency_sigma: float = 0.5
+    error_rate: float = 0.0
+    error_status: int = 503
+    image_kb: int = 1024
+    images: int = 1
+    models: int = 300
+    stream_chunks: int = 8
+
+
+class MockOpenRouter:
+    """在后台线程中运行的模拟服务"""
+
+    def __init__(self, config: MockConfig, host: str = "127.0.0.1", port: int = 0):
+        self.config = config
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._image_url: Optional[str] = None
+        self._models_body = json.dumps({"data": _fake_models(config.models)}).encode("utf-8")
+        self._models_etag = f'"models-{config.models}"'
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/api/v1"
+
+    def image_url(self) -> str:
+        """生成一次随机图像数据并复用，避免每次请求都重新编码"""
+        if self._image_url is None:
+            data = b"\x89PNG\r\n\x1a\n" + os.urandom(self.config.image_kb * 1024)
+            self._image_url = "data:image/png;base64," + base64.b64encode(data).decode("ascii")
+        return self._image_url
+
+    def latency(self) -> float:
+        """按配置的分布抽样一次延迟（秒）"""
+        mean = self.config.latency_ms / 1000.0
+        if self.config.latency_dist == "fixed":
+            return mean
+        if self.config.latency_dist == "uniform":
+            return random.uniform(0, 2 * mean)
+        # lognormal：latency_ms 为中位数，latency_sigma 控制长尾
+        return random.lognormvariate(0, self.config.latency_sigma) * mean
+
+    def start(self) -> "MockOpenRouter":
+        self.image_url()
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle_one_request(self):
+                try:
+                    super().handle_one_request()
+                except (BrokenPipeError, ConnectionResetError):
+                    # 客户端已放弃请求（对冲请求被取消、批量任务超时），不必打印异常
+                    self.close_connection = True
+
+            def _send_json(self, status: int, body: bytes, headers: Optional[dict] = None):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if not self.path.endswith("/models"):
+                    self._send_json(404, b'{"error": "not found"}')
+                    return
+                if self.headers.get("If-None-Match") == mock._models_etag:
+                    self.send_response(304)
+                    self.send_header("ETag", mock._models_etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self._send_json(200, mock._models_body, {"ETag": mock._models_etag})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                with mock._lock:
+                    mock.requests += 1
+
+                if not self.path.endswith("/chat/completions"):
+                    self._send_json(404, b'{"error": "not found"}')
+                    return
+                if random.random() < mock.config.error_rate:
+                    time.sleep(mock.latency() / 4)
+                    self._send_json(
+                        mock.config.error_status,
+                        json.dumps({"error": {"message": "mock upstream error"}}).encode(),
+                        {"Retry-After": "0"},
+                    )
+                    return
+
+                if payload.get("stream"):
+                    self._stream(payload)
+                else:
+                    time.sleep(mock.latency())
+                    self._send_json(200, json.dumps(_completion(payload, mock)).encode("utf-8"))
+
+            def _write_chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+            def _stream(self, payload: dict):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                chunks = max(1, mock.config.stream_chunks)
+                delay = mock.latency() / chunks
+                text = _reply_text(payload)
+                step = max(1, len(text) // chunks)
+                for start in range(0, len(text), step):
+                    time.sleep(delay)
+                    event = {"model": payload.get("model"), "choices": [{"delta": {"content": text[start:start + step]}}]}
+                    self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+                final = {
+                    "choices": [{
+                        "delta": {"images": _images(mock)} if mock.config.images else {},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": _usage(payload, mock),
+                }
+                self._write_chunk(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+                self._write_chunk(b"data: [DONE]\n\n")
+                self._write_chunk(b"")
+
+        return Handler
+
+
+def _reply_text(payload: dict) -> str:
+    messages = payload.get("messages") or [{}]
+    prompt = messages[-1].get("content", "")
+    if not isinstance(prompt, str):
+        prompt = "image request"
+    return f"Here is the generated image for: {prompt[:200]}"
+
+
+def _images(mock: MockOpenRouter) -> list[dict]:
+    return [
+        {"type": "image_url", "image_url": {"url": mock.image_url()}}
+        for _ in range(mock.config.images)
+    ]
+
+
+def _usage(payload: dict, mock: MockOpenRouter) -> dict:
+    # 与 Gemini 图像模型接近：每张图像约 1290 个输出 token
+    prompt_tokens = len(json.dumps(payload.get("messages", []))) // 4
+    completion_tokens = 1290 * mock.config.images + 50
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _completion(payload: dict, mock: MockOpenRouter) -> dict:
+    message = {"role": "assistant", "content": _reply_text(payload)}
+    images = _images(mock)
+    if images:
+        message["images"] = images
+    return {
+        "id": f"gen-mock-{mock.requests}",
+        "model": payload.get("model"),
+        "choices": [{"message": message, "finish_reason": "stop"}],
+        "usage": _usage(payload, mock),
+    }
+
+
+def _fake_models(count: int) -> list[dict]:
+    providers = ["google", "openai", "anthropic", "meta-llama", "mistralai"]
+    models = []
+    for i in range(count):
+        provider = providers[i % len(providers)]
+        image = i % 7 == 0
+        models.append({
+            "id": f"{provider}/mock-model-{i}",
+            "name": f"Mock Model {i}",
+            "description": "Synthetic model entry used for offline benchmarks. " * 8,
+            "context_length": 32768,
+            "architecture": {
+                "input_modalities": ["text", "image"],
+                "output_modalities": ["image", "text"] if image else ["text"],
+            },
+            "pricing": {"prompt": "0.000001", "completion": "0.000004"},
+        })
+    return models
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """注册模拟服务的命令行参数（benchmark.py 复用）"""
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="延迟中位数/均值（毫秒）")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="lognormal 分布的 sigma")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误的概率 (0-1)")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--image-kb", type=int, default=1024, help="每张图像解码后的大小（KB）")
+    parser.add_argument("--images", type=int, default=1, help="每个响应包含的图像数量")
+    parser.add_argument("--models", type=int, default=300, help="/models 返回的模型数量")
+    parser.add_argument("--stream-chunks", type=int, default=8, help="SSE 流式响应拆分的文本块数")
+
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(
+        latency_ms=args.latency_ms,
+        latency_dist=args.latency_dist,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        image_kb=args.image_kb,
+        images=args.images,
+        models=args.models,
+        stream_chunks=args.stream_chunks,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 OpenRouter 模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    mock = MockOpenRouter(config_from_args(args), args.host, args.port)
+    print(f"🧪 模拟 OpenRouter 已启动: {mock.url}")
+    print(f"   设置 OPENROUTER_API_URL={mock.url} 后启动 mcp_server.py")
+    mock.image_url()
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n已停止")
+
+
+if __name__ == "__main__":
+    main()
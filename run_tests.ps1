@@ -48,10 +48,11 @@ Write-Host "========================================" -ForegroundColor Cyan
 Write-Host "1. 基础功能测试 (test_mcp.py)"
 Write-Host "2. Gemini 图像生成测试 (test_gemini_image.py)"
 Write-Host "3. 全部测试"
+Write-Host "4. 离线基准测试 (benchmark.py，无需 API Key)"
 Write-Host "0. 退出"
 Write-Host ""
 
-$choice = Read-Host "请输入选项 (0-3)"
+$choice = Read-Host "请输入选项 (0-4)"
 
 switch ($choice) {
     "1" {
@@ -74,6 +75,11 @@ switch ($choice) {
         Write-Host ">>> 测试 2/2: Gemini 图像生成" -ForegroundColor Yellow
         python test_gemini_image.py
     }
+    "4" {
+        Write-Host ""
+        Write-Host "运行离线基准测试..." -ForegroundColor Green
+        python benchmark.py
+    }
     "0" {
         Write-Host "退出测试" -ForegroundColor Yellow
         exit 0
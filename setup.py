@@ -33,6 +33,10 @@ setup(
     ],
     python_requires=">=3.10",
     install_requires=requirements,
+    extras_require={
+        "http2": ["httpx[http2]"],
+        "images": ["Pillow"],
+    },
     entry_points={
         "console_scripts": [
             "nano-banana-mcp=mcp_server:main",
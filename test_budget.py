@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+测试预算账本的预留、结算、退回和降级（离线，无需 API Key）
+
+    python -m pytest -q test_budget.py
+"""
+
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import mcp_server
+from mcp_server import BudgetExceededError, BudgetLedger
+
+USAGE = {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150, "cost": 0.01}
+
+
+def _payload(model: str = "m", **extra) -> dict:
+    return {"model": model, "messages": [{"role": "user", "content": "x" * 400}], **extra}
+
+
+def test_record_accumulates_every_scope_and_reports_remaining():
+    ledger = BudgetLedger({"global": {"cost": 1}, "key:*": {"requests": 10}}, 0, {})
+    ledger.record("m", "s1", "key-1", USAGE, images=2)
+    ledger.record("m", "s2", "key-1", USAGE, images=1)
+
+    stats = ledger.stats()
+    assert stats["global"]["requests"] == 2
+    assert stats["global"]["images"] == 3
+    assert stats["global"]["remaining"] == {"cost": 0.98}
+    assert stats["sessions"]["s1"]["tokens"] == 150
+    assert stats["keys"]["key-1"]["remaining"] == {"requests": 8}
+
+
+def test_reservations_count_toward_admission_until_refunded():
+    ledger = BudgetLedger({"global": {"requests": 2}}, 0, {})
+    first = ledger.reserve(_payload(), "s")
+    second = ledger.reserve(_payload(), "s")
+    # 两个请求仍在途时，第三个请求看到的是已预留的用量
+    with pytest.raises(BudgetExceededError):
+        ledger.admit(_payload(), "s")
+    assert ledger.stats()["in_flight"] == 2
+
+    ledger.refund(first)
+    ledger.refund(first)  # 重复退回无影响
+    assert ledger.admit(_payload(), "s") is None
+    ledger.refund(second)
+    assert ledger.reserved == {}
+
+
+def test_settled_request_is_charged_its_actual_usage():
+    ledger = BudgetLedger({"session:*": {"tokens": 1000}}, 0, {})
+    payload = _payload(max_tokens=800)
+    reservation = ledger.reserve(payload, "s")
+    # 预留按提示词估算加上 max_tokens，与限速的预估一致
+    assert ledger.reserved[("session", "s")]["tokens"] == mcp_server._estimate_tokens(payload)
+    ledger.record("m", "s", "key-1", USAGE, images=0)
+    ledger.refund(reservation)
+    assert ledger.stats()["sessions"]["s"]["remaining"] == {"tokens": 850}
+
+
+def test_soft_limit_downgrades_model_and_max_tokens():
+    ledger = BudgetLedger(
+        {"model:big": {"cost": 0.02, "downgrade_at": 0.5, "fallback_model": "small", "max_tokens": 256}}, 0, {}
+    )
+    ledger.record("big", "s", "key-1", USAGE, images=0)
+    payload = _payload("big", max_tokens=4096)
+    downgrade = ledger.admit(payload, "s")
+    assert (payload["model"], payload["max_tokens"]) == ("small", 256)
+    assert downgrade["original_model"] == "big"
+
+
+def _serve(monkeypatch, budgets: dict, handler) -> BudgetLedger:
+    ledger = BudgetLedger(budgets, 0, {})
+    monkeypatch.setattr(mcp_server, "budget_ledger", ledger)
+    monkeypatch.setattr(mcp_server, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return ledger
+
+
+async def _chat(prompt: str) -> dict:
+    arguments = {"messages": [{"role": "user", "content": prompt}], "cache": "off", "coalesce": False}
+    contents = await mcp_server.call_tool("chat_completion", arguments)
+    return json.loads(contents[0].text)
+
+
+def test_concurrent_requests_cannot_overshoot_the_budget(monkeypatch):
+    async def handler(request):
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"choices": [{"message": {"content": "ok"}}], "usage": USAGE})
+
+    ledger = _serve(monkeypatch, {"global": {"requests": 2}}, handler)
+
+    async def run():
+        return await asyncio.gather(*(_chat(f"prompt {i}") for i in range(3)))
+
+    results = asyncio.run(run())
+    assert sum("Budget exhausted" in (r.get("error") or "") for r in results) == 1
+    assert ledger.stats()["global"]["requests"] == 2
+    assert ledger.reserved == {}
+
+
+def test_failed_request_is_refunded(monkeypatch):
+    def handler(request):
+        return httpx.Response(400, json={"error": {"message": "bad request"}})
+
+    ledger = _serve(monkeypatch, {"global": {"requests": 1}}, handler)
+    assert "HTTP error: 400" in asyncio.run(_chat("fails"))["error"]
+    assert ledger.reserved == {}
+    assert ledger.admit(_payload(), "s") is None
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+测试响应缓存的 TTL 过期和 LRU 淘汰（离线，无需 API Key）
+
+    python -m pytest -q test_cache.py
+"""
+
+import base64
+import os
+import time
+
+from mcp_server import ResponseCache
+
+
+def _result(*images: bytes) -> dict:
+    urls = ["data:image/png;base64," + base64.b64encode(image).decode("ascii") for image in images]
+    return {"choices": [{"message": {"content": "ok", "images": [{"image_url": {"url": url}} for url in urls]}}]}
+
+
+def _age(cache: ResponseCache, key: str, seconds_ago: float) -> None:
+    """把条目在磁盘上的访问时间设为若干秒之前（重启后据此重建 LRU 顺序），避免依赖文件系统的时间精度"""
+    when = time.time() - seconds_ago
+    os.utime(cache._entry_path(key), (when, when))
+
+
+def test_put_stores_image_as_blob_and_get_returns_file(tmp_path):
+    cache = ResponseCache(str(tmp_path), 10 * 1024 * 1024, 3600)
+    image = os.urandom(1000)
+    stored = cache.put("k", _result(image))
+    image_url = stored["choices"][0]["message"]["images"][0]["image_url"]
+    with open(image_url["file"], "rb") as f:
+        assert f.read() == image
+    assert cache.get("k")["choices"][0]["message"]["images"][0]["image_url"]["size"] == len(image)
+    assert cache.get("missing") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_evict_removes_least_recently_used_entries_and_their_blobs(tmp_path):
+    images = [os.urandom(40_000) for _ in range(3)]
+    # 容量只够两个条目
+    cache = ResponseCache(str(tmp_path), 100_000, 3600)
+    for i, image in enumerate(images):
+        cache.put(f"k{i}", _result(image))
+
+    # 三个条目写入过程中已淘汰最早的 k0；访问 k1 后它比 k2 新
+    assert cache.get("k0") is None
+    assert cache.get("k1") is not None
+    cache.put("k3", _result(os.urandom(40_000)))
+
+    assert cache.get("k2") is None
+    assert cache.get("k1") is not None
+    assert cache.get("k3") is not None
+    assert len(os.listdir(cache.blobs_dir)) == 2
+
+
+def test_evict_keeps_blobs_shared_with_remaining_entries(tmp_path):
+    shared = os.urandom(40_000)
+    cache = ResponseCache(str(tmp_path), 90_000, 3600)
+    cache.put("old", _result(shared, os.urandom(40_000)))
+    cache.put("new", _result(shared))
+    cache.put("other", _result(os.urandom(40_000)))
+
+    # old 被淘汰，只删除它独有的 blob，共用的 blob 仍被 new 引用
+    assert cache.get("old") is None
+    assert cache.get("other") is not None
+    assert len(os.listdir(cache.blobs_dir)) == 2
+    image_url = cache.get("new")["choices"][0]["message"]["images"][0]["image_url"]
+    with open(image_url["file"], "rb") as f:
+        assert f.read() == shared
+
+
+def test_evict_drops_expired_entries_and_orphan_blobs_but_not_partial_writes(tmp_path):
+    cache = ResponseCache(str(tmp_path), 10 * 1024 * 1024, 60)
+    cache.put("k", _result(os.urandom(1000)))
+    partial = os.path.join(cache.blobs_dir, "tmp_in_progress")
+    with open(partial, "wb") as f:
+        f.write(b"x")
+
+    cache.ttl = 0
+    time.sleep(0.01)
+    cache.evict()
+
+    assert os.listdir(cache.entries_dir) == []
+    assert os.listdir(cache.blobs_dir) == ["tmp_in_progress"]
+    assert cache.evictions == 1
+
+
+def test_index_is_rebuilt_from_disk_once_and_then_maintained_in_memory(tmp_path, monkeypatch):
+    first = ResponseCache(str(tmp_path), 100_000, 3600)
+    first.put("old", _result(os.urandom(40_000)))
+    first.put("recent", _result(os.urandom(40_000)))
+    _age(first, "old", 100)
+    _age(first, "recent", 50)
+
+    # 重启后按磁盘上的访问时间重建顺序，之后的写入不再扫描目录
+    cache = ResponseCache(str(tmp_path), 100_000, 3600)
+    assert cache.get("old") is not None
+    cache.put("new", _result(os.urandom(1000)))
+    monkeypatch.setattr(cache, "_scan", None)
+    cache.put("newer", _result(os.urandom(40_000)))
+
+    assert cache.get("recent") is None
+    assert cache.get("old") is not None
+    assert cache.get("newer") is not None
+
+
+def test_entry_removed_during_lookup_is_a_miss(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path), 10 * 1024 * 1024, 3600)
+    cache.put("k", _result(os.urandom(1000)))
+    real_utime = os.utime
+
+    def evicted_concurrently(path, *args, **kwargs):
+        # 模拟另一个线程在读取条目后、刷新访问时间前淘汰了它
+        os.remove(path)
+        return real_utime(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, "utime", evicted_concurrently)
+    assert cache.get("k") is None
+    assert cache.misses == 1
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+测试相同在途请求的合并和调用方取消（离线，无需 API Key）
+
+    python -m pytest -q test_coalescing.py
+"""
+
+import asyncio
+
+import pytest
+
+import mcp_server
+from mcp_server import _fetch_completion
+
+PAYLOAD = {"model": "m", "messages": [{"role": "user", "content": "same"}]}
+
+
+class _Upstream:
+    """替代 _fetch_upstream：等待 release 后返回结果，记录调用次数和是否被取消"""
+
+    def __init__(self):
+        self.calls = 0
+        self.cancelled = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self, payload, *args):
+        self.calls += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return {"choices": [{"message": {"content": "shared"}}]}, {"queue_wait_seconds": 0.0}
+
+
+def _run(scenario):
+    async def run():
+        upstream = _Upstream()
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr(mcp_server, "_fetch_upstream", upstream)
+            await scenario(upstream)
+        assert mcp_server._inflight == {}
+        return upstream
+
+    return asyncio.run(run())
+
+
+async def _start(n: int) -> list[asyncio.Task]:
+    tasks = [asyncio.ensure_future(_fetch_completion(PAYLOAD, "off")) for _ in range(n)]
+    await asyncio.sleep(0)
+    return tasks
+
+
+def test_identical_requests_share_one_upstream_call():
+    async def scenario(upstream):
+        tasks = await _start(3)
+        upstream.release.set()
+        results = await asyncio.gather(*tasks)
+        assert [meta.get("coalesced", False) for _, meta in results] == [False, True, True]
+        # 每个调用方拿到各自的副本
+        results[0][0]["choices"][0]["message"]["content"] = "changed"
+        assert results[1][0]["choices"][0]["message"]["content"] == "shared"
+
+    assert _run(scenario).calls == 1
+
+
+def test_cancelled_follower_does_not_affect_the_others():
+    async def scenario(upstream):
+        leader, follower = await _start(2)
+        follower.cancel()
+        await asyncio.sleep(0)
+        upstream.release.set()
+        result, meta = await leader
+        assert result["choices"][0]["message"]["content"] == "shared"
+        assert follower.cancelled()
+
+    upstream = _run(scenario)
+    assert (upstream.calls, upstream.cancelled) == (1, 0)
+
+
+def test_cancelled_leader_keeps_the_request_for_followers():
+    async def scenario(upstream):
+        leader, follower = await _start(2)
+        leader.cancel()
+        await asyncio.sleep(0)
+        upstream.release.set()
+        result, meta = await follower
+        assert meta["coalesced"] is True
+
+    upstream = _run(scenario)
+    assert (upstream.calls, upstream.cancelled) == (1, 0)
+
+
+def test_upstream_request_is_cancelled_when_every_caller_gives_up():
+    async def scenario(upstream):
+        tasks = await _start(3)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    upstream = _run(scenario)
+    assert (upstream.calls, upstream.cancelled) == (1, 1)
+
+
+def test_coalesce_false_sends_every_request():
+    async def scenario(upstream):
+        tasks = [asyncio.ensure_future(_fetch_completion(PAYLOAD, "off", coalesce=False)) for _ in range(2)]
+        await asyncio.sleep(0)
+        upstream.release.set()
+        await asyncio.gather(*tasks)
+
+    assert _run(scenario).calls == 2
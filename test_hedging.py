@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+测试对冲请求的胜出和取消（离线，无需 API Key）
+
+    python -m pytest -q test_hedging.py
+"""
+
+import asyncio
+
+import pytest
+
+from mcp_server import HedgePolicy
+
+
+def _policy(delay: float = 0.02) -> HedgePolicy:
+    """已有足够样本的策略：主请求超过 delay 秒未完成即发出对冲"""
+    policy = HedgePolicy(percentile=0.5, budget=1.0, min_samples=1, min_delay=delay, window=10)
+    policy.observe("m", delay)
+    return policy
+
+
+class _Legs:
+    """按调用顺序为每个请求指定耗时，记录完成、取消和被丢弃的请求
+
+    stubborn 中的请求被取消时仍返回结果，模拟取消前响应已经收完的情况。
+    """
+
+    def __init__(self, *durations: float, stubborn: tuple = ()):
+        self.durations = list(durations)
+        self.stubborn = stubborn
+        self.started = 0
+        self.cancelled: list[int] = []
+        self.discarded: list[str] = []
+
+    async def leg(self, tried):
+        index = self.started
+        self.started += 1
+        try:
+            await asyncio.sleep(self.durations[index])
+        except asyncio.CancelledError:
+            self.cancelled.append(index)
+            if index not in self.stubborn:
+                raise
+        return f"leg-{index}", None
+
+    def discard(self, value):
+        self.discarded.append(value[0])
+
+
+def test_fast_hedge_wins_and_slow_primary_is_cancelled():
+    policy = _policy()
+    legs = _Legs(1.0, 0.01)
+    value = asyncio.run(policy.run("m", legs.leg, True, legs.discard))
+    assert value[0] == "leg-1"
+    assert legs.cancelled == [0]
+    assert (policy.hedges, policy.wins) == (1, 1)
+
+
+def test_loser_that_finished_is_discarded():
+    policy = _policy()
+    legs = _Legs(1.0, 0.01, stubborn=(0,))
+    value = asyncio.run(policy.run("m", legs.leg, True, legs.discard))
+    assert value[0] == "leg-1"
+    assert legs.discarded == ["leg-0"]
+
+
+def test_fast_primary_does_not_hedge():
+    policy = _policy(delay=0.2)
+    legs = _Legs(0.01)
+    assert asyncio.run(policy.run("m", legs.leg, True, legs.discard))[0] == "leg-0"
+    assert legs.started == 1
+    assert policy.hedges == 0
+
+
+@pytest.mark.parametrize("cancel_after", [0.01, 0.05])
+def test_caller_cancellation_cancels_every_leg(cancel_after):
+    """在对冲发出前（0.01 s）和发出后（0.05 s）取消调用方，所有请求都被取消"""
+    policy = _policy()
+    legs = _Legs(1.0, 1.0)
+
+    async def run():
+        task = asyncio.ensure_future(policy.run("m", legs.leg, True, legs.discard))
+        await asyncio.sleep(cancel_after)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # 取消返回时请求已经结束，而不是仍在后台运行
+        return [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+
+    leftover = asyncio.run(run())
+    assert leftover == []
+    assert sorted(legs.cancelled) == list(range(legs.started))
+    assert legs.started == (1 if cancel_after < 0.02 else 2)
+
+
+@pytest.mark.parametrize("cancel_after", [0.01, 0.05])
+def test_caller_cancellation_discards_legs_that_finished_anyway(cancel_after):
+    policy = _policy()
+    legs = _Legs(1.0, 1.0, stubborn=(0, 1))
+
+    async def run():
+        task = asyncio.ensure_future(policy.run("m", legs.leg, True, legs.discard))
+        await asyncio.sleep(cancel_after)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert sorted(legs.discarded) == [f"leg-{i}" for i in range(legs.started)]
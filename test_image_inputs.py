@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+测试输入图像：本地文件、image_ref 引用和多候选结果的引用（离线，无需 API Key）
+
+    python -m pytest -q test_image_inputs.py
+"""
+
+import asyncio
+import base64
+import io
+import json
+
+import httpx
+import pytest
+from PIL import Image
+
+import mcp_server
+
+
+def _png(color: tuple, size: tuple = (64, 64)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class _Upstream:
+    """每次请求返回一张颜色不同的图像，记录发给上游的请求体"""
+
+    def __init__(self):
+        self.sent: list[dict] = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.sent.append(json.loads(request.content))
+        image = _png((len(self.sent) * 40 % 256, 0, 0))
+        url = "data:image/png;base64," + base64.b64encode(image).decode("ascii")
+        return httpx.Response(200, json={
+            "id": f"gen-up{len(self.sent)}",
+            "choices": [{"message": {"content": "ok", "images": [{"image_url": {"url": url}}]}}],
+        })
+
+    def image_parts(self) -> list[dict]:
+        """最近一次请求中发给上游的图像内容"""
+        content = self.sent[-1]["messages"][0]["content"]
+        return [part for part in content if part.get("type") == "image_url"]
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    handler = _Upstream()
+    monkeypatch.setattr(mcp_server, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    yield handler
+    mcp_server.close_image_pool()
+
+
+def _call(tmp_path, parts: list, **extra) -> dict:
+    arguments = {
+        "messages": [{"role": "user", "content": parts}],
+        "cache": "off",
+        "coalesce": False,
+        "output": "file",
+        "output_dir": str(tmp_path),
+        **extra,
+    }
+    contents = asyncio.run(mcp_server.call_tool("chat_completion", arguments))
+    return json.loads(contents[0].text)
+
+
+def _decoded(part: dict) -> Image.Image:
+    return Image.open(io.BytesIO(base64.b64decode(part["image_url"]["url"].split(",", 1)[1])))
+
+
+def test_image_file_is_resized_and_sent_as_data_url(tmp_path, upstream):
+    path = tmp_path / "input.png"
+    path.write_bytes(_png((0, 200, 0), (2048, 1024)))
+    data = _call(tmp_path, [{"type": "text", "text": "edit"}, {"type": "image_file", "path": str(path), "max_size": 512}])
+
+    assert "error" not in data
+    (part,) = upstream.image_parts()
+    assert part["image_url"]["url"].startswith("data:image/png;base64,")
+    assert _decoded(part).size == (512, 256)
+
+
+def test_image_ref_sends_an_earlier_generation(tmp_path, upstream):
+    first = _call(tmp_path, [{"type": "text", "text": "draw"}])
+    _call(tmp_path, [{"type": "image_ref", "ref": first["generation_id"]}])
+
+    with open(first["images"][0]["path"], "rb") as f:
+        saved = f.read()
+    assert base64.b64decode(upstream.image_parts()[0]["image_url"]["url"].split(",", 1)[1]) == saved
+
+
+def test_image_ref_errors_are_reported(tmp_path, upstream):
+    first = _call(tmp_path, [{"type": "text", "text": "draw"}])
+    assert "Unknown generation" in _call(tmp_path, [{"type": "image_ref", "ref": "gen-missing"}])["error"]
+    assert "out of range" in _call(tmp_path, [{"type": "image_ref", "ref": first["generation_id"], "index": 3}])["error"]
+    assert "not found" in _call(tmp_path, [{"type": "image_file", "path": str(tmp_path / "missing.png")}])["error"]
+
+
+def test_image_ref_to_a_candidate_of_an_n_greater_than_one_result(tmp_path, upstream):
+    result = _call(tmp_path, [{"type": "text", "text": "draw"}], n=2)
+    assert result["succeeded"] == 2
+    saved = {}
+    for candidate in result["candidates"]:
+        with open(candidate["images"][0]["path"], "rb") as f:
+            saved[candidate["index"]] = f.read()
+
+    def sent_after(ref: dict) -> bytes:
+        _call(tmp_path, [ref])
+        return base64.b64decode(upstream.image_parts()[0]["image_url"]["url"].split(",", 1)[1])
+
+    generation_id = result["generation_id"]
+    assert sent_after({"type": "image_ref", "ref": f"{generation_id}#1"}) == saved[1]
+    # 不带 #k 时所有候选的图像按候选顺序编号
+    assert sent_after({"type": "image_ref", "ref": generation_id, "index": 1}) == saved[1]
+    assert sent_after({"type": "image_ref", "ref": generation_id, "index": 0}) == saved[0]
+
+
+def test_image_ref_to_a_candidate_of_a_background_job(tmp_path, upstream, monkeypatch):
+    result = _call(tmp_path, [{"type": "text", "text": "draw"}], n=2)
+    job = mcp_server.Job({}, None, "job-candidates")
+    job.update("succeeded", result=result)
+    monkeypatch.setitem(mcp_server.job_manager.jobs, job.id, job)
+    with open(result["candidates"][1]["images"][0]["path"], "rb") as f:
+        second = f.read()
+
+    assert "error" not in _call(tmp_path, [{"type": "image_ref", "ref": "job-candidates#1"}])
+    assert base64.b64decode(upstream.image_parts()[0]["image_url"]["url"].split(",", 1)[1]) == second
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+测试后台任务表在重启后的恢复（离线，无需 API Key）
+
+    python -m pytest -q test_jobs.py
+"""
+
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from mcp_server import Job, JobManager, JobStore, _process_start
+
+
+def _dead_pid() -> int:
+    """返回一个已经退出的进程号"""
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+def _record(job_id: str, status: str, owner: int, attempts: int = 0, owner_start=None) -> dict:
+    job = Job({"prompt": job_id}, None, job_id)
+    job.status = status
+    job.owner = owner
+    job.owner_start = owner_start if owner_start is not None else _process_start(owner)
+    job.attempts = attempts
+    if status == "succeeded":
+        job.result = {"content": "done"}
+        job.finished_at = time.time()
+    return job.to_record()
+
+
+def _restore(path: str, inspect=None) -> tuple[dict, dict]:
+    """在事件循环中恢复任务表，worker 开始执行前即关闭，返回统计和数据库中的状态
+
+    inspect(manager) 在关闭前调用，用于检查恢复后的内存状态。
+    """
+    async def run():
+        manager = JobManager(workers=1, ttl=3600, store=JobStore(path), max_attempts=2)
+        counts = manager.restore()
+        if inspect is not None:
+            inspect(manager)
+        await manager.shutdown()
+        return counts
+
+    counts = asyncio.run(run())
+    store = JobStore(path)
+    try:
+        return counts, {record["id"]: record for record in store.load_all()}
+    finally:
+        store.close()
+
+
+def test_restore_resumes_interrupted_jobs_and_keeps_results(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    dead = _dead_pid()
+    store = JobStore(path)
+    for record in [
+        _record("finished", "succeeded", dead),
+        _record("queued", "queued", dead),
+        _record("crashed-once", "running", dead, attempts=1),
+        _record("crashed-twice", "running", dead, attempts=2),
+    ]:
+        store.save(record)
+    store.close()
+
+    counts, records = _restore(path)
+
+    assert counts["resumed"] == 2
+    assert records["finished"]["status"] == "succeeded"
+    assert records["finished"]["result"] == {"content": "done"}
+    assert records["queued"]["status"] == "queued"
+    assert records["crashed-once"]["status"] == "queued"
+    assert records["crashed-once"]["owner"] == os.getpid()
+    assert records["crashed-twice"]["status"] == "failed"
+    assert "not retried" in records["crashed-twice"]["error"]["error"]
+
+
+def test_restore_leaves_jobs_of_a_live_server_alone(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    other = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        store = JobStore(path)
+        store.save(_record("theirs", "running", other.pid, attempts=1))
+        store.save(_record("their-queue", "queued", other.pid))
+        store.close()
+
+        def inspect(manager):
+            # 其它进程的任务同样可以查询，但不能在本进程中取消
+            assert manager.get("theirs").status == "running"
+            assert not manager.owns(manager.jobs["their-queue"])
+            with pytest.raises(ValueError):
+                manager.cancel("theirs")
+
+        counts, records = _restore(path, inspect)
+    finally:
+        other.kill()
+        other.wait()
+
+    assert counts.get("resumed", 0) == 0
+    assert records["theirs"]["status"] == "running"
+    assert records["theirs"]["owner"] == other.pid
+    assert records["their-queue"]["owner"] == other.pid
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="进程启动标识取自 /proc")
+def test_restore_takes_over_jobs_whose_pid_was_reused(tmp_path):
+    """进程号仍存活但启动标识不同（如重启后被其它进程复用）时视为原进程已退出"""
+    path = str(tmp_path / "jobs.sqlite3")
+    other = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        store = JobStore(path)
+        store.save(_record("reused", "queued", other.pid, owner_start="old-boot:123"))
+        store.close()
+        counts, records = _restore(path)
+    finally:
+        other.kill()
+        other.wait()
+
+    assert counts["resumed"] == 1
+    assert records["reused"]["owner"] == os.getpid()
+    assert records["reused"]["owner_start"] == _process_start(os.getpid())
+
+
+def test_claim_is_compare_and_swap(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    record = _record("contended", "queued", _dead_pid())
+    store.save(record)
+    # 两个同时重启的进程基于同一条旧记录接管，只有先到的成功
+    assert store.claim(record, 1001, "a") is True
+    assert store.claim(record, 1002, "b") is False
+    assert store.load("contended")["owner"] == 1001
+    store.close()
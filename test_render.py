@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+测试工具结果的序列化：字段投影、图像提取和截断（离线，无需 API Key）
+
+    python -m pytest -q test_render.py
+"""
+
+import base64
+import json
+
+from mcp_server import render_result
+
+IMAGE = base64.b64encode(b"\x89PNG\r\n\x1a\n" + b"\0" * 100).decode("ascii")
+
+
+def _result() -> dict:
+    return {
+        "content": "a cat",
+        "images": [{"url": f"data:image/png;base64,{IMAGE}", "format": "png"}],
+        "usage": {"total_tokens": 42},
+    }
+
+
+def test_images_become_image_content_with_index():
+    text, image = render_result(_result(), {})
+    data = json.loads(text.text)
+    assert data["images"] == [{"format": "png", "content_index": 1}]
+    assert (image.type, image.mimeType, image.data) == ("image", "image/png", IMAGE)
+
+
+def test_fields_are_projected_before_images_are_extracted():
+    contents = render_result(_result(), {"fields": ["content", "usage.total_tokens"]})
+    # 未选中 images 时不返回图像内容
+    assert len(contents) == 1
+    assert json.loads(contents[0].text) == {"content": "a cat", "usage.total_tokens": 42}
+
+    contents = render_result(_result(), {"fields": ["images"]})
+    assert len(contents) == 2
+    assert json.loads(contents[0].text) == {"images": [{"format": "png", "content_index": 1}]}
+
+
+def test_long_fields_are_truncated_with_a_link_to_the_full_result():
+    data = json.loads(render_result({"content": "x" * 500}, {"max_field_chars": 100})[0].text)
+    assert data["content"].endswith("[truncated 400 chars]")
+    assert data["full_result"].startswith("nano-banana://")
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+测试重试和熔断（离线，无需 API Key）
+
+    python -m pytest -q test_resilience.py
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+import mcp_server
+from mcp_server import CircuitOpenError, execute_request, get_breaker
+
+
+def _status_error(status: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "http://upstream/chat/completions")
+    response = httpx.Response(status, request=request, headers={"Retry-After": "0"})
+    return httpx.HTTPStatusError(f"HTTP {status}", request=request, response=response)
+
+
+def _open_breaker(key: str):
+    breaker = get_breaker(key)
+    breaker.failure_threshold = 1
+    breaker.reset_timeout = 0.05
+
+    async def fail():
+        raise _status_error(503)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(execute_request(key, fail))
+    assert breaker.state == "open"
+    return breaker
+
+
+async def _ok():
+    return "ok"
+
+
+def test_retries_transient_errors_then_succeeds(monkeypatch):
+    monkeypatch.setattr(mcp_server, "RETRY_BASE_DELAY", 0.001)
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise _status_error(503)
+        return "ok"
+
+    value, info = asyncio.run(execute_request("retry-model", flaky))
+    assert value == "ok"
+    assert info == {"retries": 2, "circuit": "closed"}
+
+
+def test_client_errors_are_not_retried():
+    calls = []
+
+    async def bad_request():
+        calls.append(1)
+        raise _status_error(400)
+
+    with pytest.raises(httpx.HTTPStatusError) as excinfo:
+        asyncio.run(execute_request("client-error-model", bad_request))
+    assert len(calls) == 1
+    assert excinfo.value.retry_info["retries"] == 0
+
+
+def test_open_breaker_fails_fast_and_recovers_after_probe():
+    breaker = _open_breaker("breaker-model")
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(execute_request("breaker-model", _ok))
+
+    asyncio.run(asyncio.sleep(0.06))
+    assert asyncio.run(execute_request("breaker-model", _ok))[0] == "ok"
+    assert breaker.state == "closed"
+
+
+def test_cancelled_probe_does_not_wedge_the_breaker():
+    breaker = _open_breaker("cancelled-probe-model")
+
+    async def cancel_probe():
+        await asyncio.sleep(0.06)
+        probe = asyncio.ensure_future(execute_request("cancelled-probe-model", asyncio.Event().wait))
+        await asyncio.sleep(0.01)
+        assert breaker.state == "half_open"
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+    asyncio.run(cancel_probe())
+    # 被取消的探测按失败处理：熔断重新打开，冷却后下一个请求可以通过
+    assert breaker.state == "open"
+    asyncio.run(asyncio.sleep(0.06))
+    assert asyncio.run(execute_request("cancelled-probe-model", _ok))[0] == "ok"
+    assert breaker.state == "closed"
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+测试多后端路由：按延迟选择、模型映射和 OpenAI 兼容后端的响应整理（离线，无需 API Key）
+
+    python -m pytest -q test_routing.py
+"""
+
+import pytest
+
+import mcp_server
+from mcp_server import OpenAICompatibleUpstream, Upstream, UpstreamPool
+
+
+def _observed(name: str, seconds: float, failures: int = 0, samples: int = 20, **kwargs) -> Upstream:
+    upstream = Upstream(name, "http://upstream", f"key-{name}", **kwargs)
+    for i in range(samples):
+        upstream.observe("m", seconds, i < failures)
+    return upstream
+
+
+def test_latency_strategy_prefers_the_fastest_upstream(monkeypatch):
+    monkeypatch.setattr(mcp_server, "ROUTER_EXPLORE", 0.0)
+    pool = UpstreamPool([_observed("slow", 2.0), _observed("fast", 0.5)], "latency")
+    assert {pool.select(model="m").name for _ in range(10)} == {"fast"}
+
+
+def test_errors_outweigh_a_small_latency_advantage(monkeypatch):
+    monkeypatch.setattr(mcp_server, "ROUTER_EXPLORE", 0.0)
+    pool = UpstreamPool([_observed("flaky", 0.8, failures=10), _observed("steady", 1.0)], "latency")
+    assert pool.select(model="m").name == "steady"
+
+
+def test_upstreams_without_enough_samples_are_tried_first(monkeypatch):
+    monkeypatch.setattr(mcp_server, "ROUTER_EXPLORE", 0.0)
+    pool = UpstreamPool([_observed("known", 0.1), _observed("new", 5.0, samples=1)], "latency")
+    assert pool.select(model="m").name == "new"
+
+
+def test_weighted_strategy_follows_weights():
+    pool = UpstreamPool([
+        Upstream("heavy", "http://upstream", "k1", weight=3),
+        Upstream("light", "http://upstream", "k2", weight=1),
+    ], "weighted")
+    picks = [pool.select(model="m").name for _ in range(8)]
+    assert picks.count("heavy") == 6
+    # 平滑加权轮询不会让权重小的后端连续空等
+    assert "light" in picks[:4]
+
+
+def test_model_mapping_rewrites_the_model_name():
+    upstream = Upstream("mapped", "http://upstream", "k", models={"google/gemini": "gemini-pro"})
+    assert upstream.serves("google/gemini") and not upstream.serves("other")
+    assert upstream.prepare({"model": "google/gemini", "messages": []})["model"] == "gemini-pro"
+
+
+def test_openai_compatible_upstream_moves_images_into_message_images():
+    upstream = OpenAICompatibleUpstream("gateway", "http://gateway", "k")
+    assert "modalities" not in upstream.prepare({"model": "m", "modalities": ["image", "text"]})
+    assert "HTTP-Referer" not in upstream.request_headers()
+
+    result = upstream.normalize({"choices": [{"message": {"content": [
+        {"type": "text", "text": "a cat "},
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}},
+        {"type": "text", "text": "![inline](data:image/jpeg;base64,BBBB)"},
+    ]}}]})
+    message = result["choices"][0]["message"]
+    assert message["content"] == "a cat"
+    assert [img["image_url"]["url"] for img in message["images"]] == [
+        "data:image/png;base64,AAAA",
+        "data:image/jpeg;base64,BBBB",
+    ]
+
+
+def test_from_env_skips_unknown_types_and_accepts_any_case(monkeypatch, capsys):
+    monkeypatch.setattr(mcp_server, "UPSTREAMS", [
+        {"name": "a", "type": "OpenAI", "url": "http://gateway", "key": "k1"},
+        {"name": "b", "type": "anthropic", "key": "k2"},
+        {"name": "c", "key": "k3"},
+    ])
+    pool = UpstreamPool.from_env()
+    assert [(u.name, u.kind) for u in pool.upstreams] == [("a", "openai"), ("c", "openrouter")]
+    assert "b" in capsys.readouterr().err
+    # 模型目录只能从 OpenRouter 获取
+    assert pool.select(kind="openrouter").name == "c"
+    with pytest.raises(ValueError):
+        UpstreamPool([pool.upstreams[0]], "weighted").select(kind="openrouter")
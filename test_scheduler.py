@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+测试按模型限速的请求调度器（离线，无需 API Key）
+
+    python -m pytest -q test_scheduler.py
+"""
+
+import asyncio
+
+import httpx
+
+import mcp_server
+from mcp_server import RequestScheduler, Upstream, UpstreamPool, get_scheduler
+
+
+def _drain(scheduler: RequestScheduler) -> None:
+    """清空令牌桶，使后续请求都必须排队"""
+    scheduler.requests.take(scheduler.requests.tokens)
+
+
+def test_unlimited_scheduler_grants_immediately():
+    async def run():
+        scheduler = RequestScheduler("m", rpm=0, tpm=0)
+        waits = [await scheduler.acquire(10_000, "batch", "s") for _ in range(50)]
+        return scheduler, waits
+
+    scheduler, waits = asyncio.run(run())
+    assert max(waits) < 0.05
+    assert scheduler.stats()["granted"] == 50
+
+
+def test_interactive_first_and_round_robin_between_sessions():
+    # 6000 RPM：每 10 ms 补充一个令牌
+    async def run():
+        scheduler = RequestScheduler("m", rpm=6000, tpm=0)
+        _drain(scheduler)
+        order = []
+
+        async def request(name, priority, session):
+            await scheduler.acquire(1, priority, session)
+            order.append(name)
+
+        tasks = [
+            asyncio.ensure_future(request(name, priority, session))
+            for name, priority, session in [
+                ("batch-1", "batch", "c"),
+                ("a-1", "interactive", "a"),
+                ("a-2", "interactive", "a"),
+                ("a-3", "interactive", "a"),
+                ("b-1", "interactive", "b"),
+                ("b-2", "interactive", "b"),
+            ]
+        ]
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["a-1", "b-1", "a-2", "b-2", "a-3", "batch-1"]
+
+
+def test_rpm_spaces_out_requests():
+    async def run():
+        scheduler = RequestScheduler("m", rpm=3000, tpm=0)
+        _drain(scheduler)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await asyncio.gather(*(scheduler.acquire(1, "interactive", None) for _ in range(5)))
+        return loop.time() - started
+
+    # 3000 RPM 即每 20 ms 一个，5 个请求至少需要约 100 ms
+    assert asyncio.run(run()) >= 0.09
+
+
+def test_cancelled_waiter_does_not_block_the_queue():
+    async def run():
+        scheduler = RequestScheduler("m", rpm=6000, tpm=0)
+        _drain(scheduler)
+        first = asyncio.ensure_future(scheduler.acquire(1, "interactive", "a"))
+        second = asyncio.ensure_future(scheduler.acquire(1, "interactive", "a"))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.wait_for(second, timeout=1)
+        return scheduler.stats()
+
+    stats = asyncio.run(run())
+    assert stats["granted"] == 1
+    assert stats["queued"] == {"interactive": 0, "batch": 0}
+
+
+def test_settle_refunds_overestimated_tokens():
+    scheduler = RequestScheduler("m", rpm=0, tpm=60_000)
+    scheduler.tokens.take(50_000)
+    scheduler.settle(estimated=50_000, actual=1_000)
+    assert 59_000 <= scheduler.tokens.tokens <= 60_000
+    # 实际用量超过预估时补扣
+    scheduler.settle(estimated=1_000, actual=30_000)
+    assert scheduler.tokens.tokens < 31_000
+
+
+def test_oversized_request_waits_only_for_a_full_bucket():
+    scheduler = RequestScheduler("m", rpm=0, tpm=60_000)
+    assert scheduler.tokens.wait_time(1_000_000) == 0.0
+    scheduler.tokens.take(30_000)
+    # 每秒补充 1000 个令牌，约 30 秒后桶满
+    assert 29 < scheduler.tokens.wait_time(1_000_000) <= 30
+
+
+def _pool(monkeypatch, **models) -> UpstreamPool:
+    pool = UpstreamPool(
+        [Upstream(name, "http://upstream", f"key-{name}", models=served) for name, served in models.items()],
+        "weighted",
+    )
+    monkeypatch.setattr(mcp_server, "upstream_pool", pool)
+    return pool
+
+
+def test_capacity_scales_with_upstreams_serving_the_model(monkeypatch):
+    _pool(monkeypatch, a=["scaled-model"], b=["scaled-model"], c=["other-model"])
+    monkeypatch.setattr(mcp_server, "RATE_LIMIT_RPM", 10)
+    monkeypatch.setattr(mcp_server, "RATE_LIMIT_TPM", 1000)
+    monkeypatch.setattr(mcp_server, "_schedulers", {})
+    assert get_scheduler("scaled-model").stats()["rpm"] == 20
+    assert get_scheduler("scaled-model").stats()["tpm"] == 2000
+    assert get_scheduler("other-model").stats()["rpm"] == 10
+
+
+def test_every_upstream_attempt_takes_a_token(monkeypatch):
+    """429 换凭据后的第二次请求同样经过限速"""
+    _pool(monkeypatch, a=None, b=None)
+    monkeypatch.setattr(mcp_server, "_schedulers", {})
+    sent = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        sent.append(request.headers["Authorization"])
+        if request.headers["Authorization"] == "Bearer key-a":
+            return httpx.Response(429, headers={"Retry-After": "60"})
+        return httpx.Response(200, json={"choices": [{"message": {"content": "ok"}}], "usage": {"total_tokens": 5}})
+
+    async def run():
+        monkeypatch.setattr(mcp_server, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        payload = {"model": "attempt-model", "messages": [{"role": "user", "content": "hi"}]}
+        return await mcp_server._fetch_upstream(payload, None, "off", "interactive")
+
+    result, meta = asyncio.run(run())
+    assert result["choices"][0]["message"]["content"] == "ok"
+    assert sent == ["Bearer key-a", "Bearer key-b"]
+    assert get_scheduler("attempt-model").stats()["granted"] == 2
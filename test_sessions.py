@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+测试服务端会话的历史记录和淘汰（离线，无需 API Key）
+
+    python -m pytest -q test_sessions.py
+"""
+
+import asyncio
+import base64
+import json
+import os
+
+from mcp_server import ConversationStore, image_inputs
+
+PNG = b"\x89PNG\r\n\x1a\n" + os.urandom(2000)
+
+
+def _store(max_sessions: int = 10, ttl: float = 3600) -> ConversationStore:
+    return ConversationStore(max_sessions, ttl, max_turns=4, max_images=2)
+
+
+def _inline_result(generation_id: str) -> dict:
+    url = "data:image/png;base64," + base64.b64encode(PNG).decode("ascii")
+    return {"generation_id": generation_id, "content": "here", "images": [{"url": url, "format": "png"}]}
+
+
+def test_inline_images_are_spooled_and_recorded_as_refs():
+    store = _store()
+    conversation = store.get("inline")
+    store.record(conversation, [{"role": "user", "content": "draw"}], _inline_result("gen-inline"))
+
+    assistant = conversation.turns[-1][-1]
+    assert assistant["content"][1] == {"type": "image_ref", "ref": "gen-inline", "index": 0}
+    assert "base64" not in json.dumps(conversation.turns)
+    path = image_inputs.generations["gen-inline"][0]
+    with open(path, "rb") as f:
+        assert f.read() == PNG
+
+    # 下一轮拼装的请求引用该图像，清除会话时删除文件
+    messages, _ = store.build(conversation, [{"role": "user", "content": "again"}])
+    assert messages[1]["content"][1]["type"] == "image_ref"
+    assert store.clear("inline")
+    assert not os.path.exists(path)
+
+
+def test_system_prompt_changes_only_when_the_turn_is_recorded():
+    store = _store()
+    conversation = store.get("system")
+    store.record(conversation, [{"role": "system", "content": "old"}, {"role": "user", "content": "hi"}], {"content": "ok"})
+
+    turn = [{"role": "system", "content": "new"}, {"role": "user", "content": "next"}]
+    messages, _ = store.build(conversation, turn)
+    assert messages[0]["content"] == "new"
+    # 本轮请求失败时不调用 record，会话仍使用原来的系统消息
+    assert conversation.system == [{"role": "system", "content": "old"}]
+    store.record(conversation, turn, {"content": "ok"})
+    assert conversation.system == [{"role": "system", "content": "new"}]
+
+
+def test_prune_skips_sessions_in_the_middle_of_a_turn():
+    store = _store(max_sessions=2)
+
+    async def run():
+        busy = store.get("busy")
+        async with busy.lock:
+            store.get("idle")
+            store.get("newest")
+            # 超出上限时淘汰空闲的会话，而不是正在进行中的最早会话
+            assert list(store.sessions) == ["busy", "newest"]
+            store.sessions["busy"].updated_at = 0
+            store.get("another")
+            assert "busy" in store.sessions
+
+    asyncio.run(run())
+    assert store.evicted == 2
+
+
+def test_prune_drops_expired_sessions_and_their_files():
+    store = _store(ttl=60)
+    conversation = store.get("old")
+    store.record(conversation, [{"role": "user", "content": "draw"}], _inline_result("gen-expired"))
+    path = image_inputs.generations["gen-expired"][0]
+    conversation.updated_at -= 120
+
+    store.get("fresh")
+    assert list(store.sessions) == ["fresh"]
+    assert not os.path.exists(path)
+    store.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+测试 stdio 冷启动前端：握手应答、消息重放和退出清理（离线，无需 API Key）
+
+    python -m pytest -q test_stdio.py
+"""
+
+import importlib
+import json
+import os
+import subprocess
+import sys
+
+import mcp_server
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mcp_server.py")
+
+
+def _initialize(request_id, version: str = "2025-06-18") -> dict:
+    return {
+        "jsonrpc": "2.0",
+        "id": request_id,
+        "method": "initialize",
+        "params": {"protocolVersion": version, "capabilities": {}, "clientInfo": {"name": "test", "version": "0"}},
+    }
+
+
+def _request(request_id, method: str, params: dict = None) -> dict:
+    message = {"jsonrpc": "2.0", "id": request_id, "method": method}
+    if params is not None:
+        message["params"] = params
+    return message
+
+
+INITIALIZED = {"jsonrpc": "2.0", "method": "notifications/initialized"}
+
+
+def _session(tmp_path, *messages: dict, expect: int = 0) -> tuple[list[dict], subprocess.Popen]:
+    """启动服务器进程并依次发送消息，收到 expect 个应答后关闭 stdin，等待进程退出
+
+    stdin 关闭时 SDK 会丢弃仍在处理的请求，所以要先读完应答再断开。
+    """
+    env = {
+        **os.environ,
+        "OPENROUTER_API_KEY": "sk-test",
+        "OPENROUTER_API_URL": "http://127.0.0.1:9",
+        "NANO_BANANA_JOB_DB": "",
+        "NANO_BANANA_CACHE_DIR": str(tmp_path / "cache"),
+    }
+    proc = subprocess.Popen(
+        [sys.executable, SERVER],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=tmp_path,
+    )
+    for message in messages:
+        proc.stdin.write(json.dumps(message).encode() + b"\n")
+    proc.stdin.flush()
+    responses = [json.loads(proc.stdout.readline()) for _ in range(expect)]
+    proc.stdin.close()
+    # 断开后不应再有任何输出，进程应正常退出
+    responses += [json.loads(line) for line in proc.stdout.read().splitlines() if line.strip()]
+    proc.wait(timeout=30)
+    proc.stderr_text = proc.stderr.read().decode()
+    return responses, proc
+
+
+def test_handshake_constants_match_the_sdk():
+    mcp_server.load_runtime()
+    options = mcp_server.get_app().create_initialization_options()
+    assert options.capabilities.model_dump(exclude_none=True) == mcp_server._CAPABILITIES
+    assert (options.server_name, options.server_version) == (mcp_server.SERVER_NAME, mcp_server.SERVER_VERSION)
+    supported = importlib.import_module("mcp.shared.version").SUPPORTED_PROTOCOL_VERSIONS
+    assert set(mcp_server._PROTOCOL_VERSIONS) <= set(supported)
+    assert mcp_server._PROTOCOL_VERSIONS[-1] == mcp_server.mcp_types.LATEST_PROTOCOL_VERSION
+
+
+def test_prelude_answers_then_replays_to_the_full_server(tmp_path):
+    responses, proc = _session(
+        tmp_path,
+        _initialize(1),
+        INITIALIZED,
+        _request(2, "ping"),
+        _request(3, "tools/list"),
+        _request(4, "resources/read", {"uri": "nano-banana://config"}),
+        _request(5, "tools/list"),
+        expect=5,
+    )
+
+    assert proc.returncode == 0, proc.stderr_text
+    by_id = {r["id"]: r for r in responses}
+    # 每个请求恰好一个应答；重放的 initialize 的应答被丢弃
+    assert sorted(by_id) == [1, 2, 3, 4, 5] and len(responses) == 5
+    assert by_id[1]["result"]["protocolVersion"] == "2025-06-18"
+    assert by_id[2]["result"] == {}
+    # 前端应答的工具列表与完整服务器的一致
+    assert [t["name"] for t in by_id[3]["result"]["tools"]] == [t["name"] for t in by_id[5]["result"]["tools"]]
+    assert "contents" in by_id[4]["result"]
+
+
+def test_unknown_protocol_version_gets_the_latest(tmp_path):
+    responses, proc = _session(tmp_path, _initialize(1, "1999-01-01"), expect=1)
+    assert responses[0]["result"]["protocolVersion"] == mcp_server._PROTOCOL_VERSIONS[-1]
+    assert proc.returncode == 0
+
+
+def test_client_that_disconnects_before_initialize_exits_cleanly(tmp_path):
+    responses, proc = _session(tmp_path)
+    assert responses == []
+    assert proc.returncode == 0
+    assert "Traceback" not in proc.stderr_text
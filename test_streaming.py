@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+测试增量 JSON 解析器和图像 base64 落盘（离线，无需 API Key）
+
+    python -m pytest -q test_streaming.py
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+
+import httpx
+import pytest
+
+import mcp_server
+from mcp_server import StreamingJsonParser, _Base64FileSink, _is_image_url_path
+
+
+def _random_string(rng: random.Random) -> str:
+    alphabet = 'abcXYZ 019"\\/\b\f\n\r\té中文\U0001f34c'
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+
+
+def _random_value(rng: random.Random, depth: int = 0):
+    kind = rng.choice(["dict", "list", "str", "int", "float", "literal"] if depth < 4 else ["str", "int", "literal"])
+    if kind == "dict":
+        return {_random_string(rng): _random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))}
+    if kind == "list":
+        return [_random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    if kind == "str":
+        return _random_string(rng)
+    if kind == "int":
+        return rng.randint(-10**12, 10**12)
+    if kind == "float":
+        return rng.uniform(-1e6, 1e6)
+    return rng.choice([True, False, None])
+
+
+def _chunks(text: str, rng: random.Random):
+    i = 0
+    while i < len(text):
+        step = rng.randint(1, 7)
+        yield text[i:i + step]
+        i += step
+
+
+def _parse(text: str, rng: random.Random, sink_factory=lambda path: None):
+    parser = StreamingJsonParser(sink_factory)
+    for chunk in _chunks(text, rng):
+        parser.feed(chunk)
+    return parser.close()
+
+
+def test_matches_json_loads_with_random_chunking():
+    rng = random.Random(1234)
+    for _ in range(500):
+        value = _random_value(rng)
+        text = json.dumps(value, ensure_ascii=rng.random() < 0.5, indent=rng.choice([None, 1]))
+        assert _parse(text, rng) == json.loads(text)
+
+
+def _image_response(url: str) -> dict:
+    return {
+        "id": "gen-1",
+        "choices": [{"message": {"content": "ok", "images": [{"type": "image_url", "image_url": {"url": url}}]}}],
+        "usage": {"total_tokens": 3},
+    }
+
+
+def _spooling_factory(directory: str, sinks: list):
+    def factory(path):
+        if not _is_image_url_path(path):
+            return None
+        sinks.append(_Base64FileSink(directory, f"image_{len(sinks) + 1}"))
+        return sinks[-1]
+    return factory
+
+
+def test_image_url_with_escaped_slashes_is_decoded_to_disk(tmp_path):
+    rng = random.Random(7)
+    # 0xff 0xff 0xff 编码为 "////"，保证 base64 中有需要转义的斜杠
+    data = b"\x89PNG\r\n\x1a\n" + b"\xff" * 300 + os.urandom(4000)
+    url = "data:image/png;base64," + base64.b64encode(data).decode("ascii")
+    text = json.dumps(_image_response(url)).replace("/", "\\/")
+    assert "\\/" in text
+
+    for _ in range(20):
+        sinks: list = []
+        result = _parse(text, rng, _spooling_factory(str(tmp_path), sinks))
+        info = result["choices"][0]["message"]["images"][0]["image_url"]["url"]
+        assert info["format"] == "png"
+        assert info["size"] == len(data)
+        assert info["sha256"] == hashlib.sha256(data).hexdigest()
+        with open(info["file"], "rb") as f:
+            assert f.read() == data
+        assert result["usage"] == {"total_tokens": 3}
+
+
+def test_remote_image_url_stays_a_string(tmp_path):
+    url = "https:\\/\\/example.com\\/images\\/a.png?size=1024"
+    text = json.dumps(_image_response("PLACEHOLDER")).replace("PLACEHOLDER", url)
+    sinks: list = []
+    result = _parse(text, random.Random(3), _spooling_factory(str(tmp_path), sinks))
+    assert result["choices"][0]["message"]["images"][0]["image_url"]["url"] == "https://example.com/images/a.png?size=1024"
+    assert os.listdir(tmp_path) == []
+
+
+def test_truncated_body_raises_and_removes_partial_files(tmp_path):
+    data = os.urandom(20000)
+    url = "data:image/webp;base64," + base64.b64encode(data).decode("ascii")
+    body = json.dumps(_image_response(url)).encode("utf-8")
+    # 截断在图像 base64 中间，以及截断在图像之后（文件已写完但文档不完整）
+    cut_points = [len(body) // 2, body.index(b'"usage"')]
+
+    async def parse(content: bytes):
+        response = httpx.Response(200, content=content)
+        return await mcp_server._parse_streaming_body(response, str(tmp_path))
+
+    for cut in cut_points:
+        with pytest.raises(ValueError):
+            asyncio.run(parse(body[:cut]))
+        assert os.listdir(tmp_path) == []
+
+    result = asyncio.run(parse(body))
+    image_url = result["choices"][0]["message"]["images"][0]["image_url"]
+    assert image_url["size"] == len(data)
+    assert os.listdir(tmp_path) == [os.path.basename(image_url["file"])]
+
+
+@pytest.mark.parametrize("error, message", [
+    ({"code": 502, "message": "Provider returned error"}, "Provider returned error"),
+    ("upstream overloaded", "upstream overloaded"),
+])
+def test_stream_error_chunk_is_raised_with_its_message(monkeypatch, error, message):
+    body = (
+        'data: {"choices": [{"delta": {"content": "par"}}]}\n\n'
+        f"data: {json.dumps({'error': error})}\n\n"
+    )
+
+    def handler(request):
+        return httpx.Response(200, content=body.encode(), headers={"Content-Type": "text/event-stream"})
+
+    async def run():
+        monkeypatch.setattr(mcp_server, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        upstream = mcp_server.Upstream("stream", "http://upstream", "key")
+        payload = {"model": "m", "messages": [], "stream": True}
+        return await mcp_server._stream_chat_completion(payload, None, upstream)
+
+    with pytest.raises(RuntimeError, match=message):
+        asyncio.run(run())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+测试多凭据负载均衡的剔除和故障转移（离线，无需 API Key）
+
+    python -m pytest -q test_upstreams.py
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+from mcp_server import Upstream, UpstreamPool
+
+
+def _status_error(status: int, body: str = "") -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "http://upstream/chat/completions")
+    response = httpx.Response(status, request=request, text=body)
+    return httpx.HTTPStatusError(f"HTTP {status}", request=request, response=response)
+
+
+def _pool(*names: str) -> UpstreamPool:
+    return UpstreamPool([Upstream(name, "http://upstream", f"key-{name}") for name in names], "weighted")
+
+
+def _failing_on(pool: UpstreamPool, errors: dict):
+    """errors 中的上游抛出对应异常，其余上游返回自己的名字"""
+    calls = []
+
+    async def attempt(upstream):
+        calls.append(upstream.name)
+        if upstream.name in errors:
+            raise errors[upstream.name]
+        return upstream.name
+
+    return attempt, calls
+
+
+@pytest.mark.parametrize("status, body", [
+    (429, ""),
+    (401, '{"error": {"message": "No auth credentials found"}}'),
+    (403, '{"error": {"message": "Key limit exceeded (total limit)"}}'),
+    (403, '{"error": {"message": "Insufficient credits"}}'),
+])
+def test_credential_errors_eject_and_fail_over(status, body):
+    pool = _pool("a", "b")
+    attempt, calls = _failing_on(pool, {"a": _status_error(status, body)})
+    # 平滑加权轮询首先选中 a
+    value, upstream = asyncio.run(pool.call(attempt, "m"))
+    assert (value, calls) == ("b", ["a", "b"])
+    a = pool.upstreams[0]
+    assert a.ejected and a.ejections == 1
+    # a 剔除期间只选 b
+    assert {pool.select(model="m").name for _ in range(4)} == {"b"}
+
+
+def test_moderation_403_is_not_failed_over():
+    pool = _pool("a", "b")
+    body = '{"error": {"code": 403, "message": "Input was flagged for moderation", "metadata": {"reasons": ["violence"]}}}'
+    attempt, calls = _failing_on(pool, {"a": _status_error(403, body)})
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(pool.call(attempt, "m"))
+    # 提示词引起的错误换凭据也没用：不剔除、不转移
+    assert calls == ["a"]
+    assert not any(u.ejected for u in pool.upstreams)
+
+
+def test_last_upstream_error_is_raised_for_the_retry_logic():
+    pool = _pool("a", "b")
+    attempt, calls = _failing_on(pool, {"a": _status_error(429), "b": _status_error(429)})
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(pool.call(attempt, "m"))
+    assert calls == ["a", "b"]
+    # 全部被剔除时仍选最早恢复的那个，而不是拒绝请求
+    assert pool.select(model="m") in pool.upstreams
+
+
+def test_outstanding_is_released_on_failure_and_cancellation():
+    pool = _pool("a")
+
+    async def run():
+        attempt, _ = _failing_on(pool, {"a": httpx.ConnectError("down")})
+        with pytest.raises(httpx.ConnectError):
+            await pool.call(attempt, "m")
+        task = asyncio.ensure_future(pool.call(lambda upstream: asyncio.Event().wait(), "m"))
+        await asyncio.sleep(0)
+        assert pool.upstreams[0].outstanding == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert pool.upstreams[0].outstanding == 0
+    assert pool.upstreams[0].errors == 1
+
+
+def test_models_restrict_which_upstreams_serve_a_request():
+    pool = UpstreamPool([
+        Upstream("images", "http://upstream", "k1", models=["image-model"]),
+        Upstream("text", "http://upstream", "k2", models=["text-model"]),
+    ], "weighted")
+    assert {pool.select(model="image-model").name for _ in range(4)} == {"images"}
+    with pytest.raises(ValueError):
+        pool.select(model="unknown-model")